@@ -47,31 +47,19 @@ class Policy_donghunl(Policy):
             self.mu.append(init_val)
             self.mu_cnt.append(0)
 
-    def _update_average_estimate(self, attr, x):
+    def _update_average_estimate(self, a_ix, x):
         """
         iterative averaging of samples
-        :param attr: attribute
+        :param a_ix: attribute ID
         :param x: sample observed
         :return: None
         """
-        a_ix = self.attrs.index(attr)
         mu = self.mu[a_ix]
         n = self.mu_cnt[a_ix] + 1
         mu2 = 1/n * x + (n-1)/n * mu
         self.mu[a_ix] = mu2
         self.mu_cnt[a_ix] = n
 
-    def _closest_ix_to_x(self, x, vec):
-        """
-        returns index ix whose value vec[ix] is closest to x.
-
-        :param x: a number
-        :param vec: list of numbers
-        :return: ix: vec[ix] is closest to x, in absolute value of difference
-        """
-        dist = [np.abs(v - x) for v in vec]
-        return np.argmin(dist)
-
     def bid(self, attr):
         """
         finds a bid that is closest to the revenue sample mean of auctions with the given attr
@@ -79,11 +67,24 @@ class Policy_donghunl(Policy):
         :param attr: attribute tuple. guaranteed to be found in self.attrs
         :return: a value that is found in self.bid_space
         """
-        a_ix = self.attrs.index(attr)
+        a_ix = self.attr_ids[attr]
         est_mean = self.mu[a_ix]
-        closest_bid = self.bid_space[self._closest_ix_to_x(est_mean, self.bid_space)]
+        closest_bid = self.bid_index.nearest(est_mean)
         return closest_bid
 
+    def bid_batch(self, attrs, attr_ids=None):
+        """
+        same as bid, for all auctions of an iteration at once
+
+        :param attrs: list of attribute tuples
+        :param attr_ids: list of attribute IDs, one for each attr
+        :return: list of values found in self.bid_space, one for each attr
+        """
+        if attr_ids is None:
+            attr_ids = [self.attr_ids[attr] for attr in attrs]
+        est_mean = np.asarray(self.mu, dtype=float)[attr_ids]
+        return self.bid_index.nearest(est_mean).tolist()
+
     def learn(self, info):
         """
         learns from auctions results
@@ -99,9 +100,8 @@ class Policy_donghunl(Policy):
         for result in info:
             if result['revenue_per_conversion'] == '':
                 continue
-            attr = result['attr']
             revenue = result['revenue_per_conversion'] * result['num_conversion']
-            self._update_average_estimate(attr, revenue)
+            self._update_average_estimate(result['attr_id'], revenue)
 
         return True
 
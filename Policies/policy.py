@@ -10,19 +10,106 @@ All policy classes inherit this class.
 
 import numpy as np
 
+
+class BidSpace:
+    """
+    Indexed, sorted bid space. Bids can be kept as integer indices, and converted back with from_index.
+
+    Lookups are binary searches over a sorted numpy array. Methods taking a bid accept a number or an array of numbers,
+    and return an int / float, or an array of the same shape.
+    """
+
+    def __init__(self, possible_bids):
+        """
+        :param possible_bids: list of all allowed bids, in any order
+        """
+        self.values = np.unique(np.asarray(list(possible_bids), dtype=float))
+        if len(self.values) == 0:
+            raise ValueError("bid space is empty")
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def min(self):
+        return float(self.values[0])
+
+    @property
+    def max(self):
+        return float(self.values[-1])
+
+    @staticmethod
+    def _ret(ix_or_val, x):
+        return ix_or_val.item() if np.ndim(x) == 0 else ix_or_val
+
+    def from_index(self, ix):
+        """
+        :param ix: bid index
+        :return: bid
+        """
+        return self._ret(self.values[ix], ix)
+
+    def to_index(self, bid):
+        """
+        :param bid: a bid found in the bid space
+        :return: index of the bid
+        """
+        x = np.asarray(bid, dtype=float)
+        ix = np.minimum(np.searchsorted(self.values, x), len(self.values) - 1)
+        if np.any(self.values[ix] != x):
+            raise ValueError("{} is not in the bid space".format(bid))
+        return self._ret(ix, bid)
+
+    def nearest_index(self, x):
+        """
+        :param x: a number
+        :return: index of the bid closest to x. the lower bid, if two are equally close
+        """
+        x = np.asarray(x, dtype=float)
+        if len(self.values) == 1:
+            return self._ret(np.zeros(x.shape, dtype=int), x)
+        hi = np.clip(np.searchsorted(self.values, x), 1, len(self.values) - 1)
+        lo = hi - 1
+        ix = np.where(np.abs(self.values[lo] - x) <= np.abs(self.values[hi] - x), lo, hi)
+        return self._ret(ix, x)
+
+    def nearest(self, x):
+        return self.from_index(self.nearest_index(x))
+
+    def next_higher_index(self, x):
+        """
+        :param x: a number
+        :return: index of the smallest bid strictly greater than x. index of the max bid, if there is none
+        """
+        ix = np.minimum(np.searchsorted(self.values, np.asarray(x, dtype=float), side='right'), len(self.values) - 1)
+        return self._ret(ix, x)
+
+    def next_higher(self, x):
+        return self.from_index(self.next_higher_index(x))
+
+    def clamp(self, x):
+        """
+        :param x: a number
+        :return: x limited to [min bid, max bid]. note that the result need not be in the bid space
+        """
+        return self._ret(np.clip(np.asarray(x, dtype=float), self.values[0], self.values[-1]), x)
+
+
 class Policy():
 
     def __init__(self, all_attrs, possible_bids=list(range(10)), max_t=10, randseed=12345):
         """
         initializes policy base class.
 
-        :param all_attrs: list of all possible attributes
+        :param all_attrs: list of all possible attributes. the position of an attribute in this list is its ID
         :param possible_bids: list of all allowed bids
         :param max_t: maximum number of auction 'iter', or iteration timesteps
         :param randseed: random number seed.
         """
         self.attrs = all_attrs
+        self.attr_ids = {attr: ix for ix, attr in enumerate(all_attrs)}    # attribute tuple -> attribute ID
         self.bid_space = possible_bids
+        self.bid_index = BidSpace(possible_bids)    # sorted bid space with index lookups
         self.max_t = max_t
         self.prng = np.random.RandomState(randseed)
 
@@ -37,6 +124,29 @@ class Policy():
         """
         return self.prng.choice(self.bid_space)
 
+    def bid_batch(self, attrs, attr_ids=None):
+        """
+        returns bids for all auctions of an iteration at once
+
+        The simulator calls this once per iteration, instead of calling bid once per auction.
+        This default calls bid for each attribute, in order. Override it if your policy can bid faster in a batch.
+        An override may take only attrs, as bid_batch(self, attrs); the simulator then does not pass attr_ids.
+
+        :param attrs: list of attribute tuples, each guaranteed to be found in self.attrs
+        :param attr_ids: list of attribute IDs (attr_ids[i] == self.attr_ids[attrs[i]]), given by the simulator,
+                         so that per-attribute state can be kept in arrays indexed by attribute ID
+        :return: list of values found in self.bid_space, one for each attr
+        """
+        return [self.bid(attr) for attr in attrs]
+
+    def snapshot(self):
+        """
+        prepares the policy to be pickled. Simulator.save_checkpoint calls this right before it pickles the policy
+
+        This policy keeps all of its state in the object, so there is nothing to do. Override it if your policy keeps
+        state elsewhere, e.g. RemotePolicy takes a snapshot of the hosted policy
+        """
+
     def learn(self, info):
         """
         learns from auctions results
@@ -44,7 +154,7 @@ class Policy():
         This policy does not learn (need not learn, because it just bids randomly)
 
         :param info: list of results. Single result is an aggregate outcome for all auctions with a particular attr.
-                     Follows the same format as output_policy_info_?????.xlsx
+                     Follows the same format as output_policy_info_?????.xlsx, and 'attr_id' is the attribute ID
         :return: does not matter
         """
         return True
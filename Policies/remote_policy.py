@@ -0,0 +1,238 @@
+"""
+RemotePolicy class
+
+A Policy whose bids and learning run in another process, possibly on another host, behind policy_server.py.
+Messages are struct-framed binary, over one TCP connection per policy:
+
+    frame                   uint8 message type, uint32 payload length (little endian), payload
+    HELLO    client ->      utf-8 json: puid, all_attrs, possible_bids, max_t, randseed (null: policy default)
+    BID      client ->      int32 attribute IDs of all auctions of an iteration
+    BIDS         <- server  float64 bids, one per attribute ID
+    LEARN    client ->      int64 iter, uint32 number of results, then one column per FEEDBACK_COLUMNS entry
+    OK           <- server  empty. reply to HELLO, LEARN and RESTORE
+    ERROR        <- server  utf-8 traceback
+    CLOSE    client ->      empty. the server closes the connection
+    SNAPSHOT client ->      empty
+    STATE        <- server  pickled attributes and policy object of the connection
+    RESTORE  client ->      a STATE payload, instead of HELLO: the connection's policy is the pickled one
+
+One iteration costs one round trip: bid_batch sends all of the iteration's attribute IDs at once, and learn does
+not wait for the server. Its OK is collected with the next reply.
+
+A RemotePolicy can be checkpointed: snapshot() takes a SNAPSHOT of the hosted policy (Simulator.save_checkpoint
+calls it), the pickle holds the last snapshot, and an unpickled RemotePolicy RESTOREs it on a new connection at its
+first call. Pickling itself does no network I/O. The server unpickles what clients send, so it must only be
+reachable by trusted clients.
+
+To run a policy remotely, start policy_server.py on the host, and add a policy file that names the address and
+the PUID the server hosts, e.g. Policies/remote_whan.py:
+
+    from .remote_policy import RemotePolicy
+
+    class Policy_remote_whan(RemotePolicy):
+        address = ('localhost', 7878)
+        remote_puid = 'whan'
+"""
+
+import json
+import math
+import socket
+import struct
+
+import numpy as np
+
+from .policy import Policy
+
+
+HEADER = struct.Struct('<BI')
+HELLO, BID, BIDS, LEARN, OK, ERROR, CLOSE, SNAPSHOT, STATE, RESTORE = 1, 2, 3, 4, 5, 6, 7, 8, 9, 10
+
+LEARN_HEADER = struct.Struct('<qI')
+# p_info key -> wire dtype. '' (no click, no conversion) is sent as nan
+FEEDBACK_COLUMNS = [('attr_id', '<i4'),
+                    ('num_auct', '<i8'),
+                    ('your_bid', '<f8'),
+                    ('winning_bid', '<f8'),
+                    ('winning_bid_avg', '<f8'),
+                    ('your_profit_cumulative', '<f8'),
+                    ('num_impression', '<i8'),
+                    ('num_click', '<i8'),
+                    ('cost_per_click', '<f8'),
+                    ('num_conversion', '<i8'),
+                    ('revenue_per_conversion', '<f8')]
+NULLABLE_COLUMNS = ['cost_per_click', 'revenue_per_conversion']
+
+
+def send_frame(sock, msg_type, payload=b''):
+    sock.sendall(HEADER.pack(msg_type, len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("connection closed")
+        received += n
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    """
+    :return: message type, payload bytes
+    """
+    msg_type, size = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    return msg_type, _recv_exact(sock, size) if size > 0 else b''
+
+
+def encode_feedback(info, attr_ids):
+    """
+    :param info: list of p_info dicts, the input of Policy.learn
+    :param attr_ids: dict attribute tuple -> attribute ID
+    :return: LEARN payload
+    """
+    t = info[0]['iter'] if len(info) > 0 else -1
+    columns = {k: [p[k] for p in info] for k, _ in FEEDBACK_COLUMNS if k != 'attr_id'}
+    columns['attr_id'] = [attr_ids[p['attr']] for p in info]
+    for k in NULLABLE_COLUMNS:
+        columns[k] = [np.nan if v == '' else v for v in columns[k]]
+    return LEARN_HEADER.pack(t, len(info)) + b''.join(np.asarray(columns[k], dtype=dtype).tobytes()
+                                                    for k, dtype in FEEDBACK_COLUMNS)
+
+
+def decode_feedback(payload, all_attrs):
+    """
+    :param payload: LEARN payload
+    :param all_attrs: list of attribute tuples, indexed by attribute ID
+    :return: list of p_info dicts, as encoded
+    """
+    t, n = LEARN_HEADER.unpack_from(payload)
+    offset = LEARN_HEADER.size
+    columns = {}
+    for k, dtype in FEEDBACK_COLUMNS:
+        arr = np.frombuffer(payload, dtype=dtype, count=n, offset=offset)
+        offset += arr.nbytes
+        columns[k] = arr.tolist()
+        if k in NULLABLE_COLUMNS:
+            columns[k] = ['' if math.isnan(v) else v for v in columns[k]]
+    info = []
+    for ix in range(n):
+        p_info = {'iter': t, 'attr': all_attrs[columns['attr_id'][ix]]}
+        for k, _ in FEEDBACK_COLUMNS:
+            p_info[k] = columns[k][ix]
+        info.append(p_info)
+    return info
+
+
+class RemotePolicy(Policy):
+    """
+    Policy adapter: bid_batch and learn are forwarded to a policy hosted by policy_server.py.
+    Subclasses set address and remote_puid; policy_loader then loads them like any other policy.
+    snapshot() takes a snapshot of the hosted policy, which an unpickled copy restores on a new connection.
+    """
+
+    address = ('localhost', 7878)
+    remote_puid = None
+    connect_timeout = 30.0
+
+    def __init__(self, all_attrs, possible_bids=list(range(10)), max_t=10, randseed=None):
+        """
+        connects to the server, which constructs the hosted policy with the same arguments
+
+        :param all_attrs: list of all possible attributes. the position of an attribute in this list is its ID
+        :param possible_bids: list of all allowed bids
+        :param max_t: maximum number of auction 'iter', or iteration timesteps
+        :param randseed: random number seed of the hosted policy. None uses the hosted policy's default
+        """
+        super().__init__(all_attrs, possible_bids, max_t)
+        self.sock = None
+        self._pending = 0       # LEARN messages sent, whose OK is not received yet
+        self._snapshot = None   # STATE payload of the last snapshot(). restored on a new connection after unpickling
+        hello = {'puid': self.remote_puid,
+                 'all_attrs': [list(attr) for attr in all_attrs],
+                 'possible_bids': [float(b) for b in possible_bids],
+                 'max_t': max_t,
+                 'randseed': randseed}
+        self._connect(HELLO, json.dumps(hello).encode('utf-8'))
+
+    def _connect(self, msg_type, payload):
+        """
+        opens the connection, and sets up the hosted policy with a HELLO or RESTORE message
+        """
+        self.sock = socket.create_connection(tuple(self.address), timeout=self.connect_timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_frame(self.sock, msg_type, payload)
+        self._expect(OK)
+
+    def _restore(self):
+        """
+        restores the snapshot of an unpickled policy on a new connection, once
+        """
+        if self.sock is None:
+            if self._snapshot is None:
+                raise RuntimeError("remote policy {} is closed, or was pickled without a snapshot()".format(
+                    self.remote_puid))
+            self._connect(RESTORE, self._snapshot)
+            self._snapshot = None
+
+    def snapshot(self):
+        """
+        takes a snapshot of the hosted policy, which is pickled with this policy. Simulator.save_checkpoint calls this
+        before it pickles the policies. Without a connection, this keeps the snapshot not restored yet
+        """
+        if self.sock is not None:
+            self.flush()
+            send_frame(self.sock, SNAPSHOT)
+            self._snapshot = self._expect(STATE)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['sock'] = None
+        state['_pending'] = 0
+        return state
+
+    def _expect(self, msg_type):
+        reply_type, payload = recv_frame(self.sock)
+        if reply_type == ERROR:
+            raise RuntimeError("remote policy {} failed:\n{}".format(self.remote_puid, payload.decode('utf-8')))
+        if reply_type != msg_type:
+            raise RuntimeError("remote policy {} replied {}, expected {}".format(self.remote_puid, reply_type,
+                                                                                 msg_type))
+        return payload
+
+    def flush(self):
+        """
+        waits until the server has processed all learn feedback sent so far
+        """
+        while self._pending > 0:
+            self._expect(OK)
+            self._pending -= 1
+
+    def bid(self, attr):
+        return self.bid_batch([attr])[0]
+
+    def bid_batch(self, attrs, attr_ids=None):
+        if attr_ids is None:
+            attr_ids = [self.attr_ids[attr] for attr in attrs]
+        self._restore()
+        send_frame(self.sock, BID, np.asarray(attr_ids, dtype='<i4').tobytes())
+        self.flush()
+        return np.frombuffer(self._expect(BIDS), dtype='<f8').tolist()
+
+    def learn(self, info):
+        self._restore()
+        send_frame(self.sock, LEARN, encode_feedback(info, self.attr_ids))
+        self._pending += 1
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.flush()
+                send_frame(self.sock, CLOSE)
+            finally:
+                self.sock.close()
+                self.sock = None
@@ -0,0 +1,9 @@
+from .remote_policy import RemotePolicy
+
+
+class Policy_remote_whan(RemotePolicy):
+    """
+    Policy_whan, hosted by policy_server.py (python policy_server.py --port 7878)
+    """
+    address = ('localhost', 7878)
+    remote_puid = 'whan'
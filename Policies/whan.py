@@ -19,13 +19,11 @@ class Policy_whan(Policy):
         :param randseed: random number seed.
         """
         super().__init__(all_attrs, possible_bids, max_t, randseed=randseed)
-        self.bid_price = {}
-        self.revenue_per_click = {}
-        self.clicks = {}
-        for attr in all_attrs:
-            self.bid_price[attr] = self.prng.choice(self.bid_space)
-            self.revenue_per_click[attr] = 0
-            self.clicks[attr] = 0
+        # per-attribute state, indexed by attribute ID
+        self.bid_ix = np.array([self.bid_index.to_index(self.prng.choice(self.bid_space)) for _ in all_attrs],
+                               dtype=int)    # index into self.bid_index
+        self.revenue_per_click = [0] * len(all_attrs)
+        self.clicks = [0] * len(all_attrs)
 
     def bid(self, attr):
         """
@@ -36,7 +34,19 @@ class Policy_whan(Policy):
         :param attr: attribute tuple. guaranteed to be found in self.attrs
         :return: a value that is found in self.bid_space
         """
-        return self.bid_price[attr]
+        return self.bid_index.from_index(self.bid_ix[self.attr_ids[attr]])
+
+    def bid_batch(self, attrs, attr_ids=None):
+        """
+        same as bid, for all auctions of an iteration at once
+
+        :param attrs: list of attribute tuples
+        :param attr_ids: list of attribute IDs, one for each attr
+        :return: list of values found in self.bid_space, one for each attr
+        """
+        if attr_ids is None:
+            attr_ids = [self.attr_ids[attr] for attr in attrs]
+        return self.bid_index.from_index(self.bid_ix[attr_ids]).tolist()
 
     def learn(self, info):
         """
@@ -47,7 +57,7 @@ class Policy_whan(Policy):
         :return: does not matter
         """
         for result in info:
-            attr = result['attr']
+            attr = result['attr_id']
             if result['num_click'] > 0:
                 old_revenue = self.revenue_per_click[attr]*self.clicks[attr]
                 if result['num_conversion'] > 0:
@@ -57,18 +67,10 @@ class Policy_whan(Policy):
                 self.clicks[attr] += result['num_click']
                 self.revenue_per_click[attr] = (old_revenue+add_revenue)/self.clicks[attr]
             if result['winning_bid'] > self.revenue_per_click[attr]:
-                higher_than_revenue_bids = [p for p in self.bid_space if p > self.revenue_per_click[attr]]
-                # choose the smallest bid from the bids that are higher than the revenue
-                if len(higher_than_revenue_bids) > 0:
-                    self.bid_price[attr] = np.min(higher_than_revenue_bids)
-                else:
-                    self.bid_price[attr] = np.max(self.bid_space)
+                # choose the smallest bid from the bids that are higher than the revenue (max bid if none)
+                self.bid_ix[attr] = self.bid_index.next_higher_index(self.revenue_per_click[attr])
             else:
-                higher_than_winning_bids = [p for p in self.bid_space if p > result['winning_bid']]
-                # choose the smallest bid from the bids that are higher than the winning bid
-                if len(higher_than_winning_bids) > 0:
-                    self.bid_price[attr] = np.min(higher_than_winning_bids)
-                else:
-                    self.bid_price[attr] = np.max(self.bid_space)
+                # choose the smallest bid from the bids that are higher than the winning bid (max bid if none)
+                self.bid_ix[attr] = self.bid_index.next_higher_index(result['winning_bid'])
         return True
 
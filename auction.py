@@ -8,8 +8,6 @@ from itertools import product
 
 import numpy as np
 
-from openpyxl import load_workbook
-
 
 class Auction:
     """ Class to generate auction arrivals
@@ -17,7 +15,8 @@ class Auction:
     """
     @staticmethod
     def read_init_xlsx(fname):
-        wb = load_workbook("auction_ini_01.xlsx")
+        from openpyxl import load_workbook     # imported on first use, runs without xlsx I/O do not pay for it
+        wb = load_workbook(fname)
         ws = wb.active
 
         param = {}
@@ -41,6 +40,8 @@ class Auction:
         self.max_t = int(init_param['max iteration'])
         self.attrs = self._parse_attributes(attributes)
         self.attrs_set = [list(map(int, a['values'])) for a in self.attrs]
+        self.attr_combos = list(product(*self.attrs_set))
+        self.combo_params = self._precompute_combinations()
 
     def _parse_attributes(self, attrs_input):
         """parses input attributes
@@ -66,6 +67,25 @@ class Auction:
 
         return attrs_input
 
+    def _precompute_combinations(self):
+        """sums up attribute parameters for every combination of attributes, once
+
+        Sums are taken attribute by attribute, in the same order as summing per auction, so values are identical.
+
+        :return: dict of numpy arrays, with keys 'lambda', 'theta', 'avg_revenue', 'prob_conversion'.
+                 element i belongs to self.attr_combos[i], i.e. the order of product(*self.attrs_set)
+        """
+        shape = [len(values) for values in self.attrs_set]
+        combo_params = {}
+        for key, name in [('lambda', 'lambda'), ('theta', 'theta'),
+                          ('avg_revenue', 'avg-revenue'), ('prob_conversion', 'prob-conversion')]:
+            total = np.zeros(shape)
+            for ix, a in enumerate(self.attrs):
+                table = np.asarray(a[name], dtype=float)[self.attrs_set[ix]]
+                total = total + table.reshape([-1 if j == ix else 1 for j in range(len(shape))])  # outer sum
+            combo_params[key] = total.ravel()
+        return combo_params
+
     @staticmethod
     def get_revenue_sample(avg_revenue, prng=None, size=1):
         """
@@ -99,35 +119,108 @@ class Auction:
         The output can be fed into simulator so that auctions can take place
         """
         aucts = []
-        for t in range(1, self.max_t+1):
-            for attr in product(*self.attrs_set):
-                auct = {}
-                auct['attr'] = attr
-                auct['iter'] = t
-                auct['lambda'] = 0
-                for ix, a_elem in enumerate(attr):
-                    auct['lambda'] += self.attrs[ix]['lambda'][a_elem]
-                auct['num_auct'] = self.prng.poisson(auct['lambda'])
-                auct['theta'] = 0
-                for ix, a_elem in enumerate(attr):
-                    auct['theta'] += self.attrs[ix]['theta'][a_elem]
-                auct['avg_revenue'] = 0
-                for ix, a_elem in enumerate(attr):
-                    auct['avg_revenue'] += self.attrs[ix]['avg-revenue'][a_elem]
-                auct['prob_conversion'] = 0
-                for ix, a_elem in enumerate(attr):
-                    auct['prob_conversion'] += self.attrs[ix]['prob-conversion'][a_elem]
-                aucts.append(auct)
-            pass
+        for iter_aucts in self.iter_sample():
+            aucts.extend(iter_aucts)
         return aucts
 
+    def iter_sample(self, block_size=64):
+        """generates auction arrivals lazily, one iteration at a time
+
+        Draws from the PRNG in the same order as generate_sample, so the concatenated output is identical to it
+        for the same random seed.
+
+        :param block_size: number of auction arrivals are drawn for this many iterations at once
+        :return generator of lists of auctions, one list per iteration (iter 1, 2, ..., max_t)
+        """
+        lam = self.combo_params['lambda']
+        combo_lists = [self.attr_combos] + [self.combo_params[k].tolist()
+                                            for k in ['lambda', 'theta', 'avg_revenue', 'prob_conversion']]
+        for t_block in range(1, self.max_t+1, block_size):
+            num_iters = min(block_size, self.max_t + 1 - t_block)
+            num_aucts = self.prng.poisson(lam, size=(num_iters, len(lam))).tolist()
+            for b_ix in range(num_iters):
+                yield [{'attr': attr,
+                        'iter': t_block + b_ix,
+                        'lambda': lam_c,
+                        'num_auct': num_auct,
+                        'theta': theta_c,
+                        'avg_revenue': avg_revenue_c,
+                        'prob_conversion': prob_conversion_c}
+                       for (attr, lam_c, theta_c, avg_revenue_c, prob_conversion_c), num_auct
+                       in zip(zip(*combo_lists), num_aucts[b_ix])]
+
+    def generate_columns(self):
+        """generates auction arrivals as columns, without building one dict per auction
+
+        Draws from the PRNG in the same order as generate_sample, so the values are identical to it.
+
+        :return list of attribute tuples, and dict of numpy arrays with keys as in trajectory.COLUMNS
+                ('attr_ix' indexes the attribute list). Can be written with trajectory.save_columns
+        """
+        num_combos = len(self.attr_combos)
+        num_aucts = self.prng.poisson(self.combo_params['lambda'], size=(self.max_t, num_combos))
+        columns = {'iter': np.repeat(np.arange(1, self.max_t+1), num_combos),
+                   'attr_ix': np.tile(np.arange(num_combos), self.max_t),
+                   'num_auct': num_aucts.ravel()}
+        for k, v in self.combo_params.items():
+            columns[k] = np.tile(v, self.max_t)
+        return list(self.attr_combos), columns
+
+    def stream_sample(self):
+        """generates auction arrivals lazily, for the simulator
+
+        :return AuctionStream. Can be fed into simulator's read_in_auction instead of generate_sample output.
+                Memory use is bounded by one iteration's auctions.
+        """
+        return AuctionStream(self)
+
+
+class AuctionStream:
+    """ Auction arrivals generated one iteration at a time
+
+    Any object with attrs, max_t and auctions_at(t) can be fed into Simulator.read_in_auction in the same way.
+    """
+
+    def __init__(self, auction):
+        """
+        :param auction: Auction object. Its PRNG is consumed by this stream, so do not draw other samples from it.
+        """
+        self.attrs = list(auction.attr_combos)
+        self.max_t = auction.max_t
+        self._gen = auction.iter_sample()
+        self._next_t = 1
+
+    def auctions_at(self, t):
+        """
+        auctions of iteration t. Iterations must be requested in increasing order;
+        skipped iterations are generated and dropped, to keep the PRNG in sync.
+
+        :param t: iteration, 1 <= t <= max_t
+        :return: list of auctions of iteration t. empty list if t is past max_t
+        """
+        if t < self._next_t:
+            raise ValueError("iteration {} was already generated, streams cannot go back".format(t))
+        aucts = []
+        while self._next_t <= t:
+            aucts = next(self._gen, [])
+            self._next_t += 1
+        return aucts
+
+    def __iter__(self):
+        """
+        :return: generator of the remaining iterations' auction lists
+        """
+        while self._next_t <= self.max_t:
+            yield self.auctions_at(self._next_t)
+
+
 if __name__ == "__main__":
 
-    import pickle
+    from trajectory import save_columns
 
     param, attrs = Auction.read_init_xlsx("auction_ini_01.xlsx")
 
     auction = Auction(param, attrs)
-    gen = auction.generate_sample()
-
-    pickle.dump(gen, open("auction_01.p", "wb"))
+    save_columns("auction_01.traj", *auction.generate_columns())
+    # load with trajectory.load_trajectory("auction_01.traj"), or convert to the old pickle format with
+    # trajectory.trajectory_to_pickle("auction_01.traj", "auction_01.p")
@@ -0,0 +1,485 @@
+"""
+Benchmarks of the simulator hot paths
+
+Runs synthetic configurations that scale one dimension at a time (number of policies, attribute combinations,
+lambda, iterations), and writes timings as json, so that results of different commits can be compared.
+
+    python benchmark.py                         all suites, results in benchmark_results.json
+    python benchmark.py --suite policies --out bench_abc123.json
+    python benchmark.py --compare old.json new.json
+    python benchmark.py --imports               import time report of simulator start-up
+    python benchmark.py --check                 seeded regression checks of the simulator's guarantees
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from auction import Auction
+from policy_loader import get_pol, get_puids
+from profiler import Profiler
+import sim_lib as sl
+import simulator
+from traj_cache import TrajectoryCache
+
+
+SAMPLE_PUIDS = ['donghunl', 'whan', 'random']
+
+BASE_CONFIG = {'num_pols': 3, 'num_attrs': 2, 'num_values': 3, 'lambda': 10.0, 'max_t': 20}
+
+# each suite varies one dimension of BASE_CONFIG
+SUITES = {'policies': [{'num_pols': n} for n in [3, 10, 30, 100]],
+          'attributes': [{'num_attrs': a, 'num_values': v} for a, v in [(1, 3), (2, 3), (2, 6), (3, 6)]],
+          'lambda': [{'lambda': lam} for lam in [1.0, 10.0, 100.0]],
+          'iterations': [{'max_t': t} for t in [10, 40, 160]]}
+
+
+def synthetic_init(num_attrs, num_values, lam, max_t, randseed=12345):
+    """
+    builds auction parameters in the same format as Auction.read_init_xlsx output
+
+    :param num_attrs: number of attributes
+    :param num_values: number of values of each attribute. there are num_values ** num_attrs combinations
+    :param lam: mean number of auctions per attribute combination and iteration
+    :param max_t: number of iterations
+    :param randseed: auction random seed
+    :return: param, attrs. Feed into Auction(param, attrs)
+    """
+    param = {'random seed': randseed, 'max iteration': max_t}
+    attrs = [{'name': 'attr{}'.format(ix),
+              'values': ','.join(str(v) for v in range(num_values)),
+              'lambda': [lam / num_attrs] * num_values,     # combination lambda is the sum over attributes
+              'theta': 'random',
+              'avg-revenue': 'random',
+              'prob-conversion': 'random'} for ix in range(num_attrs)]
+    return param, attrs
+
+
+class SamplePolicies:
+    """
+    Simulator mixin: num_pols synthetic policies instead of the ones in puid_list.csv.
+    Sample policy classes are cycled, each copy with its own random seed.
+    """
+
+    def __init__(self, num_pols, randseed=12345, **kwargs):
+        self.num_pols = num_pols
+        super().__init__(randseed, **kwargs)
+
+    def _init_pols(self):
+        if self.pols is None and self.puids is None and self.attrs != []:
+            self.puids, self.pols = [], []
+            for ix in range(self.num_pols):
+                puid = SAMPLE_PUIDS[ix % len(SAMPLE_PUIDS)]
+                self.puids.append("{}_{:03d}".format(puid, ix))
+                self.pols.append(get_pol(puid)(self.attrs, self.possible_bids, self.max_t, randseed=1000 + ix))
+            self.p_infos = {ix: [] for ix in range(len(self.pols))}
+            self.profiler.set_policies(self.puids)
+
+
+class BenchSimulator(SamplePolicies, simulator.Simulator):
+    """
+    Simulator with num_pols synthetic policies, see SamplePolicies
+    """
+
+
+def _timings(fn, repeat):
+    """
+    :param fn: function without arguments
+    :param repeat: number of runs
+    :return: dict of min / median seconds, and the return value of the last run
+    """
+    seconds = []
+    ret = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        ret = fn()
+        seconds.append(time.perf_counter() - t)
+    return {'seconds_min': min(seconds), 'seconds_median': float(np.median(seconds)), 'repeat': repeat}, ret
+
+
+def bench_generate_sample(config, repeat=3):
+    def run():
+        param, attrs = synthetic_init(config['num_attrs'], config['num_values'], config['lambda'], config['max_t'])
+        return Auction(param, attrs).generate_sample()
+    res, aucts = _timings(run, repeat)
+    res['num_auction_rows'] = len(aucts)
+    res['num_auctions'] = sum(a['num_auct'] for a in aucts)
+    return res
+
+
+def bench_top_K_max(config, repeat=3, num_calls=2000):
+    prng = np.random.RandomState(12345)
+    possible_bids = [v / 10 for v in range(100)]
+    bids_list = [[possible_bids[ix] for ix in prng.randint(len(possible_bids), size=config['num_pols'])]
+                 for _ in range(num_calls)]
+    K = min(8, config['num_pols'])
+
+    def run():
+        for bids in bids_list:
+            sl.top_K_max(bids, K, prng)
+    res, _ = _timings(run, repeat)
+    res['num_calls'] = num_calls
+    res['us_per_call'] = res['seconds_min'] / num_calls * 1e6
+
+    bids_arr = np.array(bids_list)
+    batch_res, _ = _timings(lambda: sl.top_K_max_batch(bids_arr, K, prng), repeat)
+    res['batch_seconds_min'] = batch_res['seconds_min']
+    res['batch_us_per_row'] = batch_res['seconds_min'] / num_calls * 1e6
+    return res
+
+
+def bench_simulation(config, fmt='xlsx'):
+    """
+    one full simulation run: step() over all iterations, then output_all(fmt) into a temporary directory
+
+    :return: dict of step / output timings, and the profiler's phase breakdown (incl. feedback aggregation)
+    """
+    param, attrs = synthetic_init(config['num_attrs'], config['num_values'], config['lambda'], config['max_t'])
+    aucts = Auction(param, attrs).generate_sample()
+    prof = Profiler()
+    sim = BenchSimulator(config['num_pols'], profiler=prof)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.read_in_auction(aucts)
+        t = time.perf_counter()
+        for _ in range(config['max_t']):
+            sim.step()
+        step_seconds = time.perf_counter() - t
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                t = time.perf_counter()
+                sim.output_all(fmt, num_workers=1)
+                output_seconds = time.perf_counter() - t
+            finally:
+                os.chdir(cwd)
+    sim.close()
+
+    num_auctions = sum(a['num_auct'] for a in aucts)
+    return {'step_seconds': step_seconds,
+            'step_seconds_per_iter': step_seconds / config['max_t'],
+            'auctions_per_second': num_auctions / step_seconds if step_seconds > 0 else None,
+            'num_auction_rows': len(aucts),
+            'num_auctions': num_auctions,
+            'output_format': fmt,
+            'output_seconds': output_seconds,
+            'phases_s': prof.summary()['phases_s']}
+
+
+def _parse_importtime(stderr):
+    """
+    :param stderr: output of python -X importtime
+    :return: list of (module, self us, cumulative us, nesting depth), in import order
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        entries.append((name.strip(), int(self_us), int(cum_us), (len(name) - len(name.lstrip()) - 1) // 2))
+    return entries
+
+
+def bench_startup(modules=('simulator', 'simulator_parallel'), top=10):
+    """
+    where start-up time goes: imports each module in a fresh interpreter with python -X importtime,
+    then times loading (import and construction) of each policy listed in puid_list.csv
+
+    :param modules: modules to import
+    :param top: number of slowest direct imports of each module kept, by cumulative time
+    :return: dict {'modules': {module: {'total_ms', 'top': [[name, cumulative ms, self ms], ...]}},
+                   'policies': {puid: {'import_ms', 'init_ms'}}}
+    """
+    res = {'modules': {}, 'policies': {}}
+    for module in modules:
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                              capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        entries = _parse_importtime(proc.stderr)
+        total = [cum for name, _, cum, depth in entries if name == module and depth == 0]
+        slowest = sorted((e for e in entries if e[3] == 1), key=lambda e: -e[2])[:top]
+        res['modules'][module] = {'total_ms': total[-1] / 1e3 if total else None,
+                                  'top': [[name, cum / 1e3, self_us / 1e3] for name, self_us, cum, _ in slowest]}
+
+    param, attrs = synthetic_init(BASE_CONFIG['num_attrs'], BASE_CONFIG['num_values'], BASE_CONFIG['lambda'], 1)
+    all_attrs = sorted({a['attr'] for a in Auction(param, attrs).generate_sample()})
+    possible_bids = [v / 10 for v in range(100)]
+    for puid in get_puids():
+        t = time.perf_counter()
+        pol = get_pol(puid)
+        t_import = time.perf_counter()
+        pol(all_attrs, possible_bids, 1)
+        res['policies'][puid] = {'import_ms': (t_import - t) * 1e3, 'init_ms': (time.perf_counter() - t_import) * 1e3}
+    return res
+
+
+def startup_report(res):
+    """
+    :param res: bench_startup output
+    :return: human readable text
+    """
+    lines = []
+    for module, m in res['modules'].items():
+        lines.append("import {}: {:.1f} ms".format(module, m['total_ms'] or float('nan')))
+        for name, cum_ms, self_ms in m['top']:
+            lines.append("  {:40s} {:8.1f} ms  (self {:.1f} ms)".format(name, cum_ms, self_ms))
+    for puid, p in res['policies'].items():
+        lines.append("policy {}: import {:.1f} ms, init {:.1f} ms".format(puid, p['import_ms'], p['init_ms']))
+    return '\n'.join(lines)
+
+
+def run_suites(suites=None, repeat=3, fmt='xlsx'):
+    """
+    :param suites: list of SUITES keys. default is all suites
+    :param repeat: number of runs of the smaller benchmarks (generate_sample, top_K_max)
+    :param fmt: output format of the output benchmark
+    :return: list of result dicts
+    """
+    results = []
+    for suite in (suites or list(SUITES.keys())):
+        for change in SUITES[suite]:
+            config = dict(BASE_CONFIG)
+            config.update(change)
+            for name, fn in [('generate_sample', lambda: bench_generate_sample(config, repeat)),
+                             ('top_K_max', lambda: bench_top_K_max(config, repeat)),
+                             ('simulation', lambda: bench_simulation(config, fmt))]:
+                res = {'suite': suite, 'benchmark': name, 'config': config}
+                res.update(fn())
+                results.append(res)
+                print("{:10s} {:16s} {}: {}".format(suite, name, change, _headline(res)))
+    return results
+
+
+def _headline(res):
+    if res['benchmark'] == 'simulation':
+        return "{:.4f} s/iter, output {:.3f} s".format(res['step_seconds_per_iter'], res['output_seconds'])
+    return "{:.4f} s".format(res['seconds_min'])
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def save_results(results, fname):
+    out = {'meta': {'commit': _git_commit(),
+                    'time': datetime.now().isoformat(timespec='seconds'),
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'platform': platform.platform()},
+           'results': results}
+    with open(fname, 'w') as ofh:
+        json.dump(out, ofh, indent=2)
+
+
+def _result_key(res):
+    return res['suite'], res['benchmark'], json.dumps(res['config'], sort_keys=True)
+
+
+def slot_frequencies(bids, K, num_runs, prng, batch=False):
+    """
+    how often each bidder lands in each of the top K positions
+
+    :param bids: list of N bids
+    :param K: int
+    :param num_runs: number of draws
+    :param prng: numpy-compatible PRNG
+    :param batch: if True, draws with sl.top_K_max_batch, else with sl.top_K_max
+    :return: (N, K) array of counts. equal bids should have about equal counts in every position
+    """
+    counts = np.zeros((len(bids), min(K, len(bids))), dtype=int)
+    if batch:
+        _, top_ix = sl.top_K_max_batch(np.tile(np.asarray(bids, dtype=float), (num_runs, 1)), K, prng)
+    else:
+        top_ix = np.array([sl.top_K_max(bids, K, prng)[1] for _ in range(num_runs)])
+    for pos in range(counts.shape[1]):
+        counts[:, pos] = np.bincount(top_ix[:, pos], minlength=len(bids))
+    return counts
+
+
+def check_tie_breaks(num_runs=20000):
+    """
+    bidders 0, 1 (above the K-th bid) and 2, 3 (at it) of [5, 5, 3, 3, 1] must split their positions evenly,
+    with sl.top_K_max and sl.top_K_max_batch
+    """
+    for batch in [False, True]:
+        counts = slot_frequencies([5, 5, 3, 3, 1], 3, num_runs, np.random.RandomState(12345), batch)
+        for group, positions in [([0, 1], [0, 1]), ([2, 3], [2])]:
+            for pos in positions:
+                share = counts[group, pos] / num_runs
+                if np.any(np.abs(share - 1 / len(group)) >= 0.02):
+                    raise AssertionError("top_K_max{}: biased tie-break at position {}: {}".format(
+                        '_batch' if batch else '', pos, counts[:, pos].tolist()))
+
+
+# small configuration of the equivalence checks below
+CHECK_CONFIG = {'num_pols': 3, 'num_attrs': 2, 'num_values': 3, 'lambda': 10.0, 'max_t': 12}
+
+
+def _check_init():
+    """
+    :return: param, attrs of CHECK_CONFIG. a new copy on every call, since Auction modifies attrs
+    """
+    return synthetic_init(CHECK_CONFIG['num_attrs'], CHECK_CONFIG['num_values'], CHECK_CONFIG['lambda'],
+                          CHECK_CONFIG['max_t'])
+
+
+def _simulate(aucts, sim=None, **kwargs):
+    """
+    runs BenchSimulator over all remaining iterations of aucts
+
+    :param aucts: input of read_in_auction. ignored if sim is given
+    :param sim: optional simulator that already read in its auctions, e.g. after resume
+    :param kwargs: Simulator keyword arguments
+    :return: aggregate history without 'time_spent', and policy feedback
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        if sim is None:
+            sim = BenchSimulator(CHECK_CONFIG['num_pols'], **kwargs)
+            sim.read_in_auction(aucts)
+        while sim.t < sim.max_t:
+            sim.step()
+    sim.close()
+    return [{k: v for k, v in h.items() if k != 'time_spent'} for h in sim.hist], sim.p_infos
+
+
+def _assert_same(name, expected, actual):
+    for what, e, a in zip(['hist', 'p_infos'], expected, actual):
+        if e != a:
+            raise AssertionError("{}: {} differs".format(name, what))
+
+
+def check_click_sampling():
+    """
+    click_sampling 'batch' and 'scalar' must give identical results for the same seed
+    """
+    aucts = Auction(*_check_init()).generate_sample()
+    _assert_same('batch vs scalar', _simulate(aucts, click_sampling='scalar'),
+                 _simulate(aucts, click_sampling='batch'))
+
+
+def check_stream():
+    """
+    Auction.stream_sample and Auction.generate_sample must give identical results
+    """
+    _assert_same('stream vs eager', _simulate(Auction(*_check_init()).generate_sample()),
+                 _simulate(Auction(*_check_init()).stream_sample()))
+
+
+def check_resume():
+    """
+    a run resumed from its last checkpoint must end the same as an uninterrupted run
+    """
+    aucts = Auction(*_check_init()).generate_sample()
+    expected = _simulate(aucts)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prefix = os.path.join(tmpdir, 'checkpoint')
+        crashed = BenchSimulator(CHECK_CONFIG['num_pols'], checkpoint_every=5, checkpoint_prefix=prefix)
+        with contextlib.redirect_stdout(io.StringIO()):
+            crashed.read_in_auction(aucts)
+            for _ in range(CHECK_CONFIG['max_t'] - 4):
+                crashed.step()
+        crashed.close()
+        resumed = BenchSimulator(CHECK_CONFIG['num_pols'], checkpoint_every=5, checkpoint_prefix=prefix)
+        with contextlib.redirect_stdout(io.StringIO()):
+            resumed.resume(prefix, aucts)
+        if resumed.t != 5:
+            raise AssertionError("resumed at iteration {}, not at the last checkpoint 5".format(resumed.t))
+        _assert_same('resume vs uninterrupted', expected, _simulate(None, sim=resumed))
+
+
+def check_traj_cache():
+    """
+    a cached trajectory, when generated and when loaded again, must give the same results as generate_sample
+    """
+    expected = _simulate(Auction(*_check_init()).generate_sample())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = TrajectoryCache(tmpdir)
+        for _ in range(2):
+            _assert_same('cached vs uncached', expected, _simulate(cache.trajectory(*_check_init())))
+        if cache.hits != 1:
+            raise AssertionError("trajectory was not loaded from the cache")
+
+
+# seeded regression checks, run by --check. each raises AssertionError if its guarantee does not hold
+CHECKS = {'tie_breaks': check_tie_breaks,
+          'click_sampling': check_click_sampling,
+          'stream': check_stream,
+          'resume': check_resume,
+          'traj_cache': check_traj_cache}
+
+
+def run_checks(names=None):
+    """
+    :param names: names of CHECKS to run. default: all
+    :return: True if all checks passed
+    """
+    ok = True
+    for name in names or list(CHECKS.keys()):
+        try:
+            CHECKS[name]()
+            print("{:20s} ok".format(name))
+        except AssertionError as e:
+            print("{:20s} FAILED: {}".format(name, e))
+            ok = False
+    return ok
+
+
+def compare(old_fname, new_fname):
+    """
+    prints new / old time ratios of benchmarks present in both result files. < 1 means faster
+
+    :return: list of (suite, benchmark, config, ratio)
+    """
+    with open(old_fname) as ifh:
+        old = {_result_key(r): r for r in json.load(ifh)['results']}
+    with open(new_fname) as ifh:
+        new = json.load(ifh)['results']
+    ratios = []
+    for res in new:
+        key = _result_key(res)
+        if key not in old:
+            continue
+        time_key = 'step_seconds' if res['benchmark'] == 'simulation' else 'seconds_min'
+        ratio = res[time_key] / old[key][time_key] if old[key][time_key] > 0 else None
+        ratios.append((res['suite'], res['benchmark'], res['config'], ratio))
+        print("{:10s} {:16s} {}: {}".format(res['suite'], res['benchmark'], key[2],
+                                            "n/a" if ratio is None else "{:.2f}x".format(ratio)))
+    return ratios
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks of the simulator hot paths")
+    parser.add_argument('--suite', action='append', choices=list(SUITES.keys()),
+                        help="suite to run, can be given more than once. default: all suites")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--format', default='xlsx', help="output format of the output benchmark")
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files and exit")
+    parser.add_argument('--imports', action='store_true', help="print an import time report and exit")
+    parser.add_argument('--check', nargs='*', choices=list(CHECKS.keys()),
+                        help="run regression checks (all if none are named) and exit")
+    args = parser.parse_args()
+
+    if args.check is not None:
+        sys.exit(0 if run_checks(args.check) else 1)
+    elif args.compare:
+        compare(*args.compare)
+    elif args.imports:
+        print(startup_report(bench_startup()))
+    else:
+        save_results(run_suites(args.suite, args.repeat, args.format), args.out)
+        print("results written to {}".format(args.out))
@@ -0,0 +1,138 @@
+"""
+EventStore class
+
+Compact, columnar storage of per-click events of a simulation run.
+"""
+
+import numpy as np
+
+
+class EventStore:
+    """
+    Keeps per-click events as numpy columns instead of one dict per click.
+
+    A click event has iter, attr index (into Simulator.attrs), winning policy index, cost, conversion and revenue.
+    An auction without any click is kept as one event with num_click == 0, whose winner is a random max bidder.
+    Cumulative sums per policy are not stored, but computed on demand.
+    """
+
+    columns = {'iter': np.int32,
+               'attr_ix': np.int32,
+               'winning_pol_id': np.int32,
+               'num_click': np.int8,
+               'cost_per_click': np.float64,
+               'num_conversion': np.int8,
+               'revenue_per_conversion': np.float64}
+
+    def __init__(self):
+        self._chunks = {k: [] for k in self.columns}
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, t, attr_ix, winners, costs, conversions, revenues):
+        """
+        appends events of one auction
+
+        :param t: iteration
+        :param attr_ix: attribute index of the auction
+        :param winners: winning policy index of each click
+        :param costs: cost of each click
+        :param conversions: conversion (0 or 1) of each click
+        :param revenues: revenue of each click (0 if not converted)
+        :return: None
+        """
+        n = len(winners)
+        chunk = {'iter': np.full(n, t),
+                 'attr_ix': np.full(n, attr_ix),
+                 'winning_pol_id': winners,
+                 'num_click': np.ones(n),
+                 'cost_per_click': costs,
+                 'num_conversion': conversions,
+                 'revenue_per_conversion': revenues}
+        self._append_chunk(chunk, n)
+
+    def append_no_click(self, t, attr_ix, winner):
+        """
+        appends the single event of an auction that got no click
+
+        :param t: iteration
+        :param attr_ix: attribute index of the auction
+        :param winner: policy index of the (randomly chosen) max bidder
+        :return: None
+        """
+        chunk = {'iter': [t], 'attr_ix': [attr_ix], 'winning_pol_id': [winner], 'num_click': [0],
+                 'cost_per_click': [0.0], 'num_conversion': [0], 'revenue_per_conversion': [0.0]}
+        self._append_chunk(chunk, 1)
+
+    def _append_chunk(self, chunk, n):
+        for k, dtype in self.columns.items():
+            self._chunks[k].append(np.asarray(chunk[k], dtype=dtype))
+        self._len += n
+
+    def since(self, start):
+        """
+        events appended after the first start events, e.g. for an incremental checkpoint
+
+        :param start: number of events to skip
+        :return: dict of numpy arrays, one per column. can be appended back with extend
+        """
+        return {k: self.column(k)[start:] for k in self.columns}
+
+    def extend(self, columns):
+        """
+        appends events given as columns (output of since)
+
+        :param columns: dict of numpy arrays, one per column
+        :return: None
+        """
+        self._append_chunk(columns, len(columns['iter']))
+
+    def column(self, name):
+        """
+        returns one column of all events as a numpy array
+
+        :param name: one of EventStore.columns
+        :return: numpy array of length len(self)
+        """
+        chunks = self._chunks[name]
+        if len(chunks) != 1:
+            merged = np.concatenate(chunks) if len(chunks) > 0 else np.zeros(0, dtype=self.columns[name])
+            self._chunks[name] = [merged]
+        return self._chunks[name][0]
+
+    def cumulative(self, kind='cost', pol_id=None):
+        """
+        running sum after each event, computed on demand without a (events, policies) array
+
+        :param kind: 'cost', 'revenue' or 'profit'
+        :param pol_id: policy index. None gives each event the running sum of its own winning policy
+        :return: length len(self) array. entry i holds the running sum after event i
+        """
+        if kind == 'profit':
+            return self.cumulative('revenue', pol_id) - self.cumulative('cost', pol_id)
+        values = self.column('cost_per_click' if kind == 'cost' else 'revenue_per_conversion')
+        winners = self.column('winning_pol_id')
+        if pol_id is not None:
+            return np.cumsum(np.where(winners == pol_id, values, 0.0))
+        ret = np.zeros(len(self))
+        for p_ix in np.unique(winners).tolist():
+            won = winners == p_ix
+            ret[won] = np.cumsum(values[won])
+        return ret
+
+    def totals(self, num_pols, kind='cost'):
+        """
+        total sum per policy over all events
+
+        :param num_pols: number of policies
+        :param kind: 'cost', 'revenue' or 'profit'
+        :return: length num_pols array
+        """
+        if kind == 'profit':
+            return self.totals(num_pols, 'revenue') - self.totals(num_pols, 'cost')
+        values = self.column('cost_per_click' if kind == 'cost' else 'revenue_per_conversion')
+        ret = np.zeros(num_pols)
+        np.add.at(ret, self.column('winning_pol_id'), values)
+        return ret
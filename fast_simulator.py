@@ -0,0 +1,328 @@
+"""
+FastSimulator class, simulating a whole iteration with array operations
+"""
+
+import contextlib
+import io
+import time
+from copy import deepcopy
+
+import numpy as np
+
+from auction import Auction
+from benchmark import SamplePolicies
+from profiler import Profiler
+import sim_lib as sl
+import simulator
+
+
+def gsp_slot_prices_batch(bids, slot_pol):
+    """
+    sl.gsp_slot_prices of many auctions: each slot pays the next lower distinct bid of its auction
+    (the lowest bid pays itself)
+
+    :param bids: (num auctions, num policies) bids
+    :param slot_pol: (num auctions, K) policy index of each ad slot, highest bid first
+    :return: (num auctions, K) cost per click
+    """
+    slot_bids = np.take_along_axis(bids, slot_pol, axis=1)
+    sorted_bids = np.sort(bids, axis=1)
+    num_lower = (bids[:, None, :] < slot_bids[:, :, None]).sum(axis=2)
+    next_lower = np.take_along_axis(sorted_bids, np.maximum(num_lower - 1, 0), axis=1)
+    return np.where(num_lower > 0, next_lower, slot_bids)
+
+
+def vcg_slot_prices_batch(bids, slot_pol, slot_click_prob):
+    """
+    sl.vcg_slot_prices of many auctions
+
+    :param bids: (num auctions, num policies) bids
+    :param slot_pol: (num auctions, K) policy index of each ad slot, highest bid first
+    :param slot_click_prob: click probability (or any proportional weight) of each slot, decreasing
+    :return: (num auctions, K) cost per click
+    """
+    num_a, K = slot_pol.shape
+    slot_bids = np.take_along_axis(bids, slot_pol, axis=1)
+    if bids.shape[1] > K:
+        first_out = -np.partition(-bids, K, axis=1)[:, K:K + 1]
+    else:
+        first_out = np.zeros((num_a, 1))
+    next_bids = np.hstack([slot_bids[:, 1:], first_out])
+    p = np.asarray(slot_click_prob, dtype=float)[:K]
+    p_drop = p - np.append(p[1:], 0.0)
+    payment = np.cumsum((p_drop * next_bids)[:, ::-1], axis=1)[:, ::-1]
+    return payment / p
+
+
+PRICING_BATCH = {'gsp': lambda bids, slot_pol, slot_click_prob: gsp_slot_prices_batch(bids, slot_pol),
+                 'vcg': vcg_slot_prices_batch}
+
+
+class FastSimulator(simulator.Simulator):
+    """
+    Simulates ad-click auction over time, processing all auctions of an iteration as
+    (auctions x policies) and (auctions x ad slots) arrays instead of one auction at a time
+
+    Same public API as Simulator (read_in_auction, step, output_all). The model is the same, but random numbers
+    are drawn per iteration rather than per click, so results match the reference engine in distribution,
+    not draw for draw (see compare_engines):
+    - ties are broken with random keys (sl.top_K_max_batch)
+    - clicks of an auction are split over ad slots with a multinomial draw (as conditional binomials)
+    - revenue of an ad slot is one gamma draw for all its conversions (a sum of gamma(4) is gamma(4 * n))
+    Per-click events are not kept (self.events is None). engine='reference' runs Simulator.step instead.
+    """
+
+    def __init__(self, randseed=12345, engine='fast', **kwargs):
+        """ initializes the auction simulating environment
+
+        :param randseed: seed for the simulator. it is used for click and conversion sampling and tiebreaking
+        :param engine: 'fast' (array engine) or 'reference' (Simulator.step, for validation)
+        :param kwargs: passed to simulator.Simulator. keep_events is ignored by the fast engine
+        """
+        if engine not in ['fast', 'reference']:
+            raise ValueError("engine must be 'fast' or 'reference', not {}".format(engine))
+        self.engine = engine
+        super().__init__(randseed, **kwargs)
+        if engine == 'fast':
+            self.events = None
+
+    def get_num_clicks_batch(self, theta, num_aucts):
+        """
+        get_num_clicks of many auctions
+
+        :param theta: array of auction theta
+        :param num_aucts: array of number of auctions
+        :return: array of number of clicks, array of click probabilities
+        """
+        p_click = sl.get_click_prob({'a': theta, 'bid': 0, '0': 0, 'max_click_prob': 0.5}, 0)
+        return self.prng.binomial(num_aucts, p_click), p_click
+
+    def _split_clicks(self, num_clicks):
+        """
+        :param num_clicks: array of number of clicks, one per auction
+        :return: (num auctions, K) number of clicks landing in each ad slot, with slot probabilities
+                 self.ad_slot_click_prob_adjuster
+        """
+        p = np.asarray(self.ad_slot_click_prob_adjuster, dtype=float)
+        remaining = np.asarray(num_clicks, dtype=np.int64)
+        slot_clicks = np.zeros((len(remaining), len(p)), dtype=np.int64)
+        p_left = 1.0
+        for k in range(len(p) - 1):
+            slot_clicks[:, k] = self.prng.binomial(remaining, min(1.0, p[k] / p_left) if p_left > 0 else 0.0)
+            remaining = remaining - slot_clicks[:, k]
+            p_left -= p[k]
+        slot_clicks[:, -1] = remaining
+        return slot_clicks
+
+    def step(self):
+        """
+        simulates one timestep in the auction
+        :return: True if auction is simulated, False if no auction data is present
+        """
+        if self.engine == 'reference':
+            return super().step()
+
+        prof = self.profiler
+        self.t += 1
+
+        prof.start('generation')
+        aucts = self._auctions_at(self.t)
+        prof.stop('generation')
+        if len(aucts) == 0:
+            return False
+
+        prof.start('bidding')
+        attrs = [a['attr'] for a in aucts]
+        attr_ids = [self.attr_ix[attr] for attr in attrs]
+        step_bids = self._get_bids(attrs, attr_ids)
+        prof.stop('bidding')
+
+        prof.start('click_sampling')
+        num_a, num_p = len(aucts), len(self.pols)
+        rows = np.arange(num_a)[:, None]
+        bids = np.array(step_bids, dtype=float)
+        num_aucts = np.array([a['num_auct'] for a in aucts], dtype=np.int64)
+        theta = np.array([a['theta'] for a in aucts], dtype=float)
+        prob_conversion = np.array([a['prob_conversion'] for a in aucts], dtype=float)
+        avg_revenue = np.array([a['avg_revenue'] for a in aucts], dtype=float)
+
+        # clear all auctions: slot -> (policy, price) tables
+        _, slot_pol = sl.top_K_max_batch(bids, self.num_of_ad_slots, self.prng)
+        slot_price = PRICING_BATCH[self.pricing](bids, slot_pol, self.ad_slot_click_prob_adjuster)
+
+        # clicks, conversions and revenue of every (auction, ad slot)
+        num_clicks, p_click = self.get_num_clicks_batch(theta, num_aucts)
+        slot_clicks = self._split_clicks(num_clicks)
+        slot_conversions = self.prng.binomial(slot_clicks, prob_conversion[:, None])
+        slot_revenue = np.zeros(slot_clicks.shape)
+        has_revenue = (slot_conversions > 0) & (avg_revenue[:, None] > 0)
+        scale = np.broadcast_to(avg_revenue[:, None] / 4, slot_clicks.shape)
+        slot_revenue[has_revenue] = self.prng.gamma(4 * slot_conversions[has_revenue], scale[has_revenue])
+
+        # (auctions x policies) outcomes. a policy has at most one slot per auction
+        num_click = np.zeros((num_a, num_p), dtype=np.int64)
+        num_click[rows, slot_pol] = slot_clicks
+        num_conversion = np.zeros((num_a, num_p), dtype=np.int64)
+        num_conversion[rows, slot_pol] = slot_conversions
+        cost_sum = np.zeros((num_a, num_p))
+        cost_sum[rows, slot_pol] = slot_clicks * slot_price
+        revenue_sum = np.zeros((num_a, num_p))
+        revenue_sum[rows, slot_pol] = slot_revenue
+        cost_per_click = np.full((num_a, num_p), np.nan)
+        cost_per_click[rows, slot_pol] = np.where(slot_clicks > 0, slot_price, np.nan)
+
+        # cumulative sums after each auction, and aggregate history for output
+        costs = np.asarray(self.costs_cumulative)[None, :] + np.cumsum(cost_sum, axis=0)
+        revenues = np.asarray(self.revenues_cumulative)[None, :] + np.cumsum(revenue_sum, axis=0)
+        profits = revenues - costs
+        self.costs_cumulative, self.revenues_cumulative = costs[-1].tolist(), revenues[-1].tolist()
+        self.profits_cumulative = profits[-1].tolist()
+        if self.keep_hist or self.sink is not None:
+            self._record_hist(aucts, step_bids, num_click, num_conversion, cost_sum, revenue_sum, p_click,
+                              costs, revenues, profits)
+        prof.stop('click_sampling')
+
+        prof.start('aggregation')
+        fb = self._feedback(aucts, attrs, attr_ids, bids, slot_pol, num_click, num_conversion, cost_sum,
+                            revenue_sum, cost_per_click)
+        self._finish_step(fb)
+        return True
+
+    def _feedback(self, aucts, attrs, attr_ids, bids, slot_pol, num_click, num_conversion, cost_sum, revenue_sum,
+                  cost_per_click):
+        """
+        :return: this iteration's feedback, in the format of sl.aggregate_feedback output
+        """
+        clicked = num_click.sum(axis=1)
+        no_click = clicked == 0
+
+        # an auction without click is one event won by a max bidder, as in the reference engine
+        wins = num_click.copy()
+        wins[np.nonzero(no_click)[0], slot_pol[no_click, 0]] = 1
+        num_events = np.maximum(clicked, 1)
+        num_auct = [a['num_auct'] for a in aucts]
+        num_impression = (np.asarray(num_auct, dtype=np.int64)[:, None] * wins / num_events[:, None]).astype(np.int64)
+
+        max_bid = bids.max(axis=1)
+        clicked_bids = np.where(num_click > 0, bids, -np.inf)
+        winning_bid = np.where(no_click, max_bid, clicked_bids.max(axis=1))
+        winning_bid_avg = np.where(no_click, max_bid, (bids * num_click).sum(axis=1) / num_events)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            revenue_per_conversion = np.where(num_conversion > 0, revenue_sum / num_conversion, np.nan)
+        profit_cumulative = np.asarray(self.pol_profit_cumulative, dtype=float)[None, :] + \
+            np.cumsum(revenue_sum - cost_sum, axis=0)
+
+        return {'iter': self.t,
+                'attr': attrs,
+                'attr_id': attr_ids,
+                'num_auct': num_auct,
+                'your_bid': bids,
+                'winning_bid': winning_bid,
+                'winning_bid_avg': winning_bid_avg,
+                'your_profit_cumulative': profit_cumulative,
+                'num_impression': num_impression,
+                'num_click': num_click,
+                'cost_per_click': cost_per_click,
+                'num_conversion': num_conversion,
+                'revenue_per_conversion': revenue_per_conversion}
+
+    def _record_hist(self, aucts, step_bids, num_click, num_conversion, cost_sum, revenue_sum, p_click,
+                     costs, revenues, profits):
+        """
+        keeps aggregate history rows (self.hist, sink), in the same format as the reference engine
+        """
+        num_clicks = num_click.sum(axis=1).tolist()
+        num_conversions = num_conversion.sum(axis=1).tolist()
+        cost_total = cost_sum.sum(axis=1).tolist()
+        revenue_total = revenue_sum.sum(axis=1).tolist()
+        p_click = p_click.tolist()
+        costs, revenues, profits = costs.tolist(), revenues.tolist(), profits.tolist()
+        for a_ix, a in enumerate(aucts):
+            auct_res = dict(a)
+            auct_res['bids'] = step_bids[a_ix]
+            auct_res['num_click'] = num_clicks[a_ix]
+            auct_res['p_click'] = p_click[a_ix]
+            auct_res['cost_per_click'] = cost_total[a_ix] / num_clicks[a_ix] if num_clicks[a_ix] > 0 else ''
+            auct_res['num_conversion'] = num_conversions[a_ix]
+            auct_res['revenue_per_conversion'] = revenue_total[a_ix] / num_conversions[a_ix] \
+                if num_conversions[a_ix] > 0 else ''
+            auct_res['costs_cumulative'] = costs[a_ix]
+            auct_res['revenues_cumulative'] = revenues[a_ix]
+            auct_res['profits_cumulative'] = profits[a_ix]
+            if self.keep_hist:
+                self.hist.append(auct_res)
+            if self.sink is not None:
+                self.sink.write_hist(self._hist_row(auct_res))
+
+
+class _SamplePolicySimulator(SamplePolicies, FastSimulator):
+    """
+    FastSimulator with num_pols copies of the sample policies, see benchmark.SamplePolicies
+    """
+
+
+def _run_engine(engine, param, attrs, randseed, max_t, num_pols=None):
+    auc = Auction(dict(param, **{'random seed': randseed, 'max iteration': max_t}), deepcopy(attrs))
+    kwargs = {'engine': engine, 'keep_events': False, 'keep_hist': False, 'profiler': Profiler(keep_time_log=False)}
+    if num_pols is None:
+        sim = FastSimulator(randseed, **kwargs)
+    else:
+        sim = _SamplePolicySimulator(num_pols, randseed, **kwargs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.read_in_auction(auc.stream_sample())
+        t = time.time()
+        for _ in range(max_t):
+            sim.step()
+    seconds = time.time() - t
+    return sim.puids, np.array(sim.profits_cumulative), np.array(sim.costs_cumulative), seconds
+
+
+def compare_engines(param, attrs, seeds, max_t=20, z_threshold=4.0, num_pols=None):
+    """
+    statistical equivalence check of the fast engine against the reference engine
+
+    Runs both engines over the same seeds, and compares the means of per-policy cumulative cost and profit
+    with Welch's two-sample z statistic. Engines are taken as equivalent if every |z| < z_threshold.
+
+    :param param: auction parameters, as from Auction.read_init_xlsx
+    :param attrs: auction attributes, as from Auction.read_init_xlsx
+    :param seeds: list of seeds (auction and simulator). at least 2; a few dozens for a useful check
+    :param max_t: iterations per run
+    :param z_threshold: largest allowed |z|
+    :param num_pols: if given, runs this many copies of the sample policies instead of the ones in puid_list.csv.
+                     Use more policies than ad slots to check slot allocation and tie-breaks among the top bids
+    :return: dict with 'equivalent', per-policy 'stats', and 'seconds' per engine
+    """
+    runs = {}
+    seconds = {}
+    for engine in ['reference', 'fast']:
+        res = [_run_engine(engine, param, attrs, seed, max_t, num_pols) for seed in seeds]
+        puids = res[0][0]
+        runs[engine] = {'profit': np.array([r[1] for r in res]), 'cost': np.array([r[2] for r in res])}
+        seconds[engine] = sum(r[3] for r in res)
+
+    stats = []
+    for kind in ['cost', 'profit']:
+        ref, fast = runs['reference'][kind], runs['fast'][kind]
+        se = np.sqrt(ref.var(axis=0, ddof=1) / len(ref) + fast.var(axis=0, ddof=1) / len(fast))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.where(se > 0, (fast.mean(axis=0) - ref.mean(axis=0)) / se, 0.0)
+        for p_ix, puid in enumerate(puids):
+            stats.append({'puid': puid, 'kind': kind, 'reference_mean': float(ref[:, p_ix].mean()),
+                          'fast_mean': float(fast[:, p_ix].mean()), 'z': float(z[p_ix])})
+    return {'equivalent': all(abs(s['z']) < z_threshold for s in stats), 'stats': stats, 'seconds': seconds}
+
+
+if __name__ == "__main__":
+    param, attrs = Auction.read_init_xlsx("auction_ini_01.xlsx")
+    # policies of puid_list.csv, then more policies than ad slots (only the top 8 bids get a slot)
+    for num_pols, seeds, max_t in [(None, list(range(1, 31)), 20), (11, list(range(1, 31)), 15)]:
+        report = compare_engines(param, attrs, seeds=seeds, max_t=max_t, num_pols=num_pols)
+        print("policies: {}".format('puid_list.csv' if num_pols is None else num_pols))
+        for s in report['stats']:
+            print("{:14s} {:6s} reference {:12.2f}  fast {:12.2f}  z {:6.2f}".format(
+                s['puid'], s['kind'], s['reference_mean'], s['fast_mean'], s['z']))
+        print("reference engine {:.2f} sec, fast engine {:.2f} sec".format(report['seconds']['reference'],
+                                                                          report['seconds']['fast']))
+        print("equivalent" if report['equivalent'] else "NOT equivalent")
@@ -0,0 +1,313 @@
+"""
+Output writers for simulation results
+
+All writers take rows one at a time (append) and finish the file on close(), so that a table never has to be
+kept in memory as a whole by the writer. The first row is the header.
+
+- 'xlsx': openpyxl write-only workbook
+- 'csv': streaming csv
+- 'npz': numpy columnar binary. one array per column; empty cells become nan (numeric columns)
+- 'parquet': columnar binary, needs pyarrow (optional)
+"""
+
+import csv
+import os
+
+import numpy as np
+
+
+FORMATS = ['xlsx', 'csv', 'npz', 'parquet']
+
+
+def cell(v):
+    """
+    converts a value to what goes into an output cell. lists and tuples are written as their string
+
+    :param v: value
+    :return: value for the cell
+    """
+    return str(v) if isinstance(v, (list, tuple)) else v
+
+
+class XlsxWriter:
+    """ xlsx output, using openpyxl write-only mode (rows are not kept as cell objects) """
+
+    def __init__(self, fname):
+        from openpyxl import Workbook
+        self.fname = fname
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet()
+
+    def append(self, row):
+        self.ws.append(row)
+
+    def close(self):
+        self.wb.save(self.fname)
+
+
+class CsvWriter:
+    """ streaming csv output. rows go to disk as they are appended """
+
+    def __init__(self, fname, mode='w'):
+        self.fname = fname
+        self.ofh = open(fname, mode, newline='')
+        self.writer = csv.writer(self.ofh)
+
+    def append(self, row):
+        self.writer.writerow(row)
+
+    def flush(self):
+        self.ofh.flush()
+
+    def tell(self):
+        return self.ofh.tell()
+
+    def close(self):
+        self.ofh.close()
+
+
+class _ColumnarWriter:
+    """
+    collects rows as columns, and writes them on close
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.header = None
+        self.cols = None
+
+    def append(self, row):
+        if self.header is None:
+            self.header = [str(k) for k in row]
+            self.cols = [[] for _ in row]
+            return
+        for col, v in zip(self.cols, row):
+            col.append(v)
+
+    @staticmethod
+    def _is_numeric(col):
+        return all(isinstance(v, (int, float, np.number)) or v == '' or v is None for v in col)
+
+
+class NpzWriter(_ColumnarWriter):
+    """ numpy .npz output, one array per column """
+
+    def close(self):
+        arrays = {}
+        for k, col in zip(self.header or [], self.cols or []):
+            if self._is_numeric(col):
+                arrays[k] = np.array([np.nan if v == '' or v is None else v for v in col])
+            else:
+                arrays[k] = np.array([str(v) for v in col])
+        np.savez(self.fname, **arrays)
+
+
+class ParquetWriter(_ColumnarWriter):
+    """ parquet output. pyarrow is optional, and only needed for this format """
+
+    def __init__(self, fname):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("parquet output needs pyarrow. pip install pyarrow, or use 'npz' output instead")
+        super().__init__(fname)
+
+    def close(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        arrays = {}
+        for k, col in zip(self.header or [], self.cols or []):
+            if self._is_numeric(col):
+                arrays[k] = pa.array([None if v == '' else v for v in col], type=pa.float64())
+            else:
+                arrays[k] = pa.array([str(v) for v in col])
+        pq.write_table(pa.table(arrays), self.fname)
+
+
+_WRITERS = {'xlsx': XlsxWriter, 'csv': CsvWriter, 'npz': NpzWriter, 'parquet': ParquetWriter}
+
+
+def get_writer(fmt, fname):
+    """
+    :param fmt: one of FORMATS
+    :param fname: output file name
+    :return: writer object with append(row) and close()
+    """
+    if fmt not in _WRITERS:
+        raise ValueError("unknown output format {}. choose one of {}".format(fmt, FORMATS))
+    return _WRITERS[fmt](fname)
+
+
+def out_fname(fname_base, fmt):
+    """
+    :param fname_base: file name without extension
+    :param fmt: one of FORMATS
+    :return: file name with the extension of the format
+    """
+    return "{}.{}".format(fname_base, fmt)
+
+
+def write_rows(fmt, fname, rows):
+    """
+    writes a table to a file
+
+    :param fmt: one of FORMATS
+    :param fname: output file name
+    :param rows: iterable of rows. the first row is the header
+    :return: fname
+    """
+    writer = get_writer(fmt, fname)
+    for row in rows:
+        writer.append(row)
+    writer.close()
+    return fname
+
+
+def write_tables(fmt, tables, num_workers=None):
+    """
+    writes many tables, one at a time, or in parallel worker processes if num_workers is given
+
+    :param fmt: one of FORMATS
+    :param tables: list of (fname, rows). rows is an iterable of rows, e.g. a generator. With worker processes,
+                   each table is built as a list and sent to a worker
+    :param num_workers: number of worker processes. default (None) or 1 writes one table at a time, streaming its
+                        rows, in this process. Worker processes only pay off for large tables
+    :return: list of file names written
+    """
+    num_workers = min(num_workers or 1, len(tables))
+    if num_workers <= 1:
+        return [write_rows(fmt, fname, rows) for fname, rows in tables]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(write_rows, fmt, fname, list(rows)) for fname, rows in tables]
+        return [f.result() for f in futures]
+
+
+class StreamingSink:
+    """
+    Receives finished rows from Simulator.step while the simulation runs, and appends them to disk
+    every flush_every iterations. A crash loses at most the last flush_every iterations.
+
+    - 'csv': rows are appended to one csv file per table, and the files are flushed
+    - 'npz': each flush writes one numpy columnar part file per table, <name>.part<NNNNN>.npz.
+             read a table back with load_npz_parts(<name>)
+    xlsx cannot be appended to, so it is not a streaming format.
+    """
+
+    def __init__(self, fmt='csv', prefix='', flush_every=10):
+        """
+        :param fmt: 'csv' or 'npz'
+        :param prefix: prepended to output file names, e.g. a directory 'run01/'
+        :param flush_every: rows are written to disk every this many iterations
+        """
+        if fmt not in ['csv', 'npz']:
+            raise ValueError("streaming output format must be 'csv' or 'npz', not {}".format(fmt))
+        self.fmt = fmt
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self.headers = {}
+        self.buffers = {}
+        self.writers = {}
+        self.num_parts = 0
+        self.policy_tables = []
+
+    def open(self, hist_header, policy_info_header, time_header, puids, state=None):
+        """
+        called by Simulator.read_in_auction, once policies are known
+
+        :param hist_header: header of the master aggregate table
+        :param policy_info_header: header of the per-policy tables
+        :param time_header: header of the time spent table
+        :param puids: policy unique ids
+        :param state: output of state(), to continue files written up to a checkpoint (rows written after it are
+                      dropped). None starts new files
+        :return: None
+        """
+        self.policy_tables = ["output_policy_info_{}".format(puid) for puid in puids]
+        self.headers = {"output_master_aggregate": hist_header, "output_time_spent_in_seconds": time_header}
+        for name in self.policy_tables:
+            self.headers[name] = policy_info_header
+        self.buffers = {name: [] for name in self.headers}
+        if state is not None:
+            self._resume(state)
+        elif self.fmt == 'csv':
+            for name, header in self.headers.items():
+                self.writers[name] = CsvWriter(self.fname(name))
+                self.writers[name].append(header)
+
+    def _resume(self, state):
+        import glob
+        if self.fmt == 'csv':
+            for name in self.headers:
+                with open(self.fname(name), 'r+') as ofh:
+                    ofh.truncate(state['positions'][name])
+                self.writers[name] = CsvWriter(self.fname(name), mode='a')
+        else:
+            self.num_parts = state['num_parts']
+            for name in self.headers:
+                for fname in glob.glob("{}{}.part*.npz".format(self.prefix, name)):
+                    if int(fname[-9:-4]) >= self.num_parts:
+                        os.remove(fname)
+
+    def state(self):
+        """
+        flushes, and returns how far the files are written. see open
+
+        :return: dict of csv file positions and number of npz parts
+        """
+        self.flush()
+        return {'positions': {name: writer.tell() for name, writer in self.writers.items()},
+                'num_parts': self.num_parts}
+
+    def fname(self, name):
+        return out_fname(self.prefix + name, self.fmt)
+
+    def write_hist(self, row):
+        self.buffers["output_master_aggregate"].append(row)
+
+    def write_time(self, row):
+        self.buffers["output_time_spent_in_seconds"].append(row)
+
+    def write_policy_info(self, p_ix, rows):
+        self.buffers[self.policy_tables[p_ix]].extend(rows)
+
+    def end_iter(self, t):
+        """
+        :param t: iteration that just finished
+        :return: None
+        """
+        if t % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        if self.fmt == 'csv':
+            for name, rows in self.buffers.items():
+                for row in rows:
+                    self.writers[name].append(row)
+                self.writers[name].flush()
+        elif any(len(rows) > 0 for rows in self.buffers.values()):
+            for name, rows in self.buffers.items():
+                write_rows('npz', "{}{}.part{:05d}.npz".format(self.prefix, name, self.num_parts),
+                           [self.headers[name]] + rows)
+            self.num_parts += 1
+        self.buffers = {name: [] for name in self.headers}
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+def load_npz_parts(fname_base):
+    """
+    reads back a table written by StreamingSink in 'npz' format
+
+    :param fname_base: prefix + table name, e.g. 'output_master_aggregate'
+    :return: dict of numpy arrays, one per column
+    """
+    import glob
+    parts = [np.load(fname) for fname in sorted(glob.glob("{}.part*.npz".format(fname_base)))]
+    if len(parts) == 0:
+        return {}
+    return {k: np.concatenate([part[k] for part in parts]) for k in parts[0].files}
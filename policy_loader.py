@@ -3,27 +3,49 @@ Loads policies by
 1. load the list of PUID from "puid_list.csv"
 2. load "Policy_<PUID>" class that is defined in ./Policies/<PUID>.py
 
+Both are cached: puid_list.csv is read again only when it changes, and a policy module is imported only when
+its PUID is first asked for, so unlisted modules in ./Policies are never imported.
+
 by Donghun Lee 2018
 """
 
 import csv
+import os
+from functools import lru_cache
 from importlib import import_module
 
 
 def get_pols():
-    puids = get_puids()
-    mod_names = ["Policies" + "." + puid for puid in puids]
-    pol_names = ["Policy_" + puid for puid in puids]
-    mods = list(map(import_module, mod_names))
-    pol_ptr = [getattr(mod, pol) for mod, pol in zip(mods, pol_names)]
-    return pol_ptr
+    return [get_pol(puid) for puid in get_puids()]
+
+
+@lru_cache(maxsize=None)
+def get_pol(puid):
+    """
+    loads a single policy class
 
+    :param puid: policy unique id
+    :return: class Policy_<puid>, defined in ./Policies/<puid>.py
+    """
+    mod = import_module("Policies" + "." + puid)
+    return getattr(mod, "Policy_" + puid)
 
-def get_puids():
-    with open("puid_list.csv") as ifh:
+
+@lru_cache(maxsize=8)
+def _read_puids(path, mtime_ns):
+    with open(path) as ifh:
         reader = csv.reader(ifh)
         puids = [fn[0] for fn in reader]
-    return puids
+    return tuple(puids)
+
+
+def get_puids(fname="puid_list.csv"):
+    """
+    :param fname: policy list file, one PUID per line
+    :return: list of PUIDs. the file is parsed once, and again only after it is modified
+    """
+    path = os.path.abspath(fname)
+    return list(_read_puids(path, os.stat(path).st_mtime_ns))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+"""
+Policy server
+
+Hosts policies of ./Policies/<puid>.py for RemotePolicy clients (see Policies/remote_policy.py for the protocol).
+Every connection gets its own policy object, constructed from the client's HELLO, and served in its own thread.
+
+    python policy_server.py --host 0.0.0.0 --port 7878
+
+For tests on one machine, serve_in_thread() starts a server on localhost in the background.
+RESTORE messages are unpickled: serve only trusted clients (the default interface is localhost).
+"""
+
+import argparse
+import json
+import pickle
+import socket
+import socketserver
+import threading
+import traceback
+
+import numpy as np
+
+from policy_loader import get_pol
+from Policies import remote_policy as rp
+import sim_lib as sl
+
+
+class PolicyHandler(socketserver.BaseRequestHandler):
+    """
+    one client connection: HELLO constructs the policy (or RESTORE unpickles one), then BID, LEARN and SNAPSHOT are
+    served until CLOSE
+    """
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pol = None
+        self.all_attrs = None
+
+    def _hello(self, payload):
+        hello = json.loads(payload.decode('utf-8'))
+        self.all_attrs = [tuple(attr) for attr in hello['all_attrs']]
+        kwargs = {} if hello['randseed'] is None else {'randseed': hello['randseed']}
+        self.pol = get_pol(hello['puid'])(self.all_attrs, hello['possible_bids'], hello['max_t'], **kwargs)
+        return rp.OK, b''
+
+    def _snapshot(self, payload):
+        return rp.STATE, pickle.dumps((self.all_attrs, self.pol))
+
+    def _restore(self, payload):
+        self.all_attrs, self.pol = pickle.loads(payload)
+        return rp.OK, b''
+
+    def _bid(self, payload):
+        attr_ids = np.frombuffer(payload, dtype='<i4').tolist()
+        bids = sl.call_bid_batch(self.pol, [self.all_attrs[ix] for ix in attr_ids], attr_ids)
+        return rp.BIDS, np.asarray([float(b) for b in bids], dtype='<f8').tobytes()
+
+    def _learn(self, payload):
+        self.pol.learn(rp.decode_feedback(payload, self.all_attrs))
+        return rp.OK, b''
+
+    def handle(self):
+        handlers = {rp.HELLO: self._hello, rp.BID: self._bid, rp.LEARN: self._learn,
+                    rp.SNAPSHOT: self._snapshot, rp.RESTORE: self._restore}
+        while True:
+            try:
+                msg_type, payload = rp.recv_frame(self.request)
+            except ConnectionError:
+                return
+            if msg_type == rp.CLOSE:
+                return
+            try:
+                if msg_type not in handlers or (msg_type not in [rp.HELLO, rp.RESTORE] and self.pol is None):
+                    raise ValueError("unexpected message type {}".format(msg_type))
+                reply_type, reply = handlers[msg_type](payload)
+            except Exception:
+                reply_type, reply = rp.ERROR, traceback.format_exc().encode('utf-8')
+            rp.send_frame(self.request, reply_type, reply)
+
+
+class PolicyServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve_in_thread(host='127.0.0.1', port=0):
+    """
+    starts a policy server in a background thread
+
+    :param host: interface to listen on
+    :param port: port to listen on. 0 picks a free port
+    :return: server (call shutdown() and server_close() to stop it), and its (host, port) address
+    """
+    server = PolicyServer((host, port), PolicyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="hosts ./Policies/<puid>.py policies for RemotePolicy clients")
+    parser.add_argument('--host', default='127.0.0.1', help="interface to listen on, 0.0.0.0 for all")
+    parser.add_argument('--port', type=int, default=7878)
+    args = parser.parse_args()
+
+    with PolicyServer((args.host, args.port), PolicyHandler) as server:
+        print("serving policies on {}:{}".format(*server.server_address))
+        server.serve_forever()
@@ -0,0 +1,167 @@
+"""
+Profiler class
+
+Low-overhead instrumentation of a simulation run: per-phase timers, per-policy call latencies with
+histograms, optional sampling of the histograms and opt-in periodic reporting.
+"""
+
+import json
+from time import perf_counter_ns
+
+import numpy as np
+
+
+PHASES = ['setup', 'generation', 'bidding', 'click_sampling', 'aggregation', 'learning', 'output', 'checkpoint']
+CALLS = ['bid', 'learn']
+NUM_BUCKETS = 64    # latency histogram bucket b counts calls taking [2^(b-1), 2^b) ns
+
+
+class Profiler:
+    """
+    Collects time spent in simulation phases and in policy calls, with time.perf_counter_ns
+
+    Phase time includes the policy calls made in that phase ('bidding', 'learning').
+    The simulator's own time ('simulator', as in output_time_spent_in_seconds) is all phase time minus policy time.
+    """
+
+    def __init__(self, sample_every=1, report_every=None, keep_time_log=True):
+        """
+        :param sample_every: policy call latencies are added to the histograms in one of this many iterations.
+                             phases and policy time totals always include every iteration
+        :param report_every: if given, prints a one-line report every this many iterations
+        :param keep_time_log: if True, keeps cumulative time spent after every iteration, for output
+        """
+        self.sample_every = sample_every
+        self.report_every = report_every
+        self.keep_time_log = keep_time_log
+        self.phase_ns = {phase: 0 for phase in PHASES}
+        self.phase_count = {phase: 0 for phase in PHASES}
+        self.puids = []
+        self.policy_ns = np.zeros((0, len(CALLS)), dtype=np.int64)
+        self.policy_calls = np.zeros((0, len(CALLS)), dtype=np.int64)
+        self.latency_hist = np.zeros((0, len(CALLS), NUM_BUCKETS), dtype=np.int64)
+        self.time_log = []
+        self.sampling = True
+        self.iterations = 0
+        self._phase_start = {}
+
+    def set_policies(self, puids):
+        """
+        :param puids: policy unique ids. policy index is the position in this list
+        """
+        self.puids = list(puids)
+        self.policy_ns = np.zeros((len(puids), len(CALLS)), dtype=np.int64)
+        self.policy_calls = np.zeros((len(puids), len(CALLS)), dtype=np.int64)
+        self.latency_hist = np.zeros((len(puids), len(CALLS), NUM_BUCKETS), dtype=np.int64)
+
+    @staticmethod
+    def now():
+        return perf_counter_ns()
+
+    def start(self, phase):
+        self._phase_start[phase] = perf_counter_ns()
+
+    def stop(self, phase):
+        self.phase_ns[phase] += perf_counter_ns() - self._phase_start.pop(phase)
+        self.phase_count[phase] += 1
+
+    def add_phase(self, phase, ns):
+        """
+        adds time measured elsewhere to a phase
+
+        :param phase: one of PHASES
+        :param ns: nanoseconds
+        """
+        self.phase_ns[phase] += ns
+        self.phase_count[phase] += 1
+
+    def record_policy(self, p_ix, call, ns):
+        """
+        records one policy call. Its latency goes into the histogram only in sampled iterations
+
+        :param p_ix: policy index
+        :param call: 'bid' or 'learn'
+        :param ns: nanoseconds the call took
+        """
+        c_ix = CALLS.index(call)
+        self.policy_ns[p_ix, c_ix] += ns
+        self.policy_calls[p_ix, c_ix] += 1
+        if self.sampling:
+            self.latency_hist[p_ix, c_ix, min(int(ns).bit_length(), NUM_BUCKETS - 1)] += 1
+
+    def end_iter(self, t):
+        """
+        called by the simulator at the end of every iteration
+
+        :param t: iteration that just finished
+        """
+        self.iterations += 1
+        self.sampling = (t + 1) % self.sample_every == 0
+        if self.keep_time_log:
+            self.time_log.append((t, self.time_spent()))
+        if self.report_every is not None and t % self.report_every == 0:
+            print(self.report_line(t))
+
+    def time_spent(self):
+        """
+        :return: dict of seconds spent so far: 'simulator' and one entry per puid (bid and learn calls together)
+        """
+        pol_ns = self.policy_ns.sum(axis=1)
+        ret = {'simulator': (sum(self.phase_ns.values()) - int(pol_ns.sum())) / 1e9}
+        for puid, ns in zip(self.puids, pol_ns.tolist()):
+            ret[puid] = ns / 1e9
+        return ret
+
+    def report_line(self, t):
+        phases = ', '.join('{} {:.3f}s'.format(phase, ns / 1e9) for phase, ns in self.phase_ns.items())
+        return "iter {}: {}".format(t, phases)
+
+    def _latency_summary(self, p_ix, c_ix):
+        calls = int(self.policy_calls[p_ix, c_ix])
+        hist = self.latency_hist[p_ix, c_ix]
+        sampled = int(hist.sum())
+        summary = {'calls': calls,
+                   'total_s': int(self.policy_ns[p_ix, c_ix]) / 1e9,
+                   'mean_us': int(self.policy_ns[p_ix, c_ix]) / calls / 1e3 if calls > 0 else None,
+                   'sampled_calls': sampled,
+                   'histogram_us': {}}
+        if sampled > 0:
+            cum = np.cumsum(hist)
+            for q in [50, 90, 99]:
+                bucket = int(np.searchsorted(cum, sampled * q / 100))
+                summary['p{}_us_upper'.format(q)] = 2 ** bucket / 1e3
+            for bucket in np.nonzero(hist)[0].tolist():
+                summary['histogram_us']['<{:g}'.format(2 ** bucket / 1e3)] = int(hist[bucket])
+        return summary
+
+    def summary(self):
+        """
+        :return: dict with phase totals, and per-policy call latencies (with histograms, buckets by powers of 2 ns)
+        """
+        return {'iterations': self.iterations,
+                'sample_every': self.sample_every,
+                'phases_s': {phase: ns / 1e9 for phase, ns in self.phase_ns.items()},
+                'time_spent_s': self.time_spent(),
+                'policies': {puid: {call: self._latency_summary(p_ix, c_ix) for c_ix, call in enumerate(CALLS)}
+                             for p_ix, puid in enumerate(self.puids)}}
+
+    def report(self):
+        """
+        :return: human readable summary text
+        """
+        lines = ["{} iterations".format(self.iterations)]
+        total_ns = sum(self.phase_ns.values())
+        for phase, ns in self.phase_ns.items():
+            share = 100 * ns / total_ns if total_ns else 0
+            lines.append("  {:15s} {:10.3f} s  {:5.1f} %".format(phase, ns / 1e9, share))
+        for p_ix, puid in enumerate(self.puids):
+            for c_ix, call in enumerate(CALLS):
+                s = self._latency_summary(p_ix, c_ix)
+                if s['sampled_calls'] > 0:
+                    lines.append("  {:15s} {:5s} {:8d} calls  mean {:10.1f} us  p99 < {:10.1f} us".format(
+                        puid, call, s['calls'], s['mean_us'], s['p99_us_upper']))
+        return '\n'.join(lines)
+
+    def save_summary(self, fname):
+        with open(fname, 'w') as ofh:
+            json.dump(self.summary(), ofh, indent=2)
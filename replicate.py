@@ -0,0 +1,194 @@
+"""
+Replication driver
+
+Runs the same policy set over many random seeds in a pool of worker processes, and summarizes per-policy
+cumulative profit over the replications with means and confidence intervals.
+
+    python replicate.py auction_ini_01.xlsx --seeds 1-30 --workers 4
+    python replicate.py auction_ini_01.xlsx --seeds 1-30 --cache .traj_cache     reuses parsed config and trajectories
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+
+import numpy as np
+
+from auction import Auction
+import output_writers as ow
+from policy_loader import get_pols
+from profiler import Profiler
+from simulator import Simulator
+from traj_cache import TrajectoryCache
+
+
+# two-sided 95% critical values of Student's t distribution, by degrees of freedom. 1.96 is used above 30
+T_975 = [None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+         2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+         2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+# per-process state, set once by _init_worker and reused for every seed the process runs
+_worker_init = {}
+
+
+def _init_worker(param, attrs, cache_dir=None):
+    """
+    process pool initializer. Keeps the parsed configuration and imports policy modules once per process
+
+    :param param: auction parameters, as from Auction.read_init_xlsx
+    :param attrs: auction attributes, as from Auction.read_init_xlsx
+    :param cache_dir: optional TrajectoryCache directory. trajectories are generated once, and loaded from it
+    """
+    _worker_init['param'] = param
+    _worker_init['attrs'] = attrs
+    _worker_init['cache'] = TrajectoryCache(cache_dir) if cache_dir is not None else None
+    get_pols()
+
+
+def run_replication(seed, max_t=None, sim_seed=None):
+    """
+    generates one auction trajectory and simulates it. Runs in a worker process set up by _init_worker
+
+    :param seed: auction 'random seed'
+    :param max_t: number of iterations. default is the configured 'max iteration'
+    :param sim_seed: simulator random seed. default is seed
+    :return: dict with seed, puids, and per-policy cumulative cost, revenue and profit lists
+    """
+    param = dict(_worker_init['param'])
+    param['random seed'] = seed
+    if max_t is not None:
+        param['max iteration'] = max_t
+    if _worker_init['cache'] is not None:
+        aucts = _worker_init['cache'].trajectory(param, _worker_init['attrs'])
+    else:
+        aucts = Auction(param, deepcopy(_worker_init['attrs'])).stream_sample()    # Auction modifies attrs
+
+    t_start = time.time()
+    sim = Simulator(seed if sim_seed is None else sim_seed, keep_events=False, keep_hist=False,
+                    profiler=Profiler(keep_time_log=False))
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.read_in_auction(aucts)
+        for _ in range(int(param['max iteration'])):
+            sim.step()
+    sim.close()
+    return {'seed': seed,
+            'sim_seed': seed if sim_seed is None else sim_seed,
+            'puids': list(sim.puids),
+            'cost': list(sim.costs_cumulative),
+            'revenue': list(sim.revenues_cumulative),
+            'profit': list(sim.profits_cumulative),
+            'seconds': time.time() - t_start}
+
+
+def _run_replication_args(args):
+    return run_replication(*args)
+
+
+def run_replications(param, attrs, seeds, max_t=None, num_workers=None, cache_dir=None):
+    """
+    runs one replication per seed across a process pool. Each worker process runs many seeds
+
+    :param param: auction parameters, as from Auction.read_init_xlsx
+    :param attrs: auction attributes, as from Auction.read_init_xlsx
+    :param seeds: list of seeds. seed is used both for the auction and the simulator
+    :param max_t: number of iterations. default is the configured 'max iteration'
+    :param num_workers: number of worker processes. default is the number of cores. 1 runs in this process
+    :param cache_dir: optional TrajectoryCache directory, shared by the worker processes
+    :return: list of run_replication results, in the order of seeds
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, len(seeds)))
+    jobs = [(seed, max_t) for seed in seeds]
+    if num_workers == 1:
+        _init_worker(param, attrs, cache_dir)
+        return [_run_replication_args(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                             initargs=(param, attrs, cache_dir)) as executor:
+        return list(executor.map(_run_replication_args, jobs))
+
+
+def mean_ci(values, level_t=None):
+    """
+    :param values: sample
+    :param level_t: critical value. default is the 95% value of Student's t with len(values) - 1 degrees of freedom
+    :return: mean, sample standard deviation, and confidence interval half width (nan if fewer than 2 values)
+    """
+    x = np.asarray(values, dtype=float)
+    if len(x) < 2:
+        return float(x.mean()) if len(x) > 0 else float('nan'), float('nan'), float('nan')
+    if level_t is None:
+        level_t = T_975[len(x) - 1] if len(x) - 1 < len(T_975) else 1.96
+    std = float(x.std(ddof=1))
+    return float(x.mean()), std, level_t * std / np.sqrt(len(x))
+
+
+def summarize(results, kind='profit'):
+    """
+    :param results: run_replications output
+    :param kind: 'profit', 'cost' or 'revenue'
+    :return: rows of the summary table, header first. one row per policy
+    """
+    puids = results[0]['puids']
+    values = np.array([r[kind] for r in results])
+    rows = [['puid', 'num_replications', kind + '_mean', kind + '_std', kind + '_ci95_low', kind + '_ci95_high']]
+    for p_ix, puid in enumerate(puids):
+        mean, std, half = mean_ci(values[:, p_ix])
+        rows.append([puid, len(results), mean, std, mean - half, mean + half])
+    return rows
+
+
+def replication_rows(results):
+    """
+    :param results: run_replications output
+    :return: rows of per-replication cumulative profits, header first
+    """
+    puids = results[0]['puids']
+    rows = [['seed', 'sim_seed', 'seconds'] + ['profit_{}'.format(puid) for puid in puids]]
+    for r in results:
+        rows.append([r['seed'], r['sim_seed'], r['seconds']] + r['profit'])
+    return rows
+
+
+def parse_seeds(s):
+    """
+    :param s: comma separated seeds and ranges, e.g. "1-10,42"
+    :return: list of int seeds
+    """
+    seeds = []
+    for part in s.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            seeds.extend(range(int(lo), int(hi) + 1))
+        else:
+            seeds.append(int(part))
+    return seeds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="runs simulations over many seeds, and summarizes policy profits")
+    parser.add_argument('config', help="auction configuration xlsx, e.g. auction_ini_01.xlsx")
+    parser.add_argument('--seeds', default='1-10', help="seeds and seed ranges, e.g. 1-30 or 1,5,9")
+    parser.add_argument('--max-t', type=int, default=None, help="iterations per replication")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes. default: number of cores")
+    parser.add_argument('--format', default='csv', help="output format, one of {}".format(ow.FORMATS))
+    parser.add_argument('--out', default='output_replications', help="output file name prefix")
+    parser.add_argument('--cache', default=None, help="trajectory cache directory, e.g. .traj_cache")
+    args = parser.parse_args()
+
+    t_start = time.time()
+    if args.cache is not None:
+        param, attrs = TrajectoryCache(args.cache).config(args.config)
+    else:
+        param, attrs = Auction.read_init_xlsx(args.config)
+    results = run_replications(param, attrs, parse_seeds(args.seeds), args.max_t, args.workers, args.cache)
+    summary = summarize(results)
+    ow.write_rows(args.format, ow.out_fname(args.out + "_summary", args.format), summary)
+    ow.write_rows(args.format, ow.out_fname(args.out, args.format), replication_rows(results))
+    for row in summary:
+        print("  ".join(str(v) for v in row))
+    print("{:.2f} sec: {} replications".format(time.time() - t_start, len(results)))
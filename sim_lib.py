@@ -3,7 +3,9 @@ Simulator library
 
 Donghun Lee 2018
 """
+import inspect
 import pickle
+from fractions import Fraction
 
 import numpy as np
 
@@ -20,6 +22,24 @@ def load_auction_p(fname):
     return pickle.load(open(fname, "rb"))
 
 
+def index_auctions_by_iter(aucts):
+    """
+    groups auctions by their 'iter' so that a simulator step only touches the auctions of that iteration
+
+    :param aucts: flat list of auction dicts (output of Auction.generate_sample() or load_auction_p),
+                  or an already grouped trajectory: dict {iter: list of auctions}, or list of per-iteration lists
+    :return: dict {iter: list of auctions}, auctions keep their original order within an iteration
+    """
+    if isinstance(aucts, dict):
+        return {t: list(it_aucts) for t, it_aucts in aucts.items()}
+    by_iter = {}
+    for item in aucts:
+        it_aucts = item if isinstance(item, (list, tuple)) else [item]
+        for a in it_aucts:
+            by_iter.setdefault(a['iter'], []).append(a)
+    return by_iter
+
+
 def load_policies(all_attrs, possible_bids, max_T):
     """
     loads policies from individual .py files. See policy_loader for more info
@@ -30,6 +50,29 @@ def load_policies(all_attrs, possible_bids, max_T):
     return pols, get_puids()
 
 
+_takes_attr_ids = {}    # policy class -> whether its bid_batch accepts attr_ids
+
+
+def call_bid_batch(pol, attrs, attr_ids):
+    """
+    calls pol.bid_batch, passing attr_ids only if its bid_batch accepts them, so that policies overriding
+    bid_batch(self, attrs) keep working
+
+    :param pol: policy object
+    :param attrs: list of attribute tuples, one per auction
+    :param attr_ids: list of attribute IDs, one per auction
+    :return: output of pol.bid_batch
+    """
+    cls = type(pol)
+    if cls not in _takes_attr_ids:
+        params = list(inspect.signature(cls.bid_batch).parameters.values())
+        _takes_attr_ids[cls] = (len(params) > 2 or
+                                any(p.kind == inspect.Parameter.VAR_POSITIONAL for p in params))
+    if _takes_attr_ids[cls]:
+        return pol.bid_batch(attrs, attr_ids)
+    return pol.bid_batch(attrs)
+
+
 def get_click_prob(theta, bid):
     """
     click probability, given theta and bid, using logistic function
@@ -70,6 +113,189 @@ def _compute_actual_second_price_cost(bid, sorted_unique_bid_list):
     return sorted_unique_bid_list[cost_ix]
 
 
+def gsp_slot_prices(bids, slot_pol, slot_click_prob=None):
+    """
+    generalized second price: each slot pays, per click, the next lower distinct bid among all bids
+    (the lowest bid pays itself). Same rule as _compute_actual_second_price_cost, for all slots at once
+
+    :param bids: numpy array of bids, one per policy
+    :param slot_pol: numpy array of policy index of each ad slot, highest bid first
+    :param slot_click_prob: not used
+    :return: numpy array of cost per click of each slot
+    """
+    unique_bids = np.unique(bids)
+    ix = np.searchsorted(unique_bids, bids[slot_pol])
+    return unique_bids[np.maximum(ix - 1, 0)]
+
+
+def vcg_slot_prices(bids, slot_pol, slot_click_prob):
+    """
+    VCG position auction: each slot pays, in total, the click loss its winner imposes on the bidders below it.
+    Slot k pays sum_{j>=k} (p_j - p_{j+1}) * b_{j+1} for click probabilities p (p_K = 0) and slot bids b,
+    where b_K is the highest bid without a slot (0 if every policy has a slot). Divided by p_k, per click
+
+    :param bids: numpy array of bids, one per policy
+    :param slot_pol: numpy array of policy index of each ad slot, highest bid first
+    :param slot_click_prob: click probability (or any proportional weight) of each slot, decreasing
+    :return: numpy array of cost per click of each slot
+    """
+    K = len(slot_pol)
+    desc_bids = np.sort(bids)[::-1]
+    next_bids = np.append(bids[slot_pol][1:], desc_bids[K] if len(bids) > K else 0.0)
+    p = np.asarray(slot_click_prob, dtype=float)[:K]
+    p_drop = p - np.append(p[1:], 0.0)
+    payment = np.cumsum((p_drop * next_bids)[::-1])[::-1]
+    return payment / p
+
+
+PRICING = {'gsp': gsp_slot_prices,
+           'vcg': vcg_slot_prices}
+
+
+def clear_auction(bids, slot_pol, slot_click_prob, pricing='gsp'):
+    """
+    clears one auction: the slot -> (policy, price per click) table, computed once for all clicks of the auction
+
+    :param bids: list of bids, one per policy
+    :param slot_pol: list of policy index of each ad slot, highest bid first (top_K_max output)
+    :param slot_click_prob: click probability of each slot
+    :param pricing: pricing rule, a key of PRICING ('gsp' or 'vcg')
+    :return: numpy arrays of policy index and cost per click, both indexed by ad slot
+    """
+    bids = np.asarray(bids, dtype=float)
+    slot_pol = np.asarray(slot_pol, dtype=int)
+    return slot_pol, PRICING[pricing](bids, slot_pol, slot_click_prob)
+
+
+def exact_mean(values, counts):
+    """
+    mean of values, each repeated counts times. Rounded exactly like statistics.mean, without expanding the list
+
+    :param values: list of numbers
+    :param counts: list of int, number of repetitions of each value
+    :return: float mean
+    """
+    total = sum(Fraction(v) * int(c) for v, c in zip(values, counts))
+    return float(total / sum(int(c) for c in counts))
+
+
+def aggregate_feedback(t, attrs, attr_ids, num_aucts, bids, click_auct_ix, click_winner, click_cost,
+                       click_conversion, click_revenue, no_click_winner, profit_prev):
+    """
+    aggregates one iteration of click events into per-policy feedback, grouped by (auction, winner) in one pass
+
+    Every auction becomes one aggregate per policy. An auction without clicks counts as one event won by
+    no_click_winner at the max bid, with no click.
+    Sums are accumulated click by click (unbuffered np.add.at), so they equal the sums over per-click lists.
+
+    :param t: iteration
+    :param attrs: list of attribute tuples, one per auction
+    :param attr_ids: list of attribute IDs (index into the simulator's sorted attribute list), one per auction
+    :param num_aucts: list of number of auctions, one per auction
+    :param bids: (num auctions, num policies) bids
+    :param click_auct_ix: auction index (into attrs) of each click
+    :param click_winner: winning policy index of each click
+    :param click_cost: cost of each click
+    :param click_conversion: conversion (0 or 1) of each click
+    :param click_revenue: realized revenue of each click (0 if not converted)
+    :param no_click_winner: per auction, policy index of the chosen max bidder if no click happened, else -1
+    :param profit_prev: cumulative profit of each policy before this iteration
+    :return: dict of numpy arrays, see feedback_to_p_infos
+    """
+    bids = np.asarray(bids, dtype=float)
+    num_a, num_p = bids.shape
+    click_auct_ix = np.asarray(click_auct_ix, dtype=int)
+    click_winner = np.asarray(click_winner, dtype=int)
+    click_cost = np.asarray(click_cost, dtype=float)
+    no_click_winner = np.asarray(no_click_winner, dtype=int)
+    flat_ix = click_auct_ix * num_p + click_winner
+
+    num_click = np.bincount(flat_ix, minlength=num_a * num_p).reshape(num_a, num_p)
+    num_conversion = np.bincount(flat_ix, weights=click_conversion, minlength=num_a * num_p)
+    num_conversion = num_conversion.astype(int).reshape(num_a, num_p)
+    cost_sum = np.zeros(num_a * num_p)
+    np.add.at(cost_sum, flat_ix, click_cost)
+    cost_sum = cost_sum.reshape(num_a, num_p)
+    revenue_sum = np.zeros(num_a * num_p)
+    np.add.at(revenue_sum, flat_ix, np.asarray(click_revenue, dtype=float))
+    revenue_sum = revenue_sum.reshape(num_a, num_p)
+    # a policy has one slot per auction, so all its clicks in an auction have the same cost
+    cost_per_click = np.full(num_a * num_p, np.nan)
+    cost_per_click[flat_ix] = click_cost
+    cost_per_click = cost_per_click.reshape(num_a, num_p)
+
+    # auctions without click: one event, won by a max bidder
+    no_click = no_click_winner >= 0
+    wins = num_click.copy()
+    wins[no_click, no_click_winner[no_click]] = 1
+    num_events = np.maximum(num_click.sum(axis=1), 1)
+
+    max_bid = bids.max(axis=1)
+    winning_bid = max_bid.copy()
+    winning_bid_avg = max_bid.copy()
+    for a_ix in np.nonzero(~no_click)[0]:
+        clicked = np.nonzero(num_click[a_ix])[0]
+        winning_bid[a_ix] = bids[a_ix, clicked].max()
+        winning_bid_avg[a_ix] = exact_mean(bids[a_ix, clicked], num_click[a_ix, clicked])
+
+    num_aucts_arr = np.asarray(num_aucts, dtype=np.int64)
+    num_impression = (num_aucts_arr[:, None] * wins / num_events[:, None]).astype(np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        revenue_per_conversion = np.where(num_conversion > 0, revenue_sum / num_conversion, np.nan)
+    profit_step = np.vstack([np.asarray(profit_prev, dtype=float)[None, :], revenue_sum - cost_sum])
+    profit_cumulative = np.cumsum(profit_step, axis=0)[1:]
+
+    return {'iter': t,
+            'attr': list(attrs),
+            'attr_id': list(attr_ids),
+            'num_auct': list(num_aucts),
+            'your_bid': bids,
+            'winning_bid': winning_bid,
+            'winning_bid_avg': winning_bid_avg,
+            'your_profit_cumulative': profit_cumulative,
+            'num_impression': num_impression,
+            'num_click': num_click,
+            'cost_per_click': cost_per_click,
+            'num_conversion': num_conversion,
+            'revenue_per_conversion': revenue_per_conversion}
+
+
+def feedback_to_p_infos(fb, p_ix):
+    """
+    builds the list of per-auction info dicts given to policy p_ix, from output of aggregate_feedback
+
+    :param fb: output of aggregate_feedback
+    :param p_ix: policy index
+    :return: list of dicts, the format Policy.learn receives (see output_policy_info_?????.xlsx),
+             with 'attr_id', the dense ID of 'attr' (its index in the policy's all_attrs)
+    """
+    your_bid = fb['your_bid'][:, p_ix].tolist()
+    profit = fb['your_profit_cumulative'][:, p_ix].tolist()
+    num_impression = fb['num_impression'][:, p_ix].tolist()
+    num_click = fb['num_click'][:, p_ix].tolist()
+    cost_per_click = fb['cost_per_click'][:, p_ix].tolist()
+    num_conversion = fb['num_conversion'][:, p_ix].tolist()
+    revenue_per_conversion = fb['revenue_per_conversion'][:, p_ix].tolist()
+    winning_bid = fb['winning_bid'].tolist()
+    winning_bid_avg = fb['winning_bid_avg'].tolist()
+
+    p_infos = []
+    for a_ix, attr in enumerate(fb['attr']):
+        p_infos.append({'iter': fb['iter'],
+                        'attr': attr,
+                        'attr_id': fb['attr_id'][a_ix],
+                        'num_auct': fb['num_auct'][a_ix],
+                        'your_bid': your_bid[a_ix],
+                        'winning_bid': winning_bid[a_ix],
+                        'winning_bid_avg': winning_bid_avg[a_ix],
+                        'your_profit_cumulative': profit[a_ix],
+                        'num_impression': num_impression[a_ix],
+                        'num_click': num_click[a_ix],
+                        'cost_per_click': cost_per_click[a_ix] if num_click[a_ix] > 0 else '',
+                        'num_conversion': num_conversion[a_ix],
+                        'revenue_per_conversion': revenue_per_conversion[a_ix] if num_conversion[a_ix] > 0 else ''})
+    return p_infos
+
 
 def max_ix(l):
     """ returns all indices of l whose element is the max value
@@ -93,17 +319,29 @@ def top_K_max(l, K=1, prng=None):
     :param prng: numpy-compatible PRNG, can be obtained from np.random.RandomState()
     :return: length-K list containing elements, and second return length-K list containing corresponding index in input l
 
-    Note that ties are randomly broken by random.shuffle function from numpy
+    Note that ties are randomly broken by random.shuffle function from numpy.
+    Only the candidates for the top K are sorted (O(N + C log C) for C candidates), and equal-bid groups are shuffled
+    in the same order as the original group-by-group scan, so the PRNG is consumed identically.
     """
     if prng is None:
         prng = np.random.RandomState()
+    arr = np.asarray(l)
+    n = len(arr)
+    if 0 < K < n:
+        # candidates: every element >= the K-th largest value. if that is exactly K elements,
+        # the next lower group is also shuffled (and dropped), as in the group-by-group scan
+        kth = np.partition(arr, n - K)[n - K]
+        candidates = np.nonzero(arr >= kth)[0]
+        if len(candidates) == K:
+            candidates = np.nonzero(arr >= arr[arr < kth].max())[0]
+    else:
+        candidates = np.arange(n)
+    order = candidates[np.argsort(-arr[candidates], kind='stable')]
+    group_start = np.flatnonzero(np.diff(arr[order])) + 1
+
     ret_ix = []
-    l2 = sorted(list(set(l)), reverse=True)
-    for v in l2:
-        indices = []
-        for ix, item in enumerate(l):
-            if item == v:
-                indices.append(ix)
+    for indices in np.split(order, group_start):
+        indices = indices.tolist()
         prng.shuffle(indices)
         ret_ix.extend(indices)
         if len(ret_ix) > K:
@@ -115,3 +353,32 @@ def top_K_max(l, K=1, prng=None):
     return ret1, ret2
 
 
+def top_K_max_batch(bids, K=1, prng=None):
+    """
+    top_K_max of many bid vectors in one call. Ties are broken uniformly at random by a random key per bid,
+    so the distribution of the output is the same as top_K_max, but the PRNG stream is not
+
+    :param bids: (num auctions, N) array-like, one row of bids per auction
+    :param K: int
+    :param prng: numpy-compatible PRNG, can be obtained from np.random.RandomState()
+    :return: (num auctions, K) array of elements and (num auctions, K) array of corresponding column indices,
+             in non-increasing order in each row
+    """
+    if prng is None:
+        prng = np.random.RandomState()
+    bids = np.asarray(bids, dtype=float)
+    num_a, n = bids.shape
+    K = min(K, n)
+    tie_key = prng.random_sample((num_a, n))
+    if K < n:
+        # keep the K largest (bid, key) pairs of each row: bids above the K-th largest bid, then the ties at it
+        kth = -np.partition(-bids, K - 1, axis=1)[:, K - 1:K]
+        select_key = np.where(bids > kth, -1.0, np.where(bids == kth, tie_key, np.inf))
+        cand_ix = np.argpartition(select_key, K - 1, axis=1)[:, :K]
+    else:
+        cand_ix = np.broadcast_to(np.arange(n), (num_a, n))
+    cand_bids = np.take_along_axis(bids, cand_ix, axis=1)
+    cand_keys = np.take_along_axis(tie_key, cand_ix, axis=1)
+    order = np.lexsort((cand_keys, -cand_bids), axis=1)
+    top_ix = np.take_along_axis(cand_ix, order, axis=1)
+    return np.take_along_axis(bids, top_ix, axis=1), top_ix
@@ -5,14 +5,17 @@ Donghun Lee 2018
 """
 
 
-from copy import deepcopy
-from statistics import mean
+import os
+import pickle
+from copy import copy, deepcopy
 
 import numpy as np
 import time
-from openpyxl import Workbook
 
 from auction import Auction
+from event_store import EventStore
+from profiler import Profiler
+import output_writers as ow
 import sim_lib as sl
 
 
@@ -21,54 +24,118 @@ class Simulator:
     Simulates ad-click auction over time
     """
 
-    def __init__(self, randseed=12345):
+    hist_outs = ['iter', 'attr', 'lambda', 'num_auct', 'bids', 'theta', 'p_click', 'num_click', 'cost_per_click',
+                 'num_conversion', 'revenue_per_conversion', 'costs_cumulative', 'revenues_cumulative', 'profits_cumulative']
+    policy_info_outs = ['iter', 'attr', 'num_auct', 'your_bid', 'winning_bid', 'winning_bid_avg', 'num_impression',
+                        'num_click', 'cost_per_click', 'num_conversion', 'revenue_per_conversion', 'your_profit_cumulative']
+    # if True, _learn gets p_infos=None unless they are built for history or output anyway
+    learns_from_arrays = False
+
+    def __init__(self, randseed=12345, click_sampling='batch', keep_events=True, sink=None, keep_hist=True,
+                 profiler=None, pricing='gsp', checkpoint_every=None, checkpoint_prefix='checkpoint'):
         """ initializes the auction simulating environment
 
         :param randseed: seed for the simulator. it is used for click and conversion sampling and tiebreaking
+        :param click_sampling: 'batch' draws the ad slots of all clicks of an auction in one call and sums up
+                               with numpy. 'scalar' is the reference click-by-click loop.
+                               Both consume the PRNG identically, so the same seed gives the same totals.
+        :param keep_events: if True, every click is kept in self.events (an EventStore).
+                            Set False when only aggregates are needed.
+        :param sink: optional output_writers.StreamingSink. Aggregate rows and policy feedback rows are written to it
+                     while the simulation runs, instead of only at output_all().
+        :param keep_hist: if True, aggregate history (self.hist) and policy feedback (self.p_infos) are kept in memory
+                          for output_all(). Set False with a sink to keep memory bounded.
+        :param profiler: optional profiler.Profiler, e.g. Profiler(sample_every=10, report_every=100).
+                         A default Profiler (no sampling, no reports) is used if not given.
+        :param pricing: cost per click rule of the ad slots, a key of sim_lib.PRICING. 'gsp' (generalized second
+                        price, each slot pays the next lower distinct bid) or 'vcg' (VCG position auction)
+        :param checkpoint_every: if given, save_checkpoint(checkpoint_prefix) is called every this many iterations.
+                                 A checkpoint is postponed to the next iteration if policies are not ready for it
+        :param checkpoint_prefix: checkpoint file name prefix, e.g. 'run01/checkpoint'
         """
-        self.time_last = time.time()
+        self.profiler = Profiler() if profiler is None else profiler
         self.prng = np.random.RandomState(randseed)
+        self.click_sampling = click_sampling
+        if pricing not in sl.PRICING:
+            raise ValueError("pricing must be one of {}, not {}".format(list(sl.PRICING.keys()), pricing))
+        self.pricing = pricing
         self.pols, self.puids = None, None
         self.possible_bids = list(range(10))
         self.possible_bids = list([v / 10 for v in range(100)])  # use python primitive types instead of numpy
         self.num_of_ad_slots = 8
         self.ad_slot_click_prob_adjuster = []
         self.auctions = None
+        self.auctions_by_iter = {}
+        self.auction_stream = None
         self.attrs = []
+        self.attr_ix = {}
         self.t = 0
         self.max_t = None
+        self.sink = sink
+        self.keep_hist = keep_hist
         self.hist = []
-        self.events = []
+        self.costs_cumulative, self.revenues_cumulative, self.profits_cumulative = [], [], []
+        self.pol_profit_cumulative = []
+        self.events = EventStore() if keep_events else None
         self.p_infos = {}
-        self.time_spent = {}
-        self._time_log('simulator')
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_prefix = checkpoint_prefix
+        # how much of hist, p_infos, events, the profiler's time log and the segments file the last checkpoint covers
+        self._checkpoint = {'hist': 0, 'p_infos': 0, 'events': 0, 'time_log': 0, 'segments_pos': 0}
+        self._checkpoint_due = False
 
-    def _time_log(self, n):
-        t = time.time()
-        if n in self.time_spent.keys():
-            self.time_spent[n] += t - self.time_last
-        else:
-            self.time_spent[n] = t - self.time_last
-        self.time_last = t
+    def close(self):
+        """
+        flushes and closes the output sink, if any
+        """
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    @property
+    def time_spent(self):
+        """
+        :return: dict of seconds spent so far, in the simulator ('simulator') and in each policy (puid)
+        """
+        return self.profiler.time_spent()
 
     def read_in_auction(self, aucts):
         """ reads in output from Auction.generate_sample(), and initializes policies
 
         :param aucts: output from Auction class. The maximum simulate-able iterations depends on this
+                      Either a flat list of auction dicts (as generated, or as loaded by sl.load_auction_p),
+                      or a trajectory already grouped by iteration: dict {iter: list of auctions} or a list of
+                      per-iteration lists,
+                      or a lazy source such as Auction.stream_sample(), having attrs, max_t and auctions_at(t).
         :return: none. After running this, it is possible to run the simulation
         """
-        self.time_last = time.time()
+        self.profiler.start('setup')
 
         self.auctions = aucts
-        self.attrs = sorted(list(set([a['attr'] for a in aucts])))
-        self.max_t = self.auctions[-1]['iter']
+        if hasattr(aucts, 'auctions_at'):
+            self.auction_stream = aucts
+            self.auctions_by_iter = {}
+            self.attrs = sorted(list(set(aucts.attrs)))
+            self.max_t = aucts.max_t
+        else:
+            self.auctions_by_iter = sl.index_auctions_by_iter(aucts)
+            self.attrs = sorted(list(set([a['attr'] for it_aucts in self.auctions_by_iter.values() for a in it_aucts])))
+            self.max_t = max(self.auctions_by_iter.keys())
+        # dense attribute ID: index into self.attrs, which policies also receive as all_attrs
+        self.attr_ix = {attr: ix for ix, attr in enumerate(self.attrs)}
         self._init_pols()
+        self.costs_cumulative = [0.0] * len(self.pols)
+        self.revenues_cumulative = [0.0] * len(self.pols)
+        self.profits_cumulative = [0.0] * len(self.pols)
+        self.pol_profit_cumulative = [0.0] * len(self.pols)
+        if self.sink is not None:
+            self.sink.open(self.hist_outs, self.policy_info_outs, self._time_logged_header(), self.puids)
         if len(self.pols) < self.num_of_ad_slots:
             print("number of policies less than number of ad slots. Reducing ad slot counts == number of policies = {}".format(len(self.pols)))
             self.num_of_ad_slots = len(self.pols)
         click_prob_adjuster = [0.3 * (0.7 ** i) for i in range(self.num_of_ad_slots)]  # geometric decaying click prob adjustment
         self.ad_slot_click_prob_adjuster = [p / sum(click_prob_adjuster) for p in click_prob_adjuster]
-        self._time_log('simulator')
+        self.profiler.stop('setup')
 
 
     def _init_pols(self):
@@ -76,17 +143,21 @@ class Simulator:
         internal function. Loads and initializes policies
         :return:
         """
-        self.time_last = time.time()
-
         if self.pols is None and self.puids is None and self.attrs != []:
             self.pols, self.puids = sl.load_policies(self.attrs, self.possible_bids, self.max_t)
             self.p_infos = {ix: [] for ix in range(len(self.pols))}
-            for puid in self.puids:
-                self.time_spent[puid] = 0.0
+            self.profiler.set_policies(self.puids)
         else:
             pass
 
-        self._time_log('simulator')
+    def _auctions_at(self, t):
+        """
+        :param t: iteration
+        :return: list of auctions of iteration t
+        """
+        if self.auction_stream is not None:
+            return self.auction_stream.auctions_at(t)
+        return self.auctions_by_iter.get(t, [])
 
     def get_num_clicks(self, bid, auct):
         theta = {'a': auct['theta'],
@@ -97,242 +168,444 @@ class Simulator:
         num_clicks = self.prng.binomial(auct['num_auct'], p_click)
         return num_clicks, p_click
 
+    def _get_bids(self, attrs, attr_ids):
+        """
+        collects bids of all policies for all auctions of an iteration, with one bid_batch call per policy
+
+        :param attrs: list of attribute tuples, one per auction
+        :param attr_ids: list of attribute IDs (index into self.attrs), one per auction
+        :return: list (one per auction) of bid lists (python float, one per policy)
+        """
+        prof = self.profiler
+        pol_bids = []
+        for p_ix, p in enumerate(self.pols):
+            t = prof.now()
+            these_bids = sl.call_bid_batch(p, attrs, attr_ids)
+            prof.record_policy(p_ix, 'bid', prof.now() - t)
+            pol_bids.append([float(b) for b in these_bids])
+        return [list(bids) for bids in zip(*pol_bids)]
+
+    def _learn(self, p_infos, fb=None):
+        """
+        post-auction learning session for policies
+
+        :param p_infos: dict {policy index: list of p_info dicts of this iteration}. None only if learns_from_arrays
+        :param fb: the same feedback as arrays, as from sl.aggregate_feedback. Unused here
+        :return: None
+        """
+        prof = self.profiler
+        for p_ix, p in enumerate(self.pols):
+            t = prof.now()
+            p.learn(p_infos[p_ix])
+            prof.record_policy(p_ix, 'learn', prof.now() - t)
+
+    def _assign_clicks_scalar(self, slot_pol, slot_price, conversion, revenue, costs_sum, revenues_sum, profits_sum):
+        """
+        reference click-by-click winner assignment. see _assign_clicks_batch for parameters and return values
+        """
+        slot_pol, slot_price = slot_pol.tolist(), slot_price.tolist()
+        winning_pol_ix = []
+        cost = []
+        for ix in range(len(conversion)):
+            # winner_ix = int(self.prng.choice(max_bid_pols_ix))   # max-bidder-wins case
+            # if geometric click prob, then winner_ix is one of top-K bids
+            # fill K positions with pIx, in non-decreasing order of bids[pIx]
+            # and choose one of K with custom set probability in geometrically decaying probability
+            # that chosen one is winner_ix of this click.
+            slot = int(self.prng.choice(len(slot_pol), p=self.ad_slot_click_prob_adjuster))
+            winner_ix = slot_pol[slot]
+            winning_pol_ix.append(winner_ix)
+            # the click is priced by the slot it landed in (as each click may have different winner than max bidder)
+            cost.append(slot_price[slot])
+            costs_sum[winner_ix] += cost[ix]
+            revenues_sum[winner_ix] += conversion[ix] * revenue[ix]
+            profits_sum[winner_ix] = revenues_sum[winner_ix] - costs_sum[winner_ix]
+        return winning_pol_ix, cost, (costs_sum, revenues_sum, profits_sum)
+
+    def _assign_clicks_batch(self, slot_pol, slot_price, conversion, revenue, costs_sum, revenues_sum, profits_sum):
+        """
+        assigns every click of one auction to an ad slot with a single PRNG call, and accumulates with numpy
+
+        The ad slots are drawn from the same uniform samples, in the same order, as the click-by-click loop,
+        and the sums are accumulated click by click (unbuffered np.add.at), so the results are identical.
+
+        :param slot_pol: policy index of each ad slot (top-K bidders), from sl.clear_auction
+        :param slot_price: cost per click of each ad slot, from sl.clear_auction
+        :param conversion: list of conversions, one per click
+        :param revenue: list of revenue samples, one per click
+        :param costs_sum: cumulative cost per policy before this auction
+        :param revenues_sum: cumulative revenue per policy before this auction
+        :param profits_sum: cumulative profit per policy before this auction
+        :return: winning policy index list and cost list (one per click),
+                 (costs, revenues, profits) cumulative lists after the auction
+        """
+        num_clicks = len(conversion)
+        if num_clicks == 0:
+            return [], [], (costs_sum, revenues_sum, profits_sum)
+
+        # one draw of ad slots for all clicks, priced by the slot table
+        slot_ix = self.prng.choice(len(slot_pol), size=num_clicks, p=self.ad_slot_click_prob_adjuster)
+        winners = slot_pol[slot_ix]
+        cost = slot_price[slot_ix]
+
+        costs = np.array(costs_sum)
+        np.add.at(costs, winners, cost)
+        revenues = np.array(revenues_sum)
+        np.add.at(revenues, winners, np.asarray(conversion) * np.asarray(revenue))
+        profits = revenues - costs
+        return winners.tolist(), cost.tolist(), (costs.tolist(), revenues.tolist(), profits.tolist())
+
     def step(self):
         """
         simulates one timestep in the auction
         :return: True if auction is simulated, False if no auction data is present
         """
-        self.time_last = time.time()
-
+        prof = self.profiler
         self.t += 1
         auction_happened = False
-        events = []
-
-        for a in self.auctions:
-            if a['iter'] != self.t:
-                continue
-
-            if len(self.hist) == 0:
-                costs_sum = [0.0] * len(self.pols)
-                revenues_sum = [0.0] * len(self.pols)
-                profits_sum = [0.0] * len(self.pols)
-            else:
-                costs_sum = deepcopy(self.hist[-1]['costs_cumulative'])
-                revenues_sum = deepcopy(self.hist[-1]['revenues_cumulative'])
-                profits_sum = deepcopy(self.hist[-1]['profits_cumulative'])
+        # per-auction and per-click arrays of this iteration, for the policy feedback
+        step_attrs, step_attr_ids, step_num_aucts, step_no_click_winner = [], [], [], []
+        click_auct_ix, click_winner, click_cost, click_conversion, click_revenue = [], [], [], [], []
+
+        prof.start('generation')
+        aucts = self._auctions_at(self.t)
+        prof.stop('generation')
+        prof.start('bidding')
+        attr_ids = [self.attr_ix[a['attr']] for a in aucts]
+        step_bids = self._get_bids([a['attr'] for a in aucts], attr_ids) if len(aucts) > 0 else []
+        prof.stop('bidding')
+        prof.start('click_sampling')
+        for a, attr_id, bids in zip(aucts, attr_ids, step_bids):
+            costs_sum = list(self.costs_cumulative)
+            revenues_sum = list(self.revenues_cumulative)
+            profits_sum = list(self.profits_cumulative)
 
             auction_happened = True
-            # bids = [float(p.bid(a['attr'])) for p in self.pols]
-            bids = []
-            for puid, p in zip(self.puids, self.pols):
-                self._time_log('simulator')
-                this_bid = p.bid(a['attr'])
-                self._time_log(puid)
-                bids.append(float(this_bid))
 
             max_bid_pols_ix = sl.max_ix(bids)
             winning_bid = bids[max_bid_pols_ix[0]]
             # take top K bids -- because K slots are there
             reverse_sorted_bids, sorted_pIx = sl.top_K_max(bids, self.num_of_ad_slots, self.prng)
-            sorted_unique_bids = sorted(list(set(bids)))
+            slot_pol, slot_price = sl.clear_auction(bids, sorted_pIx, self.ad_slot_click_prob_adjuster, self.pricing)
             num_clicks, p_click = self.get_num_clicks(winning_bid, a)
-            cost = sl.compute_second_price_cost(bids, size=num_clicks)  # second price auction
             conversion = Auction.get_conversion(a['prob_conversion'], self.prng, size=num_clicks)
             revenue = Auction.get_revenue_sample(a['avg_revenue'], self.prng, size=num_clicks)
 
-            winning_pol_ix = []
-            for ix in range(num_clicks):
-                # winner_ix = int(self.prng.choice(max_bid_pols_ix))   # max-bidder-wins case
-                # if geometric click prob, then winner_ix is one of top-K bids
-                # fill K positions with pIx, in non-decreasing order of bids[pIx]
-                # and choose one of K with custom set probability in geometrically decaying probability
-                # that chosen one is winner_ix of this click.
-                winner_ix = int(self.prng.choice(sorted_pIx, p=self.ad_slot_click_prob_adjuster))
-                winning_bid = bids[winner_ix]
-                winning_pol_ix.append(winner_ix)
-                # compute actual cost (second price) for each click (as each click may have different winner than max bidder)
-                actual_cost = sl._compute_actual_second_price_cost(bids[winner_ix], sorted_unique_bids)
-                cost[ix] = actual_cost
-                costs_sum[winner_ix] += cost[ix]
-                revenues_sum[winner_ix] += conversion[ix] * revenue[ix]
-                profits_sum[winner_ix] = revenues_sum[winner_ix] - costs_sum[winner_ix]
-                event = {'iter': self.t,
-                         'attr': a['attr'],
-                         'auctions_in_iter': a['num_auct'],
-                         'bids': bids,
-                         'winning_pol_id': winner_ix,
-                         'winning_pol_name': self.puids[winner_ix],
-                         'winning_bid': winning_bid,
-                         'num_click': 1,
-                         'cost_per_click': cost[ix],
-                         'num_conversion': conversion[ix],
-                         'revenue_per_conversion': conversion[ix] * revenue[ix],
-                         'costs_cumulative': deepcopy(costs_sum),
-                         'revenues_cumulative': deepcopy(revenues_sum),
-                         'profits_cumulative': deepcopy(profits_sum)}
-                events.append(event)
-                self.events.append(event)
+            if self.click_sampling == 'scalar':
+                assign_clicks = self._assign_clicks_scalar
+            else:
+                assign_clicks = self._assign_clicks_batch
+            winning_pol_ix, cost, sums = assign_clicks(slot_pol, slot_price, conversion, revenue,
+                                                       costs_sum, revenues_sum, profits_sum)
+            costs_sum, revenues_sum, profits_sum = sums
+            self.costs_cumulative, self.revenues_cumulative, self.profits_cumulative = sums
+            gain = [c * r for (c, r) in zip(conversion, revenue)]
             if num_clicks == 0:
                 winner_ix = int(self.prng.choice(max_bid_pols_ix))
-                event = {'iter': self.t,
-                         'attr': a['attr'],
-                         'auctions_in_iter': a['num_auct'],
-                         'bids': bids,
-                         'winning_pol_id': winner_ix,
-                         'winning_pol_name': self.puids[winner_ix],
-                         'winning_bid': winning_bid,
-                         'num_click': 0,
-                         'cost_per_click': '',
-                         'num_conversion': 0,
-                         'revenue_per_conversion': '',
-                         'costs_cumulative': deepcopy(costs_sum),
-                         'revenues_cumulative': deepcopy(revenues_sum),
-                         'profits_cumulative': deepcopy(profits_sum)}
-                events.append(event)
-                self.events.append(event)
+                if self.events is not None:
+                    self.events.append_no_click(self.t, attr_id, winner_ix)
+            else:
+                winner_ix = -1
+                if self.events is not None:
+                    self.events.append(self.t, attr_id, winning_pol_ix, cost, conversion, gain)
+
+            click_auct_ix.append(np.full(num_clicks, len(step_attrs)))
+            click_winner.append(winning_pol_ix)
+            click_cost.append(cost)
+            click_conversion.append(conversion)
+            click_revenue.append(gain)
+            step_attrs.append(a['attr'])
+            step_attr_ids.append(attr_id)
+            step_num_aucts.append(a['num_auct'])
+            step_no_click_winner.append(winner_ix)
 
             # keep aggregate history for output
-            auct_res = deepcopy(a)
+            auct_res = dict(a)
             auct_res['bids'] = bids
             auct_res['num_click'] = num_clicks
             auct_res['p_click'] = p_click
-            auct_res['cost_per_click'] = mean(cost) if num_clicks > 0 else ''
+            auct_res['cost_per_click'] = sl.exact_mean(*np.unique(cost, return_counts=True)) if num_clicks > 0 else ''
             auct_res['num_conversion'] = sum(conversion)
             auct_res['revenue_per_conversion'] = sum([ncr * rpc for (ncr, rpc) in zip(conversion, revenue)])/sum(conversion) if sum(conversion) > 0 else ''
             auct_res['costs_cumulative'] = deepcopy(costs_sum)
             auct_res['revenues_cumulative'] = deepcopy(revenues_sum)
             auct_res['profits_cumulative'] = deepcopy(profits_sum)
-            auct_res['time_spent'] = deepcopy(self.time_spent)
-            self.hist.append(auct_res)
+            if self.keep_hist:
+                self.hist.append(auct_res)
+            if self.sink is not None:
+                self.sink.write_hist(self._hist_row(auct_res))
             # end of auction events handling
+        prof.stop('click_sampling')
 
         # if nothing happened. this is the way to go
-        if len(events) == 0:
+        if len(step_attrs) == 0:
             return auction_happened
 
-        # aggregate information over one iteration is assembled, for each policy
-        p_infos = {}
+        # aggregate information over one iteration is assembled for all policies at once
+        prof.start('aggregation')
+        fb = sl.aggregate_feedback(self.t, step_attrs, step_attr_ids, step_num_aucts, step_bids,
+                                   np.concatenate(click_auct_ix), np.concatenate(click_winner),
+                                   np.concatenate(click_cost), np.concatenate(click_conversion),
+                                   np.concatenate(click_revenue), step_no_click_winner, self.pol_profit_cumulative)
+        self._finish_step(fb)
 
-        for p_ix, p in enumerate(self.pols):
-            p_infos[p_ix] = []
-            last_a = events[0]['attr']
-            bunch = []
+        return auction_happened
 
-            if len(self.p_infos[p_ix]) == 0:
-                profit_sum = 0.0
-            else:
-                profit_sum = self.p_infos[p_ix][-1][-1]['your_profit_cumulative']
-
-            for ev in events + [{'attr': 'guard_dummy'}]:
-                this_a = ev['attr']
-                if last_a == this_a and ev != 'guard_dummy':
-                    bunch.append(ev)
-                else:
-                    bids_that_got_clicked = [ev['winning_bid'] for ev in bunch]
-                    # aggregate information
-                    p_info = {'iter': bunch[0]['iter'],
-                              'attr': bunch[0]['attr'],
-                              'num_auct': bunch[0]['auctions_in_iter'],
-                              'your_bid': bunch[0]['bids'][p_ix],
-                              'winning_bid': max(bids_that_got_clicked),
-                              'winning_bid_avg': mean(bids_that_got_clicked)}
-                    win_count = []
-                    clicks = []
-                    costs = []
-                    conversions = []
-                    revenues = []
-                    for ev_b in bunch:
-                        if p_ix == ev_b['winning_pol_id']:
-                            win_count.append(1)
-                            clicks.append(ev_b['num_click'])
-                            costs.append(ev_b['cost_per_click'])
-                            conversions.append(ev_b['num_conversion'])
-                            revenues.append(ev_b['revenue_per_conversion'])
-
-                    approx_num_impression = int(p_info['num_auct']*sum(win_count)/len(bunch))
-
-                    p_add_info = {'num_impression': approx_num_impression,
-                                  'num_click': sum(clicks),
-                                  'cost_per_click': mean(costs) if sum(clicks) > 0 else '',
-                                  'num_conversion': sum(conversions),
-                                  'revenue_per_conversion': sum(revenues) / sum(conversions) if sum(conversions) > 0 else ''}
-
-                    this_cost = sum([c if c != '' else 0 for c in costs])
-                    this_revenue = sum([ncr * rpc for (ncr, rpc) in zip(conversions, [r if r != '' else 0 for r in revenues])])
-                    profit_sum += this_revenue - this_cost
-                    p_info['your_profit_cumulative'] = profit_sum
-                    p_info.update(p_add_info)
-                    p_infos[p_ix].append(p_info)
-
-                    # refresh rolling aggregator and its guard
-                    bunch = [ev]
-                    last_a = this_a
+    def _finish_step(self, fb):
+        """
+        second half of a step, shared by the simulation engines: policy feedback, learning and output.
+        Called within the step's 'aggregation' phase, which ends here, so that each phase is counted once per step
 
-        # post-auction learning session for policies
-        for p_ix, p in enumerate(self.pols):
-            self._time_log('simulator')
-            p.learn(p_infos[p_ix])
-            self._time_log(self.puids[p_ix])
+        :param fb: this iteration's feedback, as from sl.aggregate_feedback
+        :return: None
+        """
+        prof = self.profiler
+        self.pol_profit_cumulative = fb['your_profit_cumulative'][-1].tolist()
+        p_infos = None
+        if self.keep_hist or self.sink is not None or not self.learns_from_arrays:
+            p_infos = {p_ix: sl.feedback_to_p_infos(fb, p_ix) for p_ix in range(len(self.pols))}
+        prof.stop('aggregation')
 
-            self.p_infos[p_ix].append(p_infos[p_ix])
+        # post-auction learning session for policies
+        prof.start('learning')
+        self._learn(p_infos, fb)
+        prof.stop('learning')
+
+        prof.start('output')
+        if p_infos is not None:
+            for p_ix in range(len(self.pols)):
+                if self.keep_hist:
+                    self.p_infos[p_ix].append(p_infos[p_ix])
+                if self.sink is not None:
+                    self.sink.write_policy_info(p_ix, [self._policy_info_row(p_info) for p_info in p_infos[p_ix]])
+        prof.stop('output')
 
         # finish up
-        self._time_log('simulator')
-        print(self.time_spent)
+        prof.end_iter(self.t)
+        if self.sink is not None:
+            if prof.keep_time_log:
+                self.sink.write_time(self._time_logged_row(prof.time_log[-1]))
+            self.sink.end_iter(self.t)
+
+        if self.checkpoint_every is not None and self.t % self.checkpoint_every == 0:
+            self._checkpoint_due = True
+        if self._checkpoint_due and self._checkpoint_ready():
+            prof.start('checkpoint')
+            self.save_checkpoint(self.checkpoint_prefix)
+            prof.stop('checkpoint')
+            self._checkpoint_due = False
+
+    def _checkpoint_ready(self):
+        """
+        :return: True if the policies can be copied into a checkpoint now, without waiting for them
+        """
+        return True
 
-        return auction_happened
+    def _policy_objects(self):
+        """
+        :return: list of policy objects, for a checkpoint
+        """
+        for pol in self.pols:
+            pol.snapshot()
+        return self.pols
+
+    def _checkpoint_state(self):
+        """
+        :return: dict of additional state of a simulator variant, for a checkpoint
+        """
+        return {}
+
+    def _restore_checkpoint_state(self, state):
+        """
+        restores _checkpoint_state output, after the rest of a checkpoint is restored
+
+        :param state: dict, as from _checkpoint_state
+        """
+        pass
+
+    def _set_policy_objects(self, pols, puids):
+        """
+        uses policy objects restored from a checkpoint, instead of loading new policies
+
+        :param pols: list of policy objects
+        :param puids: list of policy unique ids
+        """
+        self.pols, self.puids = pols, puids
+
+    def save_checkpoint(self, prefix):
+        """
+        saves the simulation state after the current iteration. resume() continues from it bit-identically
+
+        Two files are written. <prefix>.segments gets one appended record with the aggregate history, policy feedback,
+        events and time log entries since the previous checkpoint. Then <prefix>.state (iteration, PRNG state,
+        cumulative sums, policy objects, profiler counters, output sink positions) is replaced atomically.
+
+        :param prefix: checkpoint file name prefix
+        :return: None
+        """
+        ck = self._checkpoint
+        num_p_infos = len(self.p_infos[0]) if len(self.p_infos) > 0 else 0
+        segment = {'t': self.t,
+                   'hist': self.hist[ck['hist']:],
+                   'p_infos': {p_ix: infos[ck['p_infos']:] for p_ix, infos in self.p_infos.items()},
+                   'events': self.events.since(ck['events']) if self.events is not None else None,
+                   'time_log': self.profiler.time_log[ck['time_log']:]}
+        with open(prefix + '.segments', 'ab') as ofh:
+            ofh.truncate(ck['segments_pos'])    # drops records written after the last complete checkpoint
+            pickle.dump(segment, ofh, protocol=pickle.HIGHEST_PROTOCOL)
+            segments_pos = ofh.tell()
+
+        profiler = copy(self.profiler)     # the time log grows with t, and goes to the segments instead
+        profiler.time_log = []
+        state = {'t': self.t,
+                 'prng': self.prng.get_state(),
+                 'costs_cumulative': self.costs_cumulative,
+                 'revenues_cumulative': self.revenues_cumulative,
+                 'profits_cumulative': self.profits_cumulative,
+                 'pol_profit_cumulative': self.pol_profit_cumulative,
+                 'puids': self.puids,
+                 'pols': self._policy_objects(),
+                 'profiler': profiler,
+                 'sink': self.sink.state() if self.sink is not None else None,
+                 'variant': self._checkpoint_state(),
+                 'checkpoint': {'hist': len(self.hist),
+                                'p_infos': num_p_infos,
+                                'events': len(self.events) if self.events is not None else 0,
+                                'time_log': len(self.profiler.time_log),
+                                'segments_pos': segments_pos}}
+        with open(prefix + '.state.tmp', 'wb') as ofh:
+            pickle.dump(state, ofh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(prefix + '.state.tmp', prefix + '.state')
+        self._checkpoint = state['checkpoint']
+
+    def resume(self, prefix, aucts):
+        """
+        restores the state saved by save_checkpoint. Call this on a new Simulator, created with the same arguments
+        (and a new sink of the same format and prefix, if any), instead of read_in_auction. Then keep calling step().
+
+        :param prefix: checkpoint file name prefix
+        :param aucts: the auction source of the checkpointed run, as given to read_in_auction.
+                      A new stream of an Auction with the same parameters works, it is fast-forwarded
+        :return: None
+        """
+        with open(prefix + '.state', 'rb') as ifh:
+            state = pickle.load(ifh)
+        self.profiler = state['profiler']
+        self._set_policy_objects(state['pols'], state['puids'])
+        sink, self.sink = self.sink, None
+        self.read_in_auction(aucts)
+        self.sink = sink
+        if self.sink is not None:
+            self.sink.open(self.hist_outs, self.policy_info_outs, self._time_logged_header(), self.puids,
+                           state=state['sink'])
+
+        self.t = state['t']
+        self.prng.set_state(state['prng'])
+        self.costs_cumulative = state['costs_cumulative']
+        self.revenues_cumulative = state['revenues_cumulative']
+        self.profits_cumulative = state['profits_cumulative']
+        self.pol_profit_cumulative = state['pol_profit_cumulative']
+        self.p_infos = {ix: [] for ix in range(len(self.pols))}
+        with open(prefix + '.segments', 'rb') as ifh:
+            while ifh.tell() < state['checkpoint']['segments_pos']:
+                segment = pickle.load(ifh)
+                if self.keep_hist:
+                    self.hist.extend(segment['hist'])
+                    for p_ix, infos in segment['p_infos'].items():
+                        self.p_infos[p_ix].extend(infos)
+                if self.events is not None and segment['events'] is not None:
+                    self.events.extend(segment['events'])
+                self.profiler.time_log.extend(segment['time_log'])
+        self._checkpoint = dict(state['checkpoint'], hist=len(self.hist),
+                                events=len(self.events) if self.events is not None else 0,
+                                time_log=len(self.profiler.time_log))
+        self._checkpoint['p_infos'] = len(self.p_infos[0]) if len(self.p_infos) > 0 else 0
+        if self.auction_stream is not None and self.t > 0:
+            self.auction_stream.auctions_at(self.t)     # streams only go forward: skip the simulated iterations
+        self._restore_checkpoint_state(state.get('variant', {}))
+
+    def _hist_row(self, h):
+        return [ow.cell(h[k]) for k in self.hist_outs]
+
+    def _hist_rows(self):
+        """
+        :return: generator of aggregate history rows, header first
+        """
+        yield self.hist_outs
+        for h in self.hist:
+            yield self._hist_row(h)
+            # ws.append([str(['{:.2f}'.format(i) for i in h[k] ]) if isinstance(h[k], (list, tuple)) else '{:.2f}'.format(h[k]) for k in outs])
+
+    def _time_logged_header(self):
+        return ['iter'] + ['t_{}'.format(k) for k in ['simulator'] + self.puids]
+
+    def _time_logged_row(self, time_log_entry):
+        t, time_spent = time_log_entry
+        return [t] + [time_spent[k] for k in ['simulator'] + self.puids]
+
+    def _time_logged_rows(self):
+        """
+        :return: generator of cumulative time spent rows, one per iteration, header first
+        """
+        yield self._time_logged_header()
+        for time_log_entry in self.profiler.time_log:
+            yield self._time_logged_row(time_log_entry)
+
+    def _policy_info_row(self, p_info):
+        return [ow.cell(p_info[k]) for k in self.policy_info_outs]
+
+    def _policy_info_rows(self, pol_ix):
+        """
+        :param pol_ix: policy index
+        :return: generator of rows of information given to policy for each iteration, header first
+        """
+        yield self.policy_info_outs
+        for p_info_iter in self.p_infos[pol_ix]:
+            for p_info in p_info_iter:
+                yield self._policy_info_row(p_info)
 
-    def output_hist_to_xlsx(self, fname, pol_name=None):
+    def output_hist_to_xlsx(self, fname, pol_name=None, fmt='xlsx'):
         """
         outputs aggregate history to xslx
         :param fname: output file name
         :param pol_name: if not provided, prints master version.
+        :param fmt: output format, one of output_writers.FORMATS
         :return:
         """
-        wb = Workbook()
-        ws = wb.active
-        outs = ['iter', 'attr', 'lambda', 'num_auct', 'bids', 'theta', 'p_click', 'num_click', 'cost_per_click',
-                'num_conversion', 'revenue_per_conversion', 'costs_cumulative', 'revenues_cumulative', 'profits_cumulative']
-        ws.append(outs),
-        for h in self.hist:
-            ws.append([str(h[k]) if isinstance(h[k], (list, tuple)) else h[k] for k in outs])
-            # ws.append([str(['{:.2f}'.format(i) for i in h[k] ]) if isinstance(h[k], (list, tuple)) else '{:.2f}'.format(h[k]) for k in outs])
-        wb.save(fname)
+        ow.write_rows(fmt, fname, self._hist_rows())
 
-    def output_time_logged_to_xlsx(self, fname):
-        wb = Workbook()
-        ws = wb.active
-        outs = ['simulator'] + self.puids
-        ws.append(['t_{}'.format(k) for k in outs])
-        for h in self.hist:
-            ws.append([h['time_spent'][k] for k in outs])
-        wb.save(fname)
+    def output_time_logged_to_xlsx(self, fname, fmt='xlsx'):
+        ow.write_rows(fmt, fname, self._time_logged_rows())
 
-    def output_policy_info_to_xlsx(self, fname, pol_ix):
+    def output_policy_info_to_xlsx(self, fname, pol_ix, fmt='xlsx'):
         """
         outputs information given to policy for each iteration
 
         :param fname:
         :param pol_ix:
+        :param fmt: output format, one of output_writers.FORMATS
         :return:
         """
+        ow.write_rows(fmt, fname, self._policy_info_rows(pol_ix))
 
-        wb = Workbook()
-        ws = wb.active
-        outs = ['iter', 'attr', 'num_auct', 'your_bid', 'winning_bid', 'winning_bid_avg', 'num_impression', 'num_click',
-                'cost_per_click', 'num_conversion', 'revenue_per_conversion', 'your_profit_cumulative']
-        ws.append(outs)
-        for p_info_iter in self.p_infos[pol_ix]:
-            for p_info in p_info_iter:
-                ws.append([p_info[k] if not isinstance(p_info[k], tuple) else str(p_info[k]) for k in outs])
-        wb.save(fname)
-
+    def output_all(self, fmt='xlsx', num_workers=None):
+        """
+        writes all output files. Rows are streamed to the writers, one table at a time, unless num_workers is given
 
-    def output_all(self):
-        self.output_hist_to_xlsx("output_master_aggregate.xlsx")
+        :param fmt: output format, one of output_writers.FORMATS: 'xlsx' (write-only workbook), 'csv',
+                    'npz' (numpy columnar binary) or 'parquet' (needs pyarrow)
+        :param num_workers: number of processes writing files in parallel. default writes one table at a time
+        :return: list of file names written
+        """
+        self.profiler.start('output')
+        tables = [(ow.out_fname("output_master_aggregate", fmt), self._hist_rows())]
         for ix, puid in enumerate(self.puids):
-            self.output_policy_info_to_xlsx("output_policy_info_{}.xlsx".format(puid), ix)
-        self.output_time_logged_to_xlsx("output_time_spent_in_seconds.xlsx")
+            tables.append((ow.out_fname("output_policy_info_{}".format(puid), fmt), self._policy_info_rows(ix)))
+        tables.append((ow.out_fname("output_time_spent_in_seconds", fmt), self._time_logged_rows()))
+        fnames = ow.write_tables(fmt, tables, num_workers)
+        self.profiler.stop('output')
+        self.profiler.save_summary("output_profile_summary.json")
+        return fnames + ["output_profile_summary.json"]
 
 
 if __name__ == "__main__":
@@ -342,8 +615,10 @@ if __name__ == "__main__":
 
     param, attrs = Auction.read_init_xlsx("auction_ini_02.xlsx")
     auc = Auction(param, attrs)
-    aucts = auc.generate_sample()
+    aucts = auc.stream_sample()   # generated one iteration at a time. auc.generate_sample() generates all at once
     # aucts = sl.load_auction_p("auction_01.p")   # loading from a snapshot example.
+    # aucts = load_trajectory("auction_01.traj")   # memory-mapped snapshot, see trajectory.py
+    # aucts = TrajectoryCache().trajectory(param, attrs)   # generated once per configuration, see traj_cache.py
     sim.read_in_auction(aucts)
 
     print("{:.2f} sec: finished loading simulator".format(time.time() - t_start))
@@ -353,4 +628,5 @@ if __name__ == "__main__":
 
     sim.output_all()
     print("{:.2f} sec: created output files.".format(time.time() - t_start))
+    print(sim.profiler.report())
     pass
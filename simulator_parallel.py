@@ -1,382 +1,674 @@
 """
-Simulator class
+Simulator class, with policies running in parallel worker processes
 
 Donghun Lee 2018
 """
 
 
-from copy import deepcopy
-from statistics import mean
-from multiprocessing import Pool
+import os
+import time
+import traceback
+from time import perf_counter_ns
+from multiprocessing import Pipe, Process, shared_memory
+from multiprocessing.connection import wait
 
 import numpy as np
-import time
-from openpyxl import Workbook
 
 from auction import Auction
+import output_writers as ow
+from policy_loader import get_pol, get_puids
 import sim_lib as sl
+import simulator
 
 
-class Simulator:
+def available_cores():
     """
-    Simulates ad-click auction over time
+    :return: number of cores this process may run on
     """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
-    def __init__(self, randseed=12345):
-        """ initializes the auction simulating environment
 
-        :param randseed: seed for the simulator. it is used for click and conversion sampling and tiebreaking
+# per-auction and (auction, policy) feedback arrays passed to workers through shared memory
+FEEDBACK_AUCTION_ARRAYS = [('fb_attr_id', np.int64), ('num_auct', np.int64),
+                           ('winning_bid', np.float64), ('winning_bid_avg', np.float64)]
+FEEDBACK_POLICY_ARRAYS = [('your_bid', np.float64), ('your_profit_cumulative', np.float64),
+                          ('num_impression', np.int64), ('num_click', np.int64), ('cost_per_click', np.float64),
+                          ('num_conversion', np.int64), ('revenue_per_conversion', np.float64)]
+# shared['stamp'] entries: stamp of the bid inputs (shared['attr_id']) and of the learn inputs (feedback arrays)
+BID_INPUTS, LEARN_INPUTS = 0, 1
+
+
+class SharedArrays:
+    """
+    numpy arrays in one multiprocessing.shared_memory block. Created by the simulator process and handed to the
+    worker processes, which read and write the same memory without pickling.
+    """
+
+    def __init__(self, spec):
         """
-        self.time_last = time.time()
-        self.prng = np.random.RandomState(randseed)
-        self.pols, self.puids = None, None
-        self.possible_bids = list(range(10))
-        self.possible_bids = list([v / 10 for v in range(100)])  # use python primitive types instead of numpy
-        self.num_of_ad_slots = 8
-        self.ad_slot_click_prob_adjuster = []
-        self.auctions = None
-        self.attrs = []
-        self.t = 0
-        self.max_t = None
-        self.hist = []
-        self.events = []
-        self.p_infos = {}
-        self.time_spent = {}
-        self._time_log('simulator')
-
-    def _time_log(self, n):
-        t = time.time()
-        if n in self.time_spent.keys():
-            self.time_spent[n] += t - self.time_last
-        else:
-            self.time_spent[n] = t - self.time_last
-        self.time_last = t
+        :param spec: list of (name, shape, dtype). dtypes are 8 bytes wide, so that every array is aligned
+        """
+        self.spec = [(name, tuple(shape), np.dtype(dtype).str) for name, shape, dtype in spec]
+        size = sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in self.spec)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.arrays = self._views()
+
+    def _views(self):
+        arrays, offset = {}, 0
+        for name, shape, dtype in self.spec:
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            offset += arrays[name].nbytes
+        return arrays
+
+    def __getstate__(self):
+        return {'spec': self.spec, 'name': self.shm.name}
+
+    def __setstate__(self, state):
+        self.spec = state['spec']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.arrays = self._views()
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self, unlink=False):
+        """
+        :param unlink: if True, also frees the memory block. Only the creating process does this
+        """
+        self.arrays = {}
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _shared_feedback(shared, all_attrs, t, num_a):
+    """
+    :return: one iteration's feedback in the format of sl.aggregate_feedback output, with views into shared memory
+    """
+    attr_ids = shared['fb_attr_id'][:num_a].tolist()
+    fb = {'iter': t,
+          'attr': [all_attrs[ix] for ix in attr_ids],
+          'attr_id': attr_ids,
+          'num_auct': shared['num_auct'][:num_a].tolist()}
+    for name, _ in FEEDBACK_AUCTION_ARRAYS[2:] + FEEDBACK_POLICY_ARRAYS:
+        fb[name] = shared[name][:num_a]
+    return fb
+
 
-    def read_in_auction(self, aucts):
-        """ reads in output from Auction.generate_sample(), and initializes policies
+def _policy_worker(conn, shard, all_attrs, possible_bids, max_t, shared):
+    """
+    worker process loop. Owns a fixed shard of policies for the whole run.
+
+    Policies are constructed here, and never leave the worker. Messages are (seq, cmd, arg), and every reply is
+    (seq, status, out), tagged with the sequence number of its request:
+    ('bid', ('shared', stamp, num_a)) -> [(p_ix, None, ns), ...], one bid_batch call per policy for the num_a
+        attribute IDs in shared['attr_id']. Bids are written to shared['bids'], one column per policy
+    ('bid', (attrs, attr_ids)) -> [(p_ix, bids, ns), ...], the same with data in the message, for iterations with
+        more auctions than the shared arrays hold
+    ('learn', ('shared', stamp, t, num_a)) -> [(p_ix, ns), ...], feedback of iteration t from the shared feedback
+        arrays
+    ('learn', {p_ix: p_infos}) -> [(p_ix, ns), ...], the same with data in the message
+    ('get', None) -> [(p_ix, policy object), ...], for a checkpoint. calls snapshot() of each policy first
+    ns is the nanoseconds the call took inside the worker
+    ('close', None) -> worker exits
+    status is 'ok', 'error' with a traceback string as out, or 'stale' (see below).
+    The pool overwrites shared inputs while a timed out worker may not have read them yet. It sets shared['stamp']
+    before it writes new inputs, so a worker copies the inputs first and then compares the stamp with the one in
+    its request. If they differ, no policy code runs, and the reply is 'stale': the pool sends the request again
+    with data in the message.
+
+    :param conn: worker end of a multiprocessing Pipe
+    :param shard: list of (policy index, puid, policy object or None). None constructs a new policy
+    :param all_attrs: list of all possible attributes
+    :param possible_bids: list of all allowed bids
+    :param max_t: maximum number of auction 'iter'
+    :param shared: SharedArrays of the pool
+    """
+    try:
+        pols = [(p_ix, pol if pol is not None else get_pol(puid)(all_attrs, possible_bids, max_t))
+                for p_ix, puid, pol in shard]
+        conn.send((0, 'ok', None))
+    except Exception:
+        conn.send((0, 'error', traceback.format_exc()))
+        return
+
+    while True:
+        seq, cmd, arg = conn.recv()
+        if cmd == 'close':
+            break
+        try:
+            out = []
+            in_shared = isinstance(arg, tuple) and arg[0] == 'shared'
+            if cmd == 'bid':
+                if in_shared:
+                    _, stamp, num_a = arg
+                    attr_ids = shared['attr_id'][:num_a].tolist()
+                    if shared['stamp'][BID_INPUTS] != stamp:
+                        conn.send((seq, 'stale', None))
+                        continue
+                    attrs = [all_attrs[ix] for ix in attr_ids]
+                else:
+                    attrs, attr_ids = arg
+                for p_ix, p in pols:
+                    t = perf_counter_ns()
+                    these_bids = [float(b) for b in sl.call_bid_batch(p, attrs, attr_ids)]
+                    call_ns = perf_counter_ns() - t
+                    if in_shared:
+                        shared['bids'][:num_a, p_ix] = these_bids
+                        these_bids = None
+                    out.append((p_ix, these_bids, call_ns))
+            elif cmd == 'learn':
+                if in_shared:
+                    _, stamp, t, num_a = arg
+                    fb = _shared_feedback(shared, all_attrs, t, num_a)
+                    p_infos = {p_ix: sl.feedback_to_p_infos(fb, p_ix) for p_ix, _ in pols}
+                    del fb
+                    if shared['stamp'][LEARN_INPUTS] != stamp:
+                        conn.send((seq, 'stale', None))
+                        continue
+                else:
+                    p_infos = arg
+                for p_ix, p in pols:
+                    t = perf_counter_ns()
+                    p.learn(p_infos[p_ix])
+                    out.append((p_ix, perf_counter_ns() - t))
+            elif cmd == 'get':
+                for _, p in pols:
+                    p.snapshot()
+                out = pols
+            conn.send((seq, 'ok', out))
+        except Exception:
+            conn.send((seq, 'error', traceback.format_exc()))
+    conn.close()
+    shared.close()
+
+
+class PolicyWorkerPool:
+    """
+    Long-lived pool of worker processes. Each worker owns a fixed shard of policies for the whole run.
+    Attribute IDs, bids and feedback arrays of an iteration are exchanged through shared memory, written once by
+    the simulator process, so only small control messages travel through the pipes.
 
-        :param aucts: output from Auction class. The maximum simulate-able iterations depends on this
-        :return: none. After running this, it is possible to run the simulation
+    With a call timeout or a run budget, the pool supervises its workers, and every policy gets a worker of its own.
+    A worker that does not reply in time is left out of that call, and of the following calls until its late reply
+    arrives (which is discarded). A worker over its run budget is stopped for the rest of the run.
+    """
+
+    def __init__(self, puids, all_attrs, possible_bids, max_t, num_workers=None, pols=None,
+                 call_timeout=None, run_budget=None):
+        """
+        starts worker processes and loads policies in them
+
+        :param puids: list of policy unique ids. policy index is the position in this list
+        :param all_attrs: list of all possible attributes
+        :param possible_bids: list of all allowed bids
+        :param max_t: maximum number of auction 'iter'
+        :param num_workers: number of worker processes. default is the number of available cores.
+                            Ignored with call_timeout or run_budget, which run one worker per policy
+        :param pols: optional list of policy objects (e.g. from a checkpoint) to run instead of new policies.
+                     A None entry is a policy that was stopped (see get_policies); its worker is not started
+        :param call_timeout: seconds a bid or learn call of a worker may take. default is no limit
+        :param run_budget: seconds of bid and learn calls a worker may take over the whole run. default is no limit
+        """
+        if call_timeout is not None or run_budget is not None:
+            num_workers = len(puids)
+        elif num_workers is None:
+            num_workers = available_cores()
+        num_workers = max(1, min(num_workers, len(puids)))
+        self.num_pols = len(puids)
+        self.call_timeout = call_timeout
+        self.run_budget = run_budget
+        self.seq = 0
+        self.shards = [[p_ix for p_ix in range(len(puids)) if p_ix % num_workers == w_ix]
+                       for w_ix in range(num_workers)]
+        # (seq, cmd, send time in ns, arg with data in the message) of a timed out request, until its reply
+        self.pending = [None] * num_workers
+        self.used_ns = [0] * num_workers        # time of finished bid and learn calls, as measured in the worker
+        self.stopped = [False] * num_workers
+        # an iteration has one auction per attribute combination, larger ones are sent through the pipes
+        self.capacity = len(all_attrs)
+        self.num_writes = 0
+        self.shared = SharedArrays([('stamp', (2,), np.int64),
+                                    ('attr_id', (self.capacity,), np.int64),
+                                    ('bids', (self.capacity, self.num_pols), np.float64)] +
+                                   [(name, (self.capacity,), dtype) for name, dtype in FEEDBACK_AUCTION_ARRAYS] +
+                                   [(name, (self.capacity, self.num_pols), dtype)
+                                    for name, dtype in FEEDBACK_POLICY_ARRAYS])
+        self.conns = []
+        self.procs = []
+        for w_ix, shard in enumerate(self.shards):
+            if pols is not None and all(pols[p_ix] is None for p_ix in shard):
+                self.stopped[w_ix] = True
+                self.conns.append(None)
+                self.procs.append(None)
+                continue
+            shard = [(p_ix, puids[p_ix], pols[p_ix] if pols is not None else None) for p_ix in shard]
+            parent_conn, child_conn = Pipe()
+            proc = Process(target=_policy_worker,
+                           args=(child_conn, shard, all_attrs, possible_bids, max_t, self.shared), daemon=True)
+            proc.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.procs.append(proc)
+        for w_ix in range(num_workers):
+            if not self.stopped[w_ix]:
+                self._recv(w_ix, 0)
+
+    def _recv(self, w_ix, seq):
+        """
+        :return: reply of the worker to request seq. None if its shared inputs were overwritten before it read them
+        """
+        reply_seq, status, out = self.conns[w_ix].recv()
+        if status == 'error':
+            raise RuntimeError("policy worker failed:\n" + out)
+        if reply_seq != seq:
+            raise RuntimeError("policy worker {} replied to request {}, expected {}".format(w_ix, reply_seq, seq))
+        return out
+
+    def _new_stamp(self, inputs):
         """
-        self.time_last = time.time()
+        marks shared inputs as overwritten. Call before writing them
 
-        self.auctions = aucts
-        self.attrs = sorted(list(set([a['attr'] for a in aucts])))
-        self.max_t = self.auctions[-1]['iter']
-        self._init_pols()
-        if len(self.pols) < self.num_of_ad_slots:
-            print("number of policies less than number of ad slots. Reducing ad slot counts == number of policies = {}".format(len(self.pols)))
-            self.num_of_ad_slots = len(self.pols)
-        click_prob_adjuster = [0.3 * (0.7 ** i) for i in range(self.num_of_ad_slots)]  # geometric decaying click prob adjustment
-        self.ad_slot_click_prob_adjuster = [p / sum(click_prob_adjuster) for p in click_prob_adjuster]
-        self._time_log('simulator')
+        :param inputs: BID_INPUTS or LEARN_INPUTS
+        :return: stamp of the new inputs, sent with the requests that read them
+        """
+        self.num_writes += 1
+        self.shared['stamp'][inputs] = self.num_writes
+        return self.num_writes
 
+    def _charge(self, w_ix, out):
+        """
+        adds the time of bid or learn calls in a worker reply to the worker's run budget use
+        """
+        self.used_ns[w_ix] += sum(r[-1] for r in out)
 
-    def _init_pols(self):
+    def _collect_late(self, w_ix):
         """
-        internal function. Loads and initializes policies
-        :return:
+        takes the late reply of a timed out request, if it has arrived. Its result is discarded.
+        A stale reply (shared inputs overwritten) is answered by sending the request again with data in the message
+        """
+        seq, cmd, t_sent, msg_arg = self.pending[w_ix]
+        if self.conns[w_ix].poll():
+            out = self._recv(w_ix, seq)
+            if out is None:
+                self.seq += 1
+                self.conns[w_ix].send((self.seq, cmd, msg_arg))
+                self.pending[w_ix] = (self.seq, cmd, t_sent, msg_arg)
+                return
+            if cmd != 'get':
+                self._charge(w_ix, out)
+            self.pending[w_ix] = None
+
+    def _over_budget_s(self, w_ix, now):
         """
-        self.time_last = time.time()
+        :return: seconds of calls so far, if over the run budget. None otherwise
+        """
+        if self.run_budget is None:
+            return None
+        used_ns = self.used_ns[w_ix]
+        if self.pending[w_ix] is not None:
+            used_ns += now - self.pending[w_ix][2]
+        return used_ns / 1e9 if used_ns > self.run_budget * 1e9 else None
+
+    def _stop(self, w_ix):
+        self.procs[w_ix].terminate()
+        self.procs[w_ix].join()
+        self.stopped[w_ix] = True
+        self.pending[w_ix] = None
+
+    def _call(self, cmd, args, timeout=None, msg_arg=None):
+        """
+        sends one request to each worker in args, and collects the replies that arrive within the timeout
+
+        :param cmd: 'bid', 'learn' or 'get'
+        :param args: dict {worker index: arg}
+        :param timeout: seconds to wait for replies. None waits for all
+        :param msg_arg: function of the worker index, returning the arg with data in the message, for args that refer
+                        to shared inputs. Called for timed out requests only, and kept in case the shared inputs are
+                        overwritten before they are read
+        :return: dict {worker index: reply} of workers that replied in time, and dict {worker index: (reason, seconds)}
+                 of overruns. reason is 'timeout', 'busy' (still running a timed out call) or 'budget' (run budget
+                 exceeded, the worker is stopped now). Stopped workers are neither sent requests nor reported again
+        """
+        sent = {}
+        overruns = {}
+        for w_ix, arg in args.items():
+            if self.stopped[w_ix]:
+                continue
+            if self.pending[w_ix] is not None:
+                self._collect_late(w_ix)
+            if self.pending[w_ix] is not None:
+                overruns[w_ix] = ('busy', (perf_counter_ns() - self.pending[w_ix][2]) / 1e9)
+                continue
+            self.seq += 1
+            self.conns[w_ix].send((self.seq, cmd, arg))
+            sent[w_ix] = self.seq
+
+        t_sent = perf_counter_ns()
+        deadline = None if timeout is None else t_sent + int(timeout * 1e9)
+        replies = {}
+        waiting = {self.conns[w_ix]: w_ix for w_ix in sent}
+        while waiting:
+            ready = wait(list(waiting), None if deadline is None else max(0, deadline - perf_counter_ns()) / 1e9)
+            if not ready:
+                break
+            for conn in ready:
+                w_ix = waiting.pop(conn)
+                replies[w_ix] = self._recv(w_ix, sent[w_ix])
+                if cmd != 'get':
+                    self._charge(w_ix, replies[w_ix])
+        now = perf_counter_ns()
+        for w_ix in waiting.values():
+            self.pending[w_ix] = (sent[w_ix], cmd, t_sent, msg_arg(w_ix) if msg_arg is not None else None)
+            overruns[w_ix] = ('timeout', (now - t_sent) / 1e9)
+
+        for w_ix in args:
+            if not self.stopped[w_ix]:
+                used_s = self._over_budget_s(w_ix, now)
+                if used_s is not None:
+                    self._stop(w_ix)
+                    overruns[w_ix] = ('budget', used_s)
+        return replies, overruns
+
+    def _policy_overruns(self, overruns):
+        return {p_ix: overrun for w_ix, overrun in overruns.items() for p_ix in self.shards[w_ix]}
+
+    def bid(self, attrs, attr_ids):
+        """
+        one message per worker for all auctions of an iteration
 
-        if self.pols is None and self.puids is None and self.attrs != []:
-            self.pols, self.puids = sl.load_policies(self.attrs, self.possible_bids, self.max_t)
-            self.p_infos = {ix: [] for ix in range(len(self.pols))}
-            for puid in self.puids:
-                self.time_spent[puid] = 0.0
+        :param attrs: list of attribute tuples, one per auction
+        :param attr_ids: list of attribute IDs, one per auction
+        :return: list of bid lists (one per auction, for attrs) and nanoseconds spent list, both indexed by policy index,
+                 and dict {policy index: (reason, seconds)} of overruns.
+                 Both lists have None for policies without a reply in time
+        """
+        num_a = len(attr_ids)
+        workers = range(len(self.conns))
+        if num_a <= self.capacity:
+            stamp = self._new_stamp(BID_INPUTS)
+            self.shared['attr_id'][:num_a] = attr_ids
+            args = {w_ix: ('shared', stamp, num_a) for w_ix in workers}
+            msg_arg = lambda w_ix: (attrs, attr_ids)
+        else:
+            args, msg_arg = {w_ix: (attrs, attr_ids) for w_ix in workers}, None
+        replies, overruns = self._call('bid', args, self.call_timeout, msg_arg)
+        pol_bids = [None] * self.num_pols
+        ns = [None] * self.num_pols
+        for out in replies.values():
+            for p_ix, these_bids, call_ns in out:
+                pol_bids[p_ix] = these_bids if these_bids is not None else self.shared['bids'][:num_a, p_ix].tolist()
+                ns[p_ix] = call_ns
+        return pol_bids, ns, self._policy_overruns(overruns)
+
+    def learn(self, p_infos, fb=None):
+        """
+        writes the feedback arrays to shared memory once, and workers build their own policies' p_info dicts.
+        Without fb (or with more auctions than the shared arrays hold), each worker is sent its policies' p_infos
+
+        :param p_infos: dict {policy index: list of p_info dicts}, or None to build them from fb where needed
+        :param fb: the same feedback as arrays, as from sl.aggregate_feedback. Required if p_infos is None
+        :return: nanoseconds spent list, indexed by policy index (None for policies without a reply in time),
+                 and dict {policy index: (reason, seconds)} of overruns
+        """
+        def shard_p_infos(w_ix):
+            if p_infos is None:
+                return {p_ix: sl.feedback_to_p_infos(fb, p_ix) for p_ix in self.shards[w_ix]}
+            return {p_ix: p_infos[p_ix] for p_ix in self.shards[w_ix]}
+
+        if fb is not None and len(fb['attr_id']) <= self.capacity:
+            num_a = len(fb['attr_id'])
+            stamp = self._new_stamp(LEARN_INPUTS)
+            self.shared['fb_attr_id'][:num_a] = fb['attr_id']
+            for name, _ in FEEDBACK_AUCTION_ARRAYS[1:] + FEEDBACK_POLICY_ARRAYS:
+                self.shared[name][:num_a] = fb[name]
+            args = {w_ix: ('shared', stamp, fb['iter'], num_a) for w_ix in range(len(self.conns))}
+            msg_arg = shard_p_infos
         else:
-            pass
-
-        self._time_log('simulator')
-
-    def get_num_clicks(self, bid, auct):
-        theta = {'a': auct['theta'],
-                 'bid': 0,                 # TODO: adjust this with attribute as well?
-                 '0': 0,                   # TODO: baseline click probability
-                 'max_click_prob': 0.5}
-        p_click = sl.get_click_prob(theta, bid)
-        num_clicks = self.prng.binomial(auct['num_auct'], p_click)
-        return num_clicks, p_click
-
-    def bid_from_policy(self, puid, p, a):
-        t = time.time()
-        # print('Computing Policy {}'.format(puid))
-        this_bid = float(p.bid(a['attr']))
-        time_last = {puid: time.time()-t}
-        # print('Finished computing Policy {} in {:f} secs'.format(puid, time_last[puid]))
-        return this_bid, time_last, p
-
-    def step(self):
+            args = {w_ix: shard_p_infos(w_ix) for w_ix in range(len(self.conns)) if not self.stopped[w_ix]}
+            msg_arg = None
+        replies, overruns = self._call('learn', args, self.call_timeout, msg_arg)
+        ns = [None] * self.num_pols
+        for out in replies.values():
+            for p_ix, call_ns in out:
+                ns[p_ix] = call_ns
+        return ns, self._policy_overruns(overruns)
+
+    def idle(self):
         """
-        simulates one timestep in the auction
-        :return: True if auction is simulated, False if no auction data is present
+        :return: True if no worker is running a timed out call. Late replies that have arrived are taken first
         """
-        self.time_last = time.time()
+        for w_ix in range(len(self.conns)):
+            if self.pending[w_ix] is not None:
+                self._collect_late(w_ix)
+        return all(pending is None for pending in self.pending)
 
-        self.t += 1
-        auction_happened = False
-        events = []
+    def get_policies(self):
+        """
+        waits for the late replies of timed out calls, then copies the policies.
+        With a run budget, a worker is waited for until its budget runs out, and then stopped
 
-        for a in self.auctions:
-            if a['iter'] != self.t:
+        :return: list of copies of the policy objects, indexed by policy index (None for policies of stopped workers),
+                 and dict {policy index: (reason, seconds)} of overruns while waiting
+        """
+        overruns = {}
+        for w_ix in range(len(self.conns)):
+            while self.pending[w_ix] is not None:
+                wait_s = None
+                if self.run_budget is not None:
+                    used_ns = self.used_ns[w_ix] + perf_counter_ns() - self.pending[w_ix][2]
+                    wait_s = max(0, self.run_budget * 1e9 - used_ns) / 1e9
+                if not self.conns[w_ix].poll(wait_s):
+                    used_ns = self.used_ns[w_ix] + perf_counter_ns() - self.pending[w_ix][2]
+                    self._stop(w_ix)
+                    overruns[w_ix] = ('budget', used_ns / 1e9)
+                    break
+                self._collect_late(w_ix)
+        replies, _ = self._call('get', {w_ix: None for w_ix in range(len(self.conns))})
+        pols = [None] * self.num_pols
+        for out in replies.values():
+            for p_ix, pol in out:
+                pols[p_ix] = pol
+        return pols, self._policy_overruns(overruns)
+
+    def close(self):
+        for w_ix, (conn, proc) in enumerate(zip(self.conns, self.procs)):
+            if self.stopped[w_ix]:
                 continue
+            if self.pending[w_ix] is not None:
+                proc.terminate()     # still running a timed out call
+                continue
+            try:
+                conn.send((None, 'close', None))
+                conn.close()
+            except (OSError, BrokenPipeError):
+                pass
+        for proc in self.procs:
+            if proc is None:
+                continue
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+        self.conns, self.procs = [], []
+        if self.shared is not None:
+            self.shared.close(unlink=True)
+            self.shared = None
 
-            if len(self.hist) == 0:
-                costs_sum = [0.0] * len(self.pols)
-                revenues_sum = [0.0] * len(self.pols)
-                profits_sum = [0.0] * len(self.pols)
-            else:
-                costs_sum = deepcopy(self.hist[-1]['costs_cumulative'])
-                revenues_sum = deepcopy(self.hist[-1]['revenues_cumulative'])
-                profits_sum = deepcopy(self.hist[-1]['profits_cumulative'])
-
-            auction_happened = True
-            # bids = [float(p.bid(a['attr'])) for p in self.pols]
-            # bids = []
-            pool = Pool(24)
-            results = pool.starmap(Simulator().bid_from_policy, zip(self.puids, self.pols, [a] * len(self.pols)))
-            pool.close()
-            pool.join()
-            bids = [b for (b, t, p) in results]
-            time_last = [t for (b, t, p) in results]
-            pols = [p for (b, t, p) in results]
-            self.pols = pols
-            dicts = {}
-            for dict in time_last:
-                dicts.update(dict)
-            for n in dicts.keys():
-                if n in self.time_spent.keys():
-                    self.time_spent[n] += dicts[n]
-                else:
-                    self.time_spent[n] = dicts[n]
-
-            #for puid, p in zip(self.puids, self.pols):
-            #    self._time_log('simulator')
-            #    this_bid = p.bid(a['attr'])
-            #    self._time_log(puid)
-            #    bids.append(float(this_bid))
-
-            max_bid_pols_ix = sl.max_ix(bids)
-            winning_bid = bids[max_bid_pols_ix[0]]
-            # take top K bids -- because K slots are there
-            reverse_sorted_bids, sorted_pIx = sl.top_K_max(bids, self.num_of_ad_slots, self.prng)
-            sorted_unique_bids = sorted(list(set(bids)))
-            num_clicks, p_click = self.get_num_clicks(winning_bid, a)
-            cost = sl.compute_second_price_cost(bids, size=num_clicks)  # second price auction
-            conversion = Auction.get_conversion(a['prob_conversion'], self.prng, size=num_clicks)
-            revenue = Auction.get_revenue_sample(a['avg_revenue'], self.prng, size=num_clicks)
-
-            winning_pol_ix = []
-            for ix in range(num_clicks):
-                # winner_ix = int(self.prng.choice(max_bid_pols_ix))   # max-bidder-wins case
-                # if geometric click prob, then winner_ix is one of top-K bids
-                # fill K positions with pIx, in non-decreasing order of bids[pIx]
-                # and choose one of K with custom set probability in geometrically decaying probability
-                # that chosen one is winner_ix of this click.
-                winner_ix = int(self.prng.choice(sorted_pIx, p=self.ad_slot_click_prob_adjuster))
-                winning_bid = bids[winner_ix]
-                winning_pol_ix.append(winner_ix)
-                # compute actual cost (second price) for each click (as each click may have different winner than max bidder)
-                actual_cost = sl._compute_actual_second_price_cost(bids[winner_ix], sorted_unique_bids)
-                cost[ix] = actual_cost
-                costs_sum[winner_ix] += cost[ix]
-                revenues_sum[winner_ix] += conversion[ix] * revenue[ix]
-                profits_sum[winner_ix] = revenues_sum[winner_ix] - costs_sum[winner_ix]
-                event = {'iter': self.t,
-                         'attr': a['attr'],
-                         'auctions_in_iter': a['num_auct'],
-                         'bids': bids,
-                         'winning_pol_id': winner_ix,
-                         'winning_pol_name': self.puids[winner_ix],
-                         'winning_bid': winning_bid,
-                         'num_click': 1,
-                         'cost_per_click': cost[ix],
-                         'num_conversion': conversion[ix],
-                         'revenue_per_conversion': conversion[ix] * revenue[ix],
-                         'costs_cumulative': deepcopy(costs_sum),
-                         'revenues_cumulative': deepcopy(revenues_sum),
-                         'profits_cumulative': deepcopy(profits_sum)}
-                events.append(event)
-                self.events.append(event)
-            if num_clicks == 0:
-                winner_ix = int(self.prng.choice(max_bid_pols_ix))
-                event = {'iter': self.t,
-                         'attr': a['attr'],
-                         'auctions_in_iter': a['num_auct'],
-                         'bids': bids,
-                         'winning_pol_id': winner_ix,
-                         'winning_pol_name': self.puids[winner_ix],
-                         'winning_bid': winning_bid,
-                         'num_click': 0,
-                         'cost_per_click': '',
-                         'num_conversion': 0,
-                         'revenue_per_conversion': '',
-                         'costs_cumulative': deepcopy(costs_sum),
-                         'revenues_cumulative': deepcopy(revenues_sum),
-                         'profits_cumulative': deepcopy(profits_sum)}
-                events.append(event)
-                self.events.append(event)
-
-            # keep aggregate history for output
-            auct_res = deepcopy(a)
-            auct_res['bids'] = bids
-            auct_res['num_click'] = num_clicks
-            auct_res['p_click'] = p_click
-            auct_res['cost_per_click'] = mean(cost) if num_clicks > 0 else ''
-            auct_res['num_conversion'] = sum(conversion)
-            auct_res['revenue_per_conversion'] = sum([ncr * rpc for (ncr, rpc) in zip(conversion, revenue)])/sum(conversion) if sum(conversion) > 0 else ''
-            auct_res['costs_cumulative'] = deepcopy(costs_sum)
-            auct_res['revenues_cumulative'] = deepcopy(revenues_sum)
-            auct_res['profits_cumulative'] = deepcopy(profits_sum)
-            auct_res['time_spent'] = deepcopy(self.time_spent)
-            self.hist.append(auct_res)
-            # end of auction events handling
-
-        # if nothing happened. this is the way to go
-        if len(events) == 0:
-            return auction_happened
-
-        # aggregate information over one iteration is assembled, for each policy
-        p_infos = {}
-
-        for p_ix, p in enumerate(self.pols):
-            p_infos[p_ix] = []
-            last_a = events[0]['attr']
-            bunch = []
-
-            if len(self.p_infos[p_ix]) == 0:
-                profit_sum = 0.0
-            else:
-                profit_sum = self.p_infos[p_ix][-1][-1]['your_profit_cumulative']
-
-            for ev in events + [{'attr': 'guard_dummy'}]:
-                this_a = ev['attr']
-                if last_a == this_a and ev != 'guard_dummy':
-                    bunch.append(ev)
-                else:
-                    bids_that_got_clicked = [ev['winning_bid'] for ev in bunch]
-                    # aggregate information
-                    p_info = {'iter': bunch[0]['iter'],
-                              'attr': bunch[0]['attr'],
-                              'num_auct': bunch[0]['auctions_in_iter'],
-                              'your_bid': bunch[0]['bids'][p_ix],
-                              'winning_bid': max(bids_that_got_clicked),
-                              'winning_bid_avg': mean(bids_that_got_clicked)}
-                    win_count = []
-                    clicks = []
-                    costs = []
-                    conversions = []
-                    revenues = []
-                    for ev_b in bunch:
-                        if p_ix == ev_b['winning_pol_id']:
-                            win_count.append(1)
-                            clicks.append(ev_b['num_click'])
-                            costs.append(ev_b['cost_per_click'])
-                            conversions.append(ev_b['num_conversion'])
-                            revenues.append(ev_b['revenue_per_conversion'])
-
-                    approx_num_impression = int(p_info['num_auct']*sum(win_count)/len(bunch))
-
-                    p_add_info = {'num_impression': approx_num_impression,
-                                  'num_click': sum(clicks),
-                                  'cost_per_click': mean(costs) if sum(clicks) > 0 else '',
-                                  'num_conversion': sum(conversions),
-                                  'revenue_per_conversion': sum(revenues) / sum(conversions) if sum(conversions) > 0 else ''}
-
-                    this_cost = sum([c if c != '' else 0 for c in costs])
-                    this_revenue = sum([ncr * rpc for (ncr, rpc) in zip(conversions, [r if r != '' else 0 for r in revenues])])
-                    profit_sum += this_revenue - this_cost
-                    p_info['your_profit_cumulative'] = profit_sum
-                    p_info.update(p_add_info)
-                    p_infos[p_ix].append(p_info)
-
-                    # refresh rolling aggregator and its guard
-                    bunch = [ev]
-                    last_a = this_a
-
-        # post-auction learning session for policies
-        for p_ix, p in enumerate(self.pols):
-            self._time_log('simulator')
-            p.learn(p_infos[p_ix])
-            self._time_log(self.puids[p_ix])
-
-            self.p_infos[p_ix].append(p_infos[p_ix])
-
-        # finish up
-        self._time_log('simulator')
-        print(self.time_spent)
-
-        return auction_happened
-
-    def output_hist_to_xlsx(self, fname, pol_name=None):
+
+class Simulator(simulator.Simulator):
+    """
+    Simulates ad-click auction over time, with policies living in a persistent pool of worker processes
+
+    self.pols only holds policy indices; the policy objects are inside the workers.
+    Call close() (or use as a context manager) to stop the workers.
+
+    With call_timeout or run_budget, policies run supervised, one worker each, and a slow policy cannot stall a step
+    for longer than call_timeout. A policy without bids in time bids its fallback bids, and a policy without a learn
+    reply in time misses that feedback. Overruns are kept in self.overruns, and written by output_all().
+    """
+
+    overrun_outs = ['iter', 'puid', 'call', 'reason', 'seconds']
+    # workers build p_infos from the feedback arrays themselves
+    learns_from_arrays = True
+
+    def __init__(self, randseed=12345, num_workers=None, call_timeout=None, run_budget=None, fallback='last',
+                 max_checkpoint_delay=3, **kwargs):
+        """ initializes the auction simulating environment
+
+        :param randseed: seed for the simulator. it is used for click and conversion sampling and tiebreaking
+        :param num_workers: number of policy worker processes. default is the number of available cores.
+                            With call_timeout or run_budget, every policy gets a worker of its own, whatever
+                            num_workers is: a worker is timed as a whole, so a slow policy would hold back the
+                            others in its worker
+        :param call_timeout: seconds one bid_batch or learn call of a policy may take. default is no limit
+        :param run_budget: seconds of bid_batch and learn calls a policy may take over the whole run. A policy over
+                           its budget is stopped, and bids its fallback bids from then on. default is no limit
+        :param fallback: bid of a policy that did not bid in time. 'last' is its last bid for the same attributes
+                         (the minimum possible bid if there is none), 'min' is the minimum possible bid
+        :param max_checkpoint_delay: iterations a due checkpoint may be postponed while a policy is still running a
+                                     timed out call. After that, the checkpoint waits for the call (or, with a
+                                     run budget, until the policy is stopped)
+        :param kwargs: passed to simulator.Simulator
         """
-        outputs aggregate history to xslx
-        :param fname: output file name
-        :param pol_name: if not provided, prints master version.
+        if fallback not in ['last', 'min']:
+            raise ValueError("fallback must be 'last' or 'min', not {}".format(fallback))
+        self.num_workers = num_workers
+        self.call_timeout = call_timeout
+        self.run_budget = run_budget
+        self.fallback = fallback
+        self.max_checkpoint_delay = max_checkpoint_delay
+        self._checkpoint_delay = 0
+        self.overruns = []
+        self.pool = None
+        self._restored_pols = None
+        self._last_bids = None
+        super().__init__(randseed, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        super().close()
+
+    def _init_pols(self):
+        """
+        internal function. Starts the worker pool, which loads and initializes policies
         :return:
         """
-        wb = Workbook()
-        ws = wb.active
-        outs = ['iter', 'attr', 'lambda', 'num_auct', 'bids', 'theta', 'p_click', 'num_click', 'cost_per_click',
-                'num_conversion', 'revenue_per_conversion', 'costs_cumulative', 'revenues_cumulative', 'profits_cumulative']
-        ws.append(outs),
-        for h in self.hist:
-            ws.append([str(h[k]) if isinstance(h[k], (list, tuple)) else h[k] for k in outs])
-            # ws.append([str(['{:.2f}'.format(i) for i in h[k] ]) if isinstance(h[k], (list, tuple)) else '{:.2f}'.format(h[k]) for k in outs])
-        wb.save(fname)
-
-    def output_time_logged_to_xlsx(self, fname):
-        wb = Workbook()
-        ws = wb.active
-        outs = ['simulator'] + self.puids
-        ws.append(['t_{}'.format(k) for k in outs])
-        for h in self.hist:
-            ws.append([h['time_spent'][k] for k in outs])
-        wb.save(fname)
-
-    def output_policy_info_to_xlsx(self, fname, pol_ix):
+        if self.pool is None and self.attrs != []:
+            if self._restored_pols is None:
+                self.puids = get_puids()
+                self.profiler.set_policies(self.puids)
+            self.pool = PolicyWorkerPool(self.puids, self.attrs, self.possible_bids, self.max_t, self.num_workers,
+                                         pols=self._restored_pols, call_timeout=self.call_timeout,
+                                         run_budget=self.run_budget)
+            self._restored_pols = None
+            self.pols = list(range(len(self.puids)))
+            self.p_infos = {ix: [] for ix in range(len(self.pols))}
+            # last bid of each policy for each attribute ID, nan before its first bid
+            self._last_bids = np.full((len(self.pols), len(self.attrs)), np.nan)
+
+    def _checkpoint_ready(self):
+        # a policy still running a timed out call cannot be copied without waiting for it. A checkpoint is postponed
+        # for at most max_checkpoint_delay iterations, then save_checkpoint waits
+        if self.pool.idle() or self._checkpoint_delay >= self.max_checkpoint_delay:
+            self._checkpoint_delay = 0
+            return True
+        self._checkpoint_delay += 1
+        return False
+
+    def _policy_objects(self):
+        pols, overruns = self.pool.get_policies()
+        self._log_overruns('checkpoint', overruns)
+        return pols
+
+    def _checkpoint_state(self):
+        return {'overruns': self.overruns, 'last_bids': self._last_bids, 'used_ns': self.pool.used_ns}
+
+    def _restore_checkpoint_state(self, state):
+        self.overruns = state['overruns']
+        self._last_bids = state['last_bids']
+        self.pool.used_ns = state['used_ns']
+
+    def _set_policy_objects(self, pols, puids):
+        self._restored_pols, self.puids = pols, puids
+
+    def _record_policies(self, call, ns):
+        for p_ix, call_ns in enumerate(ns):
+            if call_ns is not None:
+                self.profiler.record_policy(p_ix, call, call_ns)
+
+    def _log_overruns(self, call, overruns):
+        for p_ix, (reason, seconds) in sorted(overruns.items()):
+            self.overruns.append({'iter': self.t, 'puid': self.puids[p_ix], 'call': call,
+                                  'reason': reason, 'seconds': seconds})
+
+    def _fallback_bids(self, p_ix, attr_ids):
+        min_bid = min(self.possible_bids)
+        if self.fallback == 'min':
+            return [min_bid] * len(attr_ids)
+        return [min_bid if np.isnan(b) else float(b) for b in self._last_bids[p_ix, attr_ids].tolist()]
+
+    def _get_bids(self, attrs, attr_ids):
+        pol_bids, ns, overruns = self.pool.bid(attrs, attr_ids)
+        self._record_policies('bid', ns)
+        self._log_overruns('bid', overruns)
+        for p_ix, these_bids in enumerate(pol_bids):
+            if these_bids is None:
+                pol_bids[p_ix] = self._fallback_bids(p_ix, attr_ids)
+            elif self.fallback == 'last':
+                self._last_bids[p_ix, attr_ids] = these_bids
+        return [list(bids) for bids in zip(*pol_bids)]
+
+    def _learn(self, p_infos, fb=None):
+        ns, overruns = self.pool.learn(p_infos, fb)
+        self._record_policies('learn', ns)
+        self._log_overruns('learn', overruns)
+
+    def _overrun_rows(self):
+        yield self.overrun_outs
+        for o in self.overruns:
+            yield [o[k] for k in self.overrun_outs]
+
+    def output_all(self, fmt='xlsx', num_workers=None):
         """
-        outputs information given to policy for each iteration
+        writes all output files, and output_policy_overruns if any policy call overran
 
-        :param fname:
-        :param pol_ix:
-        :return:
+        :param fmt: output format, one of output_writers.FORMATS
+        :param num_workers: number of processes writing files in parallel. default writes one table at a time
+        :return: list of file names written
         """
-
-        wb = Workbook()
-        ws = wb.active
-        outs = ['iter', 'attr', 'num_auct', 'your_bid', 'winning_bid', 'winning_bid_avg', 'num_impression', 'num_click',
-                'cost_per_click', 'num_conversion', 'revenue_per_conversion', 'your_profit_cumulative']
-        ws.append(outs)
-        for p_info_iter in self.p_infos[pol_ix]:
-            for p_info in p_info_iter:
-                ws.append([p_info[k] if not isinstance(p_info[k], tuple) else str(p_info[k]) for k in outs])
-        wb.save(fname)
-
-
-    def output_all(self):
-        self.output_hist_to_xlsx("output_master_aggregate.xlsx")
-        for ix, puid in enumerate(self.puids):
-            self.output_policy_info_to_xlsx("output_policy_info_{}.xlsx".format(puid), ix)
-        self.output_time_logged_to_xlsx("output_time_spent_in_seconds.xlsx")
+        fnames = super().output_all(fmt, num_workers)
+        if len(self.overruns) > 0:
+            fname = ow.out_fname("output_policy_overruns", fmt)
+            ow.write_rows(fmt, fname, self._overrun_rows())
+            fnames.append(fname)
+        return fnames
 
 
 if __name__ == "__main__":
     t_start = time.time()
     print("{:.2f} sec: start loading simulator".format(time.time() - t_start))
-    sim = Simulator()
-
-    param, attrs = Auction.read_init_xlsx("auction_ini_01.xlsx")
-    auc = Auction(param, attrs)
-    aucts = auc.generate_sample()
-    # aucts = sl.load_auction_p("auction_01.p")   # loading from a snapshot example.
-    sim.read_in_auction(aucts)
-
-    print("{:.2f} sec: finished loading simulator".format(time.time() - t_start))
-    for t in range(param['max iteration']):
-        sim_res = sim.step()
-        print("{:.2f} sec: simulation iter {}, auction happened? {}".format(time.time() - t_start, t, sim_res))
-
-    sim.output_all()
-    print("{:.2f} sec: created output files.".format(time.time() - t_start))
-    pass
+    with Simulator() as sim:
+        param, attrs = Auction.read_init_xlsx("auction_ini_01.xlsx")
+        auc = Auction(param, attrs)
+        aucts = auc.generate_sample()
+        # aucts = sl.load_auction_p("auction_01.p")   # loading from a snapshot example.
+        sim.read_in_auction(aucts)
+
+        print("{:.2f} sec: finished loading simulator".format(time.time() - t_start))
+        for t in range(param['max iteration']):
+            sim_res = sim.step()
+            print("{:.2f} sec: simulation iter {}, auction happened? {}".format(time.time() - t_start, t, sim_res))
+
+        sim.output_all()
+        print("{:.2f} sec: created output files.".format(time.time() - t_start))
+        print(sim.profiler.report())
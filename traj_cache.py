@@ -0,0 +1,220 @@
+"""
+Content-addressed on-disk cache of parsed configurations and generated trajectories
+
+Parsing auction_ini_??.xlsx (openpyxl) and generating a trajectory are repeated for every run of a sweep.
+The cache keeps both, keyed by the sha256 of their inputs:
+
+    config_<sha256 of the xlsx bytes>.json       parsed (param, attrs) of Auction.read_init_xlsx
+    <sha256 of param, attrs, generator version>.traj   trajectory file (see trajectory.py), memory-mapped on load
+    <same key>.json                               the param and attrs the trajectory was generated from
+
+Files are written to a temporary name and moved into place with os.replace, so readers never see partial files
+and concurrent writers of the same entry are harmless. Eviction (least recently used first, down to max_bytes)
+runs under an exclusive file lock.
+
+    cache = TrajectoryCache('.traj_cache')
+    param, attrs = cache.config("auction_ini_01.xlsx")
+    aucts = cache.trajectory(param, attrs)      # feed into Simulator.read_in_auction
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from copy import deepcopy
+
+try:
+    import fcntl
+except ImportError:     # not on POSIX: eviction is not serialized between processes
+    fcntl = None
+
+from auction import Auction
+import trajectory
+
+
+# bump when Auction's sampling changes, so that trajectories generated by older code are not reused
+GENERATOR_VERSION = 1
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def trajectory_key(param, attrs):
+    """
+    :param param: auction parameters, as from Auction.read_init_xlsx ('random seed' and 'max iteration' included)
+    :param attrs: auction attributes, as from Auction.read_init_xlsx
+    :return: cache key of the trajectory generated from them
+    """
+    content = {'param': param, 'attrs': attrs, 'generator': GENERATOR_VERSION, 'format': trajectory.VERSION}
+    return _sha256(json.dumps(content, sort_keys=True).encode('utf-8'))
+
+
+class TrajectoryCache:
+    """
+    Local cache directory of parsed configurations and trajectories, bounded in size by LRU eviction.
+    Safe to share between processes.
+    """
+
+    def __init__(self, root='.traj_cache', max_bytes=1 << 30):
+        """
+        :param root: cache directory. created if missing
+        :param max_bytes: size limit of the cache directory. least recently used entries are evicted above it
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    @contextmanager
+    def _lock(self):
+        with open(self._path('.lock'), 'a') as lock_fh:
+            if fcntl is not None:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+    def _write_atomic(self, name, write):
+        """
+        :param name: file name in the cache directory
+        :param write: function writing the file, given a (temporary) file name
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.tmp_')
+        os.close(fd)
+        os.chmod(tmp, 0o644)
+        try:
+            write(tmp)
+            os.replace(tmp, self._path(name))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _write_json(self, name, obj):
+        def write(fname):
+            with open(fname, 'w') as ofh:
+                json.dump(obj, ofh)
+        self._write_atomic(name, write)
+
+    def _touch(self, name):
+        """
+        marks an entry as used. Returns False if it does not exist (anymore)
+        """
+        try:
+            os.utime(self._path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def config(self, fname):
+        """
+        parsed configuration of an xlsx file, parsed once per file content
+
+        :param fname: auction configuration xlsx, e.g. auction_ini_01.xlsx
+        :return: param, attrs, as Auction.read_init_xlsx(fname)
+        """
+        with open(fname, 'rb') as ifh:
+            name = 'config_{}.json'.format(_sha256(ifh.read()))
+        if self._touch(name):
+            try:
+                with open(self._path(name)) as ifh:
+                    cached = json.load(ifh)
+                self.hits += 1
+                return cached['param'], cached['attrs']
+            except FileNotFoundError:
+                pass
+        self.misses += 1
+        param, attrs = Auction.read_init_xlsx(fname)
+        self._write_json(name, {'param': param, 'attrs': attrs})
+        self.evict()
+        return param, attrs
+
+    def trajectory(self, param, attrs):
+        """
+        trajectory of an auction configuration, generated once per content
+
+        :param param: auction parameters, as from Auction.read_init_xlsx. 'random seed' and 'max iteration' are part
+                      of the key
+        :param attrs: auction attributes, as from Auction.read_init_xlsx. not modified
+        :return: memory-mapped trajectory.Trajectory, with the same auctions as Auction(param, attrs).generate_sample()
+        """
+        key = trajectory_key(param, attrs)
+        if self._touch(key + '.traj'):
+            try:
+                traj = trajectory.load_trajectory(self._path(key + '.traj'))
+                self.hits += 1
+                return traj
+            except FileNotFoundError:
+                pass
+        self.misses += 1
+        columns = Auction(param, deepcopy(attrs)).generate_columns()    # Auction parses (and modifies) attrs
+        self._write_json(key + '.json', {'param': param, 'attrs': attrs, 'generator': GENERATOR_VERSION})
+        self._write_atomic(key + '.traj', lambda fname: trajectory.save_columns(fname, *columns))
+        traj = trajectory.load_trajectory(self._path(key + '.traj'))
+        self.evict(keep=key)
+        return traj
+
+    def entries(self):
+        """
+        :return: list of (last use time, size in bytes, file names) of cache entries, least recently used first
+        """
+        by_entry = {}
+        with os.scandir(self.root) as it:
+            for f in it:
+                if f.name.startswith('.') or not f.is_file():
+                    continue
+                stem = os.path.splitext(f.name)[0]
+                st = f.stat()
+                used, size, names = by_entry.get(stem, (0, 0, []))
+                by_entry[stem] = (max(used, st.st_mtime), size + st.st_size, names + [f.name])
+        return sorted(by_entry.values())
+
+    def size(self):
+        """
+        :return: total size of cache entries in bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """
+        removes least recently used entries until the cache is within max_bytes
+
+        :param keep: key of an entry that is never removed, e.g. the one just written
+        :return: number of entries removed
+        """
+        removed = 0
+        with self._lock():
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, names in entries:
+                if total <= self.max_bytes:
+                    break
+                if keep is not None and os.path.splitext(names[0])[0] == keep:
+                    continue
+                for name in names:
+                    try:
+                        os.remove(self._path(name))
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                removed += 1
+        return removed
+
+    def clear(self):
+        """
+        removes all cache entries
+        """
+        with self._lock():
+            for _, _, names in self.entries():
+                for name in names:
+                    try:
+                        os.remove(self._path(name))
+                    except FileNotFoundError:
+                        pass
@@ -0,0 +1,208 @@
+"""
+Columnar binary trajectory format
+
+A trajectory file stores auction arrivals as columns, and can be memory-mapped so that a simulator only reads
+the iterations it needs. Layout of a file:
+
+    b'ADCTRAJ1'                   8 bytes magic
+    header length                 uint32, little endian
+    header                        utf-8 json: version, attrs, max_t, num_rows, and dtype/offset of each column
+    columns                       raw little-endian arrays, each starting at a 64-byte aligned offset
+
+Rows are sorted by iteration. Column 'iter_ptr' (length max_t + 2) gives row ranges: rows of iteration t are
+iter_ptr[t]:iter_ptr[t + 1].
+"""
+
+import json
+import pickle
+import struct
+
+import numpy as np
+
+import sim_lib as sl
+
+
+MAGIC = b'ADCTRAJ1'
+VERSION = 1
+ALIGN = 64
+
+# column name -> dtype. attr is stored as an index into the header's attrs list
+COLUMNS = {'iter': '<i4',
+           'attr_ix': '<i4',
+           'num_auct': '<i8',
+           'lambda': '<f8',
+           'theta': '<f8',
+           'avg_revenue': '<f8',
+           'prob_conversion': '<f8'}
+
+
+def save_columns(fname, attrs, columns):
+    """
+    writes a trajectory file from columns
+
+    :param fname: output file name, usually auction_???.traj
+    :param attrs: list of attribute tuples. columns['attr_ix'] indexes this list
+    :param columns: dict of 1-d arrays, keys as in COLUMNS. rows must be sorted by 'iter'
+    :return: None
+    """
+    iters = np.asarray(columns['iter'], dtype=COLUMNS['iter'])
+    if len(iters) > 1 and np.any(np.diff(iters) < 0):
+        raise ValueError("trajectory rows must be sorted by iter")
+    max_t = int(iters.max()) if len(iters) > 0 else 0
+    arrays = {k: np.ascontiguousarray(columns[k], dtype=dtype) for k, dtype in COLUMNS.items()}
+    arrays['iter_ptr'] = np.searchsorted(iters, np.arange(max_t + 2), side='left').astype('<i8')
+
+    col_info = {}
+    offset = 0
+    for k, arr in arrays.items():
+        col_info[k] = {'dtype': arr.dtype.str, 'length': len(arr), 'offset': offset}
+        offset += -(-arr.nbytes // ALIGN) * ALIGN
+    header = {'version': VERSION,
+              'attrs': [list(attr) for attr in attrs],
+              'max_t': max_t,
+              'num_rows': len(iters),
+              'columns': col_info}
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 4 + len(header_bytes)) // ALIGN) * ALIGN
+
+    with open(fname, 'wb') as ofh:
+        ofh.write(MAGIC)
+        ofh.write(struct.pack('<I', len(header_bytes)))
+        ofh.write(header_bytes)
+        for k, arr in arrays.items():
+            ofh.seek(data_start + col_info[k]['offset'])
+            ofh.write(arr.tobytes())
+        ofh.truncate(data_start + offset)
+
+
+def save_trajectory(aucts, fname):
+    """
+    writes auctions to a trajectory file
+
+    :param aucts: output from Auction.generate_sample(), or anything Simulator.read_in_auction accepts as a list
+    :param fname: output file name, usually auction_???.traj
+    :return: None
+    """
+    by_iter = sl.index_auctions_by_iter(aucts)
+    rows = [a for t in sorted(by_iter.keys()) for a in by_iter[t]]
+    attrs = sorted(list(set([a['attr'] for a in rows])))
+    attr_ix = {attr: ix for ix, attr in enumerate(attrs)}
+    columns = {k: [a[k] for a in rows] for k in COLUMNS if k != 'attr_ix'}
+    columns['attr_ix'] = [attr_ix[a['attr']] for a in rows]
+    save_columns(fname, attrs, columns)
+
+
+class Trajectory:
+    """
+    Memory-mapped trajectory file. Can be fed into Simulator.read_in_auction, which then reads only
+    the iterations it simulates.
+    """
+
+    def __init__(self, fname):
+        """
+        :param fname: trajectory file name, written by save_trajectory or save_columns
+        """
+        with open(fname, 'rb') as ifh:
+            if ifh.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a trajectory file".format(fname))
+            header_len, = struct.unpack('<I', ifh.read(4))
+            header = json.loads(ifh.read(header_len).decode('utf-8'))
+        if header['version'] > VERSION:
+            raise ValueError("trajectory file version {} is not supported".format(header['version']))
+        data_start = -(-(len(MAGIC) + 4 + header_len) // ALIGN) * ALIGN
+
+        self.fname = fname
+        self.attrs = [tuple(attr) for attr in header['attrs']]
+        self.max_t = header['max_t']
+        self.num_rows = header['num_rows']
+        self.columns = {}
+        for k, info in header['columns'].items():
+            if info['length'] == 0:
+                self.columns[k] = np.zeros(0, dtype=info['dtype'])
+            else:
+                self.columns[k] = np.memmap(fname, dtype=info['dtype'], mode='r',
+                                            offset=data_start + info['offset'], shape=(info['length'],))
+        self.iter_ptr = self.columns.pop('iter_ptr')
+
+    def __len__(self):
+        return self.num_rows
+
+    def columns_at(self, t):
+        """
+        :param t: iteration
+        :return: dict of column slices (numpy arrays) of iteration t
+        """
+        if t < 0 or t > self.max_t:
+            return {k: col[0:0] for k, col in self.columns.items()}
+        start, end = self.iter_ptr[t], self.iter_ptr[t + 1]
+        return {k: col[start:end] for k, col in self.columns.items()}
+
+    def auctions_at(self, t):
+        """
+        :param t: iteration
+        :return: list of auction dicts of iteration t, same format as Auction.generate_sample() output
+        """
+        cols = self.columns_at(t)
+        lists = {k: col.tolist() for k, col in cols.items()}
+        return [{'attr': self.attrs[lists['attr_ix'][ix]],
+                 'iter': lists['iter'][ix],
+                 'lambda': lists['lambda'][ix],
+                 'num_auct': lists['num_auct'][ix],
+                 'theta': lists['theta'][ix],
+                 'avg_revenue': lists['avg_revenue'][ix],
+                 'prob_conversion': lists['prob_conversion'][ix]} for ix in range(len(lists['iter']))]
+
+    def __iter__(self):
+        """
+        :return: generator of per-iteration auction lists, iter 1, 2, ..., max_t
+        """
+        for t in range(1, self.max_t + 1):
+            yield self.auctions_at(t)
+
+    def to_list(self):
+        """
+        :return: flat list of auction dicts, same format as Auction.generate_sample() output
+        """
+        return [a for it_aucts in self for a in it_aucts]
+
+
+def load_trajectory(fname):
+    """
+    :param fname: trajectory file name
+    :return: memory-mapped Trajectory
+    """
+    return Trajectory(fname)
+
+
+def pickle_to_trajectory(pfname, fname):
+    """
+    converts a pickled auction list (auction_???.p) to a trajectory file
+
+    :param pfname: pickle file name
+    :param fname: output trajectory file name
+    :return: None
+    """
+    save_trajectory(sl.load_auction_p(pfname), fname)
+
+
+def trajectory_to_pickle(fname, pfname):
+    """
+    converts a trajectory file back to a pickled auction list, loadable by sim_lib.load_auction_p
+
+    :param fname: trajectory file name
+    :param pfname: output pickle file name
+    :return: None
+    """
+    with open(pfname, 'wb') as ofh:
+        pickle.dump(load_trajectory(fname).to_list(), ofh)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) != 3:
+        print("usage: python trajectory.py <in.p> <out.traj>   or   python trajectory.py <in.traj> <out.p>")
+    elif sys.argv[1].endswith('.traj'):
+        trajectory_to_pickle(sys.argv[1], sys.argv[2])
+    else:
+        pickle_to_trajectory(sys.argv[1], sys.argv[2])